@@ -4,35 +4,237 @@ API endpoints for AI server functionality.
 
 import os
 from typing import Dict, Any, Optional, List
-from fastapi import FastAPI, HTTPException, BackgroundTasks, WebSocket, WebSocketDisconnect, Request
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi import FastAPI, HTTPException, Query, WebSocket, WebSocketDisconnect, Request
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 from pydantic import BaseModel
 import asyncio
 import uvicorn
 import logging
 import json
+import itertools
+from collections import OrderedDict
 from datetime import datetime
 
+from ai_server.metrics import REGISTRY, MetricsMiddleware, metrics_endpoint
+from ai_server.computer_use.agent_metrics import agent_metric_families, record_task_finished
 from ai_server.computer_use.config import ComputerUseConfig
 from ai_server.computer_use.service import ComputerUseAgent
+from ai_server.computer_use.browser_pool import close_browser_pools, prewarm_browser_pools
+from ai_server.computer_use.llm_pool import close_llm_pool
+from ai_server.computer_use.task_scheduler import TaskQueueFullError, TaskScheduler
+from ai_server.computer_use.events import TaskEventBus
+from ai_server.computer_use.screencast import BrowserScreencast, Frame
+from ai_server.computer_use.task_store import TaskStore
+from ai_server.computer_use.timings import StepTimings, timing_histograms
+from ai_server.computer_use.state_backend import WORKER_ID, create_state_backend
+from ai_server.computer_use.task_views import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    cached_json_response,
+    etag_matches,
+    history_page,
+    history_steps,
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="AI Server API")
+# Time every request by route and serve the metrics in Prometheus format
+app.add_middleware(MetricsMiddleware)
+app.add_route("/metrics", metrics_endpoint, include_in_schema=False)
 
 # Store active agents to prevent garbage collection
 active_agents = {}
 # Store message queues for user-agent interaction
 message_queues = {}
-# Store task state
-task_states = {}
+# Limits how many agents run at once; the rest wait in a bounded queue
+task_scheduler = TaskScheduler()
+# Numbers task IDs; active_agents shrinks, so its length cannot be used
+task_counter = itertools.count(1)
+# Pushes task state changes and screenshots to WebSocket subscribers
+task_events = TaskEventBus()
+# Live browser streams, created when the first viewer connects
+screencasts: Dict[str, BrowserScreencast] = {}
+# Task IDs ordered by last update, most recent last
+session_index: "OrderedDict[str, None]" = OrderedDict()
+# Shown by browser-stream when there is no session
+placeholder_frame: Optional[Frame] = None
+
+# Shares task state with other workers and routes control commands to the worker running a task
+state_backend = create_state_backend()
+# Tasks whose state is about to be saved to the state backend, and whether they have finished
+pending_saves: Dict[str, bool] = {}
+
+# Task state fields that are not sent as JSON updates
+PRIVATE_STATE_FIELDS = {"browser_image"}
+
+def forget_task(task_id: str):
+    """Drop the per-task indexes of a task that has left memory."""
+    session_index.pop(task_id, None)
+    task_events.remove(task_id)
+    task_scheduler.forget(task_id)
+
+# Store task state; finished tasks are compacted and eventually archived to disk
+task_states = TaskStore(
+    compact=lambda state: {key: value for key, value in state.items() if key not in PRIVATE_STATE_FIELDS},
+    on_evict=forget_task,
+)
+
+# Task, browser, screenshot and LLM metrics are read from the components at scrape time
+REGISTRY.register_collector(lambda: agent_metric_families(task_scheduler, task_states))
+
+def finish_task(task_id: str, agent: Optional[ComputerUseAgent] = None):
+    """
+    Release a finished task's agent and let the store compact its state.
+    
+    Args:
+        task_id: The ID of the task.
+        agent: The agent that ran the task, used to keep its history.
+    """
+    active_agents.pop(task_id, None)
+    message_queues.pop(task_id, None)
+    if task_states.is_in_memory(task_id):
+        state = task_states[task_id]
+        state["history"] = agent.agent.history if agent and agent.agent else []
+        if agent:
+            state["timings"] = agent.timings.to_dict()
+        state["scheduling"] = task_scheduler.info(task_id)
+        if state["scheduling"] and state["scheduling"]["status"] == "running":
+            # Called from the task itself, just before the scheduler sees it finish
+            state["scheduling"]["status"] = "finished"
+        record_task_finished(state.get("status"))
+        schedule_save(task_id, finished=True)
+        task_states.finish(task_id)
+
+def update_task_state(task_id: str, **changes: Any):
+    """
+    Update a task's state and publish the fields that changed.
+    
+    Args:
+        task_id: The ID of the task.
+        **changes: State fields to set.
+    """
+    if not task_states.is_in_memory(task_id):
+        return
+    state = task_states[task_id]
+    delta = {key: value for key, value in changes.items() if state.get(key) != value}
+    if not delta:
+        return
+    delta["last_update"] = datetime.now().isoformat()
+    state.update(delta)
+    touch_session(task_id)
+    public = {key: value for key, value in delta.items() if key not in PRIVATE_STATE_FIELDS}
+    task_events.publish(task_id, **public)
+    schedule_save(task_id)
+
+def schedule_save(task_id: str, finished: bool = False):
+    """
+    Save a task's state to the state backend once the current burst of updates is done.
+    
+    Args:
+        task_id: The ID of the task.
+        finished: Whether the task has finished, so its state can expire.
+    """
+    if not state_backend.shared:
+        return
+    if task_id in pending_saves:
+        pending_saves[task_id] = pending_saves[task_id] or finished
+        return
+    pending_saves[task_id] = finished
+    asyncio.ensure_future(save_task_state(task_id))
+
+async def save_task_state(task_id: str):
+    """Write a task's state to the state backend so that other workers can serve it."""
+    # Let updates made in the same step land in the same write
+    await asyncio.sleep(0)
+    finished = pending_saves.pop(task_id, False)
+    if not task_states.is_in_memory(task_id):
+        return
+    state = task_states[task_id]
+    record = {key: value for key, value in state.items() if key not in PRIVATE_STATE_FIELDS}
+    record["scheduling"] = task_scheduler.info(task_id) or state.get("scheduling")
+    try:
+        await state_backend.save_task(task_id, record, owner=WORKER_ID, finished=finished)
+    except Exception as e:
+        logger.error(f"Error saving state of task {task_id}: {e}", exc_info=True)
+
+async def forward_control(task_id: str, command: str, **kwargs: Any) -> bool:
+    """
+    Send a control command to the worker running a task.
+    
+    Args:
+        task_id: The ID of the task.
+        command: "pause", "resume", "stop" or "message".
+        **kwargs: Arguments of the command.
+        
+    Returns:
+        True if another worker owns the task and the command was sent.
+    """
+    owner = await state_backend.task_owner(task_id)
+    if owner is None or owner == WORKER_ID:
+        return False
+    await state_backend.send_control(owner, {"task_id": task_id, "command": command, **kwargs})
+    return True
+
+def touch_session(task_id: str):
+    """Mark a task as the most recently updated session."""
+    session_index[task_id] = None
+    session_index.move_to_end(task_id)
+
+def set_browser_image(task_id: str, frame: Frame):
+    """Store a task's latest screenshot and mark the session as updated."""
+    if task_id in task_states:
+        task_states[task_id]["browser_image"] = frame
+        touch_session(task_id)
+
+@app.on_event("startup")
+async def startup():
+    """Launch the configured browser pools and listen for forwarded control commands."""
+    prewarm_browser_pools()
+    if state_backend.shared:
+        app.state.control_listener = asyncio.create_task(handle_control_commands())
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Close all pooled browsers, the LLM client pool and the state backend, and finish archiving tasks."""
+    if state_backend.shared:
+        app.state.control_listener.cancel()
+    await close_browser_pools()
+    await close_llm_pool()
+    await state_backend.close()
+    await task_states.flush()
+
+async def handle_control_commands():
+    """Apply control commands that other workers forwarded for tasks running here."""
+    handlers = {
+        "pause": pause_task,
+        "resume": resume_task,
+        "stop": stop_task,
+        "message": lambda task_id, message: send_message_to_agent(task_id, UserMessage(message=message)),
+    }
+    while True:
+        try:
+            async for command in state_backend.control_messages(WORKER_ID):
+                task_id = command.pop("task_id")
+                try:
+                    await handlers[command.pop("command")](task_id, **command)
+                except HTTPException as e:
+                    logger.warning(f"Control command for task {task_id} failed: {e.detail}")
+                except Exception as e:
+                    logger.error(f"Error applying control command for task {task_id}: {e}", exc_info=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error receiving control commands: {e}", exc_info=True)
+            await asyncio.sleep(1)
 
 class ComputerUseRequest(BaseModel):
     """Request model for computer use tasks."""
     task: str
     openai_api_key: str
     headless: bool = False
+    priority: int = 0
 
 class UserMessage(BaseModel):
     """Message from the user to the agent."""
@@ -46,19 +248,20 @@ class ComputerUseResponse(BaseModel):
     data: Dict[str, Any] = None
 
 @app.post("/api/computer-use", response_model=ComputerUseResponse)
-async def start_computer_use_task(request: ComputerUseRequest, background_tasks: BackgroundTasks):
+async def start_computer_use_task(request: ComputerUseRequest):
     """
-    Start a new computer use task using the specified configuration.
+    Queue a new computer use task using the specified configuration.
+    
+    The task starts as soon as the scheduler has a free slot.
     
     Args:
         request: The request containing the task and configuration.
-        background_tasks: FastAPI background tasks manager.
         
     Returns:
         A response with task status information.
     """
     try:
-        task_id = f"task_{len(active_agents) + 1}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        task_id = f"task_{next(task_counter)}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
         
         # Create agent configuration
         config = ComputerUseConfig(
@@ -76,7 +279,7 @@ async def start_computer_use_task(request: ComputerUseRequest, background_tasks:
         
         # Set initial task state
         task_states[task_id] = {
-            "status": "pending",
+            "status": "queued",
             "currentUrl": None,
             "reasoning": None,
             "paused": False,
@@ -84,53 +287,359 @@ async def start_computer_use_task(request: ComputerUseRequest, background_tasks:
             "browser_image": None,
             "last_update": datetime.now().isoformat()
         }
+        task_events.publish(
+            task_id,
+            **{key: value for key, value in task_states[task_id].items() if key not in PRIVATE_STATE_FIELDS}
+        )
+        touch_session(task_id)
         
-        # Run the agent in the background
-        background_tasks.add_task(run_agent_task, task_id, agent, request.task)
+        # Queue the agent; requests are shared fairly between API keys
+        try:
+            task_scheduler.submit(
+                task_id,
+                lambda: run_agent_task(task_id, agent, request.task),
+                owner=request.openai_api_key,
+                priority=request.priority,
+            )
+        except TaskQueueFullError:
+            active_agents.pop(task_id, None)
+            message_queues.pop(task_id, None)
+            task_states.pop(task_id, None)
+            session_index.pop(task_id, None)
+            task_events.remove(task_id)
+            raise
+        schedule_save(task_id)
         
         return ComputerUseResponse(
-            status="started",
-            message=f"Computer use task '{request.task}' started successfully",
-            task_id=task_id
+            status="queued",
+            message=f"Computer use task '{request.task}' queued successfully",
+            task_id=task_id,
+            data={"scheduling": task_scheduler.info(task_id)}
         )
+    except TaskQueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
     except Exception as e:
         logger.error(f"Error starting computer use task: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/computer-use/{task_id}", response_model=ComputerUseResponse)
-async def get_computer_use_task(task_id: str):
+# Fixed paths are registered before /api/computer-use/{task_id} so they are not
+# captured by it
+@app.get("/api/computer-use/browser-view", response_class=HTMLResponse)
+async def get_browser_view():
     """
-    Get the status of a running computer use task.
+    Display a live view of the browser.
+    
+    Returns:
+        HTML page that will show the browser.
+    """
+    html_content = """
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>Browser View</title>
+        <style>
+            body { margin: 0; padding: 0; font-family: Arial, sans-serif; }
+            #browser-container { width: 100%; height: 100vh; overflow: hidden; }
+            #browser-image { width: 100%; height: 100%; object-fit: contain; }
+            #status { position: fixed; top: 10px; left: 10px; background: rgba(0,0,0,0.7); color: white; padding: 5px 10px; border-radius: 5px; }
+        </style>
+    </head>
+    <body>
+        <div id="browser-container">
+            <img id="browser-image" src="/api/computer-use/browser-stream" alt="Browser view">
+        </div>
+        <div id="status">Connecting to browser...</div>
+        
+        <script>
+            const statusEl = document.getElementById('status');
+            const imageEl = document.getElementById('browser-image');
+            const taskId = new URLSearchParams(window.location.search).get('task_id');
+            
+            if (taskId) {
+                // Live stream of a specific task
+                imageEl.src = `/api/computer-use/${encodeURIComponent(taskId)}/stream`;
+                imageEl.onload = () => {
+                    statusEl.textContent = 'Browser view active';
+                };
+            } else {
+                // Poll the latest frame; unchanged frames come back as 304
+                let lastEtag = null;
+                setInterval(async () => {
+                    try {
+                        const response = await fetch('/api/computer-use/browser-stream', { cache: 'no-cache' });
+                        if (!response.ok) {
+                            statusEl.textContent = 'Error connecting to browser';
+                            return;
+                        }
+                        const etag = response.headers.get('ETag');
+                        if (etag && etag === lastEtag) {
+                            return;
+                        }
+                        lastEtag = etag;
+                        const previous = imageEl.src;
+                        imageEl.src = URL.createObjectURL(await response.blob());
+                        if (previous.startsWith('blob:')) {
+                            URL.revokeObjectURL(previous);
+                        }
+                        statusEl.textContent = 'Browser view active';
+                    } catch (e) {
+                        statusEl.textContent = 'Error connecting to browser';
+                    }
+                }, 1000);
+            }
+            
+            // Handle errors
+            imageEl.onerror = () => {
+                statusEl.textContent = 'Error connecting to browser';
+            };
+        </script>
+    </body>
+    </html>
+    """
+    return html_content
+
+def frame_response(frame: Frame, request: Request) -> Response:
+    """
+    Serve a frame, or 304 Not Modified if the client already has it.
     
     Args:
-        task_id: The ID of the task to query.
+        frame: The frame to serve.
+        request: The incoming request, checked for If-None-Match.
         
     Returns:
-        A response with task status information.
+        The image or an empty 304 response.
     """
-    if task_id not in active_agents:
+    headers = {"ETag": frame.etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, frame.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=frame.data, media_type=frame.media_type, headers=headers)
+
+def get_placeholder_frame() -> Optional[Frame]:
+    """Load the placeholder image once and keep it as a frame."""
+    global placeholder_frame
+    if placeholder_frame is None:
+        placeholder = os.path.join(os.path.dirname(__file__), "placeholder.png")
+        if os.path.exists(placeholder):
+            with open(placeholder, "rb") as f:
+                placeholder_frame = Frame.from_bytes(f.read(), "image/png")
+    return placeholder_frame
+
+@app.get("/api/computer-use/browser-stream")
+async def get_browser_stream(request: Request):
+    """
+    Get the latest browser screenshot of the most recently updated task.
+    
+    Args:
+        request: The incoming request.
+        
+    Returns:
+        Browser screenshot image, or 304 if it has not changed.
+    """
+    latest_task_id = next(reversed(session_index), None)
+    
+    if latest_task_id is None:
+        # Return a placeholder image
+        placeholder = get_placeholder_frame()
+        if placeholder:
+            return frame_response(placeholder, request)
+        raise HTTPException(status_code=404, detail="No active browser session")
+    
+    return await get_task_browser_stream(latest_task_id, request)
+
+@app.get("/api/computer-use/{task_id}/browser-stream")
+async def get_task_browser_stream(task_id: str, request: Request):
+    """
+    Get the latest browser screenshot of a task.
+    
+    Args:
+        task_id: The ID of the task.
+        request: The incoming request.
+        
+    Returns:
+        Browser screenshot image, or 304 if it has not changed.
+    """
+    if task_id not in task_states:
         raise HTTPException(status_code=404, detail=f"Task {task_id} not found")
     
-    agent = active_agents[task_id]
-    task_state = task_states.get(task_id, {})
+    browser_image = task_states[task_id].get("browser_image")
+    if browser_image:
+        return frame_response(browser_image, request)
+    else:
+        raise HTTPException(status_code=404, detail="No browser image available")
+
+async def load_task_state(task_id: str) -> Dict[str, Any]:
+    """
+    Get a task's state from this worker or, if another worker runs it, from the state backend.
+    
+    Args:
+        task_id: The ID of the task.
+        
+    Returns:
+        The task state.
+    """
+    task_state = await task_states.aget(task_id)
+    if task_state is None:
+        task_state = await state_backend.load_task(task_id)
+    if task_state is None:
+        raise HTTPException(status_code=404, detail=f"Task {task_id} not found")
+    return task_state
+
+def get_task_history(task_id: str, task_state: Dict[str, Any]) -> Any:
+    """Get a task's agent history; finished tasks keep it serialized in their state."""
+    agent = active_agents.get(task_id)
+    if agent:
+        return agent.agent.history if agent.agent else []
+    return task_state.get("history", [])
+
+def task_version(task_id: str, task_state: Dict[str, Any], history: Any) -> tuple:
+    """A cheap key that changes whenever the task's response changes."""
+    scheduling = task_scheduler.info(task_id) or task_state.get("scheduling") or {}
+    return (
+        task_id,
+        task_state.get("status"),
+        task_state.get("last_update"),
+        len(history_steps(history)),
+        scheduling.get("status"),
+        scheduling.get("queue_position"),
+    )
+
+def task_response(task_id: str, task_state: Dict[str, Any], history: Any = None) -> Dict[str, Any]:
+    """
+    Build the response body for a task, in the shape of ComputerUseResponse.
     
-    # Combine agent data with task state
+    Args:
+        task_id: The ID of the task.
+        task_state: The task's state.
+        history: The agent history to include, or None to leave it out.
+        
+    Returns:
+        The response body.
+    """
     data = {
-        "history": agent.agent.history if agent.agent else [],
         "currentUrl": task_state.get("currentUrl"),
         "reasoning": task_state.get("reasoning"),
         "paused": task_state.get("paused", False),
         "stopped": task_state.get("stopped", False),
-        "last_update": task_state.get("last_update")
+        "last_update": task_state.get("last_update"),
+        "vision": task_state.get("vision"),
+        "context": task_state.get("context"),
+        "scheduling": task_scheduler.info(task_id) or task_state.get("scheduling")
+    }
+    if history is not None:
+        data = {"history": history, **data}
+    return {
+        "status": task_state.get("status", "pending"),
+        "message": f"Task {task_id} information retrieved",
+        "task_id": task_id,
+        "data": data,
     }
+
+@app.get("/api/computer-use/timings")
+async def get_timings():
+    """
+    Get histograms of the step timings of every task on this worker.
+    
+    Registered before /api/computer-use/{task_id} so that it is not taken for a task ID.
+    
+    Returns:
+        Histograms of span durations by span name, and of screenshot sizes.
+    """
+    return {"histograms": timing_histograms()}
+
+@app.get("/api/computer-use/{task_id}", response_model=ComputerUseResponse)
+async def get_computer_use_task(task_id: str, request: Request):
+    """
+    Get the status of a computer use task, including its full history.
+    
+    Args:
+        task_id: The ID of the task to query.
+        request: The incoming request, checked for If-None-Match.
+        
+    Returns:
+        A response with task status information, or 304 if it has not changed.
+    """
+    task_state = await load_task_state(task_id)
+    history = get_task_history(task_id, task_state)
     
-    return ComputerUseResponse(
-        status=task_state.get("status", "pending"),
-        message=f"Task {task_id} information retrieved",
-        task_id=task_id,
-        data=data
+    return cached_json_response(
+        request,
+        ("task",) + task_version(task_id, task_state, history),
+        lambda: task_response(task_id, task_state, history),
     )
 
+@app.get("/api/computer-use/{task_id}/status", response_model=ComputerUseResponse)
+async def get_computer_use_task_status(task_id: str, request: Request):
+    """
+    Get the status of a computer use task without its history.
+    
+    Args:
+        task_id: The ID of the task to query.
+        request: The incoming request, checked for If-None-Match.
+        
+    Returns:
+        A response with task status information, or 304 if it has not changed.
+    """
+    task_state = await load_task_state(task_id)
+    history = get_task_history(task_id, task_state)
+    
+    return cached_json_response(
+        request,
+        ("status",) + task_version(task_id, task_state, history),
+        lambda: task_response(task_id, task_state),
+    )
+
+@app.get("/api/computer-use/{task_id}/history")
+async def get_computer_use_task_history(
+    task_id: str,
+    request: Request,
+    since: int = Query(0, ge=0),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+):
+    """
+    Get the history steps of a task after a cursor.
+    
+    Args:
+        task_id: The ID of the task.
+        request: The incoming request, checked for If-None-Match.
+        since: Number of steps the client already has.
+        limit: Maximum number of steps to return.
+        
+    Returns:
+        The steps and the cursor ("next") to pass as since in the next request.
+    """
+    task_state = await load_task_state(task_id)
+    history = get_task_history(task_id, task_state)
+    
+    return cached_json_response(
+        request,
+        ("history", since, limit) + task_version(task_id, task_state, history),
+        lambda: {"task_id": task_id, **history_page(history, since, limit)},
+    )
+
+@app.get("/api/computer-use/{task_id}/timings")
+async def get_computer_use_task_timings(task_id: str):
+    """
+    Get the timed spans of a task's steps: LLM calls with their token counts,
+    actions, page loads, page state capture and screenshot sizes.
+    
+    Args:
+        task_id: The ID of the task.
+        
+    Returns:
+        The spans per step, totals and histograms over the task's steps.
+        Timings are kept by the worker that ran the task.
+    """
+    task_state = await load_task_state(task_id)
+    agent = active_agents.get(task_id)
+    timings = agent.timings.to_dict() if agent else task_state.get("timings") or StepTimings().to_dict()
+    scheduling = task_scheduler.info(task_id) or task_state.get("scheduling") or {}
+    return {
+        "task_id": task_id,
+        "status": task_state.get("status"),
+        "queue_wait_seconds": scheduling.get("queue_wait_seconds"),
+        **timings,
+    }
+
 @app.post("/api/computer-use/{task_id}/message")
 async def send_message_to_agent(task_id: str, message: UserMessage):
     """
@@ -144,6 +653,10 @@ async def send_message_to_agent(task_id: str, message: UserMessage):
         A success message.
     """
     if task_id not in active_agents:
+        if await task_states.acontains(task_id):
+            raise HTTPException(status_code=400, detail=f"Task {task_id} is no longer running")
+        if await forward_control(task_id, "message", message=message.message):
+            return {"status": "success", "message": "Message sent to agent"}
         raise HTTPException(status_code=404, detail=f"Task {task_id} not found")
     
     if task_id not in message_queues:
@@ -154,6 +667,8 @@ async def send_message_to_agent(task_id: str, message: UserMessage):
     # Update task state
     if task_id in task_states:
         task_states[task_id]["last_update"] = datetime.now().isoformat()
+        task_events.publish(task_id, last_update=task_states[task_id]["last_update"])
+        touch_session(task_id)
     
     return {"status": "success", "message": "Message sent to agent"}
 
@@ -169,13 +684,15 @@ async def pause_task(task_id: str):
         A success message.
     """
     if task_id not in active_agents:
+        if await task_states.acontains(task_id):
+            raise HTTPException(status_code=400, detail=f"Task {task_id} is no longer running")
+        if await forward_control(task_id, "pause"):
+            return {"status": "success", "message": "Task paused"}
         raise HTTPException(status_code=404, detail=f"Task {task_id} not found")
     
     # Update task state
-    if task_id in task_states:
-        task_states[task_id]["paused"] = True
-        task_states[task_id]["status"] = "paused"
-        task_states[task_id]["last_update"] = datetime.now().isoformat()
+    update_task_state(task_id, paused=True, status="paused")
+    await active_agents[task_id].pause()
     
     return {"status": "success", "message": "Task paused"}
 
@@ -191,13 +708,15 @@ async def resume_task(task_id: str):
         A success message.
     """
     if task_id not in active_agents:
+        if await task_states.acontains(task_id):
+            raise HTTPException(status_code=400, detail=f"Task {task_id} is no longer running")
+        if await forward_control(task_id, "resume"):
+            return {"status": "success", "message": "Task resumed"}
         raise HTTPException(status_code=404, detail=f"Task {task_id} not found")
     
     # Update task state
-    if task_id in task_states:
-        task_states[task_id]["paused"] = False
-        task_states[task_id]["status"] = "running"
-        task_states[task_id]["last_update"] = datetime.now().isoformat()
+    update_task_state(task_id, paused=False, status="running")
+    await active_agents[task_id].resume()
     
     return {"status": "success", "message": "Task resumed"}
 
@@ -213,105 +732,104 @@ async def stop_task(task_id: str):
         A success message.
     """
     if task_id not in active_agents:
+        if await task_states.acontains(task_id):
+            raise HTTPException(status_code=400, detail=f"Task {task_id} is no longer running")
+        if await forward_control(task_id, "stop"):
+            return {"status": "success", "message": "Task stopped"}
         raise HTTPException(status_code=404, detail=f"Task {task_id} not found")
     
     # Update task state
-    if task_id in task_states:
-        task_states[task_id]["stopped"] = True
-        task_states[task_id]["status"] = "stopped"
-        task_states[task_id]["last_update"] = datetime.now().isoformat()
+    update_task_state(task_id, stopped=True, status="stopped")
+    
+    # Drop the task from the queue if it has not started yet; a running
+    # task is cancelled by the agent
+    was_queued = task_scheduler.cancel(task_id, running=False)
+    agent = active_agents[task_id]
+    await agent.stop()
     
     # Close browser
     try:
-        await active_agents[task_id].close()
+        await agent.close()
     except Exception as e:
         logger.error(f"Error closing browser for task {task_id}: {e}", exc_info=True)
     
+    if was_queued:
+        finish_task(task_id)
+    
     return {"status": "success", "message": "Task stopped"}
 
-@app.get("/api/computer-use/browser-view", response_class=HTMLResponse)
-async def get_browser_view():
+def get_screencast(task_id: str) -> BrowserScreencast:
     """
-    Display a live view of the browser.
+    Get the live stream for a task, creating it if needed.
     
+    Args:
+        task_id: The ID of the task.
+        
     Returns:
-        HTML page that will show the browser.
+        The task's screencast.
     """
-    html_content = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Browser View</title>
-        <style>
-            body { margin: 0; padding: 0; font-family: Arial, sans-serif; }
-            #browser-container { width: 100%; height: 100vh; overflow: hidden; }
-            #browser-image { width: 100%; height: 100%; object-fit: contain; }
-            #status { position: fixed; top: 10px; left: 10px; background: rgba(0,0,0,0.7); color: white; padding: 5px 10px; border-radius: 5px; }
-        </style>
-    </head>
-    <body>
-        <div id="browser-container">
-            <img id="browser-image" src="/api/computer-use/browser-stream" alt="Browser view">
-        </div>
-        <div id="status">Connecting to browser...</div>
+    if task_id not in active_agents:
+        raise HTTPException(status_code=404, detail=f"Task {task_id} not found")
+    if task_id not in screencasts:
+        screencasts[task_id] = BrowserScreencast(
+            active_agents[task_id].get_current_page,
+            on_frame=lambda frame: set_browser_image(task_id, frame),
+        )
+    return screencasts[task_id]
+
+@app.get("/api/computer-use/{task_id}/stream")
+async def stream_browser(task_id: str):
+    """
+    Stream the task's browser as multipart MJPEG (or WebP).
+    
+    The response can be used directly as the src of an <img>. Frames are
+    only captured while at least one viewer is connected.
+    
+    Args:
+        task_id: The ID of the task.
         
-        <script>
-            const statusEl = document.getElementById('status');
-            const imageEl = document.getElementById('browser-image');
-            
-            // Reload image periodically to get updates
-            setInterval(() => {
-                imageEl.src = `/api/computer-use/browser-stream?t=${new Date().getTime()}`;
-                statusEl.textContent = 'Browser view active';
-            }, 1000);
-            
-            // Handle errors
-            imageEl.onerror = () => {
-                statusEl.textContent = 'Error connecting to browser';
-            };
-        </script>
-    </body>
-    </html>
+    Returns:
+        A multipart/x-mixed-replace stream of images.
     """
-    return html_content
+    screencast = get_screencast(task_id)
+    subscription = screencast.subscribe()
+    
+    async def frames():
+        try:
+            async for frame in subscription:
+                header = f"--frame\r\nContent-Type: {screencast.media_type}\r\nContent-Length: {len(frame)}\r\n\r\n"
+                yield header.encode() + frame + b"\r\n"
+        finally:
+            subscription.close()
+    
+    return StreamingResponse(frames(), media_type="multipart/x-mixed-replace; boundary=frame")
 
-@app.get("/api/computer-use/browser-stream")
-async def get_browser_stream():
+@app.websocket("/api/computer-use/{task_id}/stream/ws")
+async def stream_browser_ws(websocket: WebSocket, task_id: str):
     """
-    Stream the browser screenshot.
+    Stream the task's browser as binary WebSocket frames.
     
-    Returns:
-        Browser screenshot image.
-    """
-    # Find the most recently updated task
-    latest_task_id = None
-    latest_time = None
-    
-    for task_id, state in task_states.items():
-        if "last_update" in state:
-            try:
-                update_time = datetime.fromisoformat(state["last_update"])
-                if latest_time is None or update_time > latest_time:
-                    latest_time = update_time
-                    latest_task_id = task_id
-            except (ValueError, TypeError):
-                pass
-    
-    if not latest_task_id or latest_task_id not in task_states:
-        # Return a placeholder image
-        placeholder = os.path.join(os.path.dirname(__file__), "placeholder.png")
-        if os.path.exists(placeholder):
-            with open(placeholder, "rb") as f:
-                return StreamingResponse(f, media_type="image/png")
-        else:
-            raise HTTPException(status_code=404, detail="No active browser session")
+    Args:
+        websocket: The WebSocket connection.
+        task_id: The ID of the task.
+    """
+    if task_id not in active_agents:
+        await websocket.close(code=4004, reason=f"Task {task_id} not found")
+        return
     
-    # If there's a browser image, return it
-    browser_image = task_states[latest_task_id].get("browser_image")
-    if browser_image:
-        return StreamingResponse(browser_image, media_type="image/png")
-    else:
-        raise HTTPException(status_code=404, detail="No browser image available")
+    await websocket.accept()
+    subscription = get_screencast(task_id).subscribe()
+    
+    try:
+        async for frame in subscription:
+            await websocket.send_bytes(frame)
+        await websocket.close()
+    except WebSocketDisconnect:
+        logger.info(f"Browser stream for task {task_id} disconnected")
+    except Exception as e:
+        logger.error(f"Browser stream error for task {task_id}: {e}", exc_info=True)
+    finally:
+        subscription.close()
 
 @app.websocket("/api/computer-use/{task_id}/ws")
 async def websocket_endpoint(websocket: WebSocket, task_id: str):
@@ -328,16 +846,51 @@ async def websocket_endpoint(websocket: WebSocket, task_id: str):
     
     await websocket.accept()
     
+    # The first message is a full snapshot; after that only changed fields
+    # are sent, each with a sequence number. A client that sees a gap in the
+    # sequence can send {"type": "resync"} to get a new snapshot. Screenshots
+    # are sent as binary frames.
+    subscription = task_events.subscribe(task_id)
+    receiver = asyncio.ensure_future(receive_client_messages(websocket, subscription))
+    
     try:
-        while True:
-            if task_id in task_states:
-                await websocket.send_json(task_states[task_id])
-            await asyncio.sleep(1)
+        while not receiver.done():
+            next_event = asyncio.ensure_future(subscription.next())
+            await asyncio.wait({next_event, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if not next_event.done():
+                next_event.cancel()
+                break
+            event = next_event.result()
+            if event.type == "frame":
+                await websocket.send_bytes(event.data)
+            else:
+                await websocket.send_json(event.to_json())
     except WebSocketDisconnect:
         logger.info(f"WebSocket for task {task_id} disconnected")
     except Exception as e:
         logger.error(f"WebSocket error for task {task_id}: {e}", exc_info=True)
         await websocket.close(code=1011, reason=str(e))
+    finally:
+        receiver.cancel()
+        subscription.close()
+
+async def receive_client_messages(websocket: WebSocket, subscription):
+    """
+    Handle messages sent by a WebSocket client until it disconnects.
+    
+    Args:
+        websocket: The WebSocket connection.
+        subscription: The client's event subscription.
+    """
+    try:
+        while True:
+            message = await websocket.receive_json()
+            if isinstance(message, dict) and message.get("type") == "resync":
+                subscription.resync()
+    except WebSocketDisconnect:
+        logger.info(f"WebSocket for task {subscription.topic.task_id} disconnected")
+    except Exception as e:
+        logger.debug(f"Stopped reading WebSocket for task {subscription.topic.task_id}: {e}")
 
 async def run_agent_task(task_id: str, agent: ComputerUseAgent, task: str):
     """
@@ -349,51 +902,36 @@ async def run_agent_task(task_id: str, agent: ComputerUseAgent, task: str):
         task: The task description.
     """
     # Update task state
-    if task_id in task_states:
-        task_states[task_id]["status"] = "running"
-        task_states[task_id]["last_update"] = datetime.now().isoformat()
+    update_task_state(task_id, status="running")
+    
+    # Publish every agent step as it happens
+    def on_step(step: Dict[str, Any]):
+        update_task_state(
+            task_id,
+            step=step["step"],
+            currentUrl=step.get("url"),
+            reasoning=step.get("reasoning"),
+            actions=step.get("actions"),
+            vision=step.get("vision"),
+            context=step.get("context"),
+        )
+        if step.get("screenshot"):
+            set_browser_image(task_id, Frame.from_bytes(step["screenshot"], "image/png"))
+            task_events.publish_frame(task_id, step["screenshot"])
+    
+    agent.add_step_listener(on_step)
+    
+    # Deliver user messages as they arrive
+    message_task = asyncio.ensure_future(process_user_messages(task_id, agent))
     
     try:
-        # Start the task
-        result_future = asyncio.ensure_future(agent.run(task))
-        
-        # Set up periodic browser screenshot capture
-        screenshot_task = asyncio.ensure_future(capture_browser_screenshots(task_id, agent))
-        
-        # Monitor for user messages and task state changes
-        message_task = asyncio.ensure_future(process_user_messages(task_id, agent))
-        
-        # Wait for the task to complete or be stopped
-        while not result_future.done():
-            if task_id in task_states and task_states[task_id].get("stopped", False):
-                result_future.cancel()
-                break
-            
-            if task_id in task_states and task_states[task_id].get("paused", False):
-                # We're paused, just wait
-                await asyncio.sleep(1)
-                continue
-            
-            # If the agent's state has reasoning, save it
-            if agent.agent and hasattr(agent.agent, "chain") and hasattr(agent.agent.chain, "last_log"):
-                if task_id in task_states:
-                    task_states[task_id]["reasoning"] = agent.agent.chain.last_log
-            
-            # If the browser has a URL, save it
-            if agent.browser and hasattr(agent.browser, "current_url"):
-                if task_id in task_states:
-                    task_states[task_id]["currentUrl"] = agent.browser.current_url
-            
-            await asyncio.sleep(0.5)
-        
-        # Clean up the monitoring tasks
-        screenshot_task.cancel()
-        message_task.cancel()
+        # Nothing here wakes up while the agent runs or is paused; stop_task
+        # ends the run by cancelling it
+        await agent.run(task)
         
         # Update task state
-        if task_id in task_states:
-            task_states[task_id]["status"] = "completed"
-            task_states[task_id]["last_update"] = datetime.now().isoformat()
+        if not agent.stopped:
+            update_task_state(task_id, status="completed")
         
         # Final cleanup
         try:
@@ -402,92 +940,43 @@ async def run_agent_task(task_id: str, agent: ComputerUseAgent, task: str):
             logger.error(f"Error closing agent for task {task_id}: {e}", exc_info=True)
     except asyncio.CancelledError:
         logger.info(f"Task {task_id} was cancelled")
-        if task_id in task_states:
-            task_states[task_id]["status"] = "cancelled"
-            task_states[task_id]["last_update"] = datetime.now().isoformat()
+        update_task_state(task_id, status="cancelled")
     except Exception as e:
         logger.error(f"Error in agent task {task_id}: {e}", exc_info=True)
-        if task_id in task_states:
-            task_states[task_id]["status"] = "error"
-            task_states[task_id]["error"] = str(e)
-            task_states[task_id]["last_update"] = datetime.now().isoformat()
+        update_task_state(task_id, status="error", error=str(e))
     finally:
+        message_task.cancel()
+        # End any live streams; viewers see the stream close
+        screencast = screencasts.pop(task_id, None)
+        if screencast:
+            screencast.close()
+        finish_task(task_id, agent)
         logger.info(f"Task {task_id} finished")
 
-async def capture_browser_screenshots(task_id: str, agent: ComputerUseAgent):
-    """
-    Periodically capture screenshots from the browser and save them to the task state.
-    
-    Args:
-        task_id: The ID of the task.
-        agent: The agent running the task.
-    """
-    try:
-        while True:
-            if task_id not in task_states or task_states[task_id].get("stopped", False):
-                break
-            
-            # Capture screenshot from browser if available
-            if agent.browser and agent.browser.page:
-                try:
-                    # This is a placeholder - the actual implementation depends on
-                    # how screenshots are handled in the browser-use library
-                    screenshot = await agent.browser.page.screenshot()
-                    if task_id in task_states:
-                        # Save as BytesIO for streaming
-                        from io import BytesIO
-                        task_states[task_id]["browser_image"] = BytesIO(screenshot)
-                except Exception as e:
-                    logger.error(f"Error capturing screenshot for task {task_id}: {e}", exc_info=True)
-            
-            await asyncio.sleep(1)  # Capture every second
-    except asyncio.CancelledError:
-        logger.debug(f"Screenshot capture for task {task_id} cancelled")
-    except Exception as e:
-        logger.error(f"Error in screenshot capture for task {task_id}: {e}", exc_info=True)
-
 async def process_user_messages(task_id: str, agent: ComputerUseAgent):
     """
-    Process messages from the user to the agent.
+    Pass messages from the user to the agent until the task ends.
     
     Args:
         task_id: The ID of the task.
         agent: The agent running the task.
     """
-    if task_id not in message_queues:
-        message_queues[task_id] = asyncio.Queue()
-    
-    queue = message_queues[task_id]
+    queue = message_queues.setdefault(task_id, asyncio.Queue())
     
     try:
         while True:
-            if task_id not in task_states or task_states[task_id].get("stopped", False):
-                break
+            message = await queue.get()
             
-            # Check if there are any messages in the queue
-            try:
-                message = await asyncio.wait_for(queue.get(), timeout=0.5)
-                
-                # Update reasoning with user message
-                if task_id in task_states:
-                    task_states[task_id]["reasoning"] = f"User message: {message}\n\n{task_states[task_id].get('reasoning', '')}"
-                
-                # Send message to agent
-                # This is a placeholder - the actual implementation depends on
-                # how messages are handled in the browser-use library
-                if agent.agent:
-                    # Add to agent's context or processing queue
-                    logger.info(f"Received message for task {task_id}: {message}")
-                    
-                    # In a real implementation, you would call agent.send_message(message)
-                    # or similar functionality available in your agent class
-                    
-                queue.task_done()
-            except asyncio.TimeoutError:
-                # No messages in the queue
-                pass
+            # Update reasoning with user message
+            if task_states.is_in_memory(task_id):
+                update_task_state(
+                    task_id,
+                    reasoning=f"User message: {message}\n\n{task_states[task_id].get('reasoning') or ''}"
+                )
             
-            await asyncio.sleep(0.1)  # Small delay to prevent CPU spinning
+            logger.info(f"Received message for task {task_id}: {message}")
+            await agent.add_user_message(message)
+            queue.task_done()
     except asyncio.CancelledError:
         logger.debug(f"Message processing for task {task_id} cancelled")
     except Exception as e:
@@ -0,0 +1,325 @@
+"""
+Benchmark för server.py
+
+Mäter latens, genomströmning och time-to-first-token för /api/generate/stream
+och latens och genomströmning för /api/generate. Som standard skapas en liten lokal modell (samma arkitektur som
+deepseek-coder, men med slumpade vikter) så att inget behöver laddas ner,
+och FastAPI-appen körs med uvicorn i en tråd i samma process.
+
+Exempel:
+    python benchmark.py --concurrency 1,4,16 --prompt-tokens 32,256 --max-tokens 32
+    python benchmark.py --url http://localhost:8080 --api-key din-api-nyckel-här
+    python benchmark.py --output resultat.json --baseline förra.json --max-regression 0.1
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import sys
+import socket
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+BENCHMARK_API_KEY = "benchmark"
+
+
+def create_tiny_model(directory: str) -> str:
+    """Skapa en liten Llama-modell med en tokenizer på teckennivå, helt offline."""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    vocab = {"<unk>": 0, "<s>": 1, "</s>": 2}
+    for code in range(32, 127):
+        vocab[chr(code)] = len(vocab)
+    vocab["\n"] = len(vocab)
+
+    backend = Tokenizer(models.WordLevel(vocab=vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    backend.decoder = decoders.Fuse()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, bos_token="<s>", eos_token="</s>", unk_token="<unk>")
+
+    config = LlamaConfig(
+        vocab_size=len(vocab),
+        hidden_size=256,
+        intermediate_size=688,
+        num_hidden_layers=4,
+        num_attention_heads=8,
+        num_key_value_heads=8,
+        max_position_embeddings=4096,
+        bos_token_id=1,
+        # Slutet av sekvens används aldrig så att varje förfrågan genererar max_tokens
+        eos_token_id=None,
+    )
+    LlamaForCausalLM(config).save_pretrained(directory)
+    tokenizer.save_pretrained(directory)
+    return directory
+
+
+def start_in_process_server(app) -> str:
+    """
+    Starta appen med uvicorn på en ledig port på localhost.
+
+    httpx.ASGITransport buffrar hela svaret, så strömningen (och därmed TTFT)
+    går bara att mäta över en riktig anslutning.
+    """
+    import uvicorn
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+def make_prompt(tokens: int, index: int) -> str:
+    """Skapa en prompt på ungefär tokens tokens (ett tecken per token för testmodellen)."""
+    text = "".join(f"def function_{index}_{i}(x):\n    return x + {i}\n" for i in range(tokens // 20 + 1))
+    return text[:tokens]
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    if len(values) == 1:
+        return {"p50": values[0], "p95": values[0], "p99": values[0]}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+
+def peak_rss_mb() -> float:
+    """Högsta RSS för den här processen (inklusive modellen när den körs i samma process)."""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss är i kilobyte på Linux men i byte på macOS
+    return usage / (1024 * 1024) if sys.platform == "darwin" else usage / 1024
+
+
+async def stream_request(client: httpx.AsyncClient, prompt: str, max_tokens: int, api_key: str) -> Dict[str, Any]:
+    """Skicka en förfrågan till strömningsendpointen och mät TTFT och total latens."""
+    body = {"prompt": prompt, "max_tokens": max_tokens, "temperature": 0.7, "top_p": 0.95}
+    headers = {"Authorization": f"Bearer {api_key}"}
+    start = time.perf_counter()
+    first_token = None
+    chunks = []
+    async with client.stream("POST", "/api/generate/stream", json=body, headers=headers) as response:
+        if response.status_code != 200:
+            await response.aread()
+            return {"error": f"HTTP {response.status_code}: {response.text}"}
+        async for line in response.aiter_lines():
+            if line.startswith("event: error"):
+                return {"error": line}
+            if not line.startswith("data: ") or line == "data: [DONE]":
+                continue
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            chunks.append(json.loads(line[len("data: "):])["text"])
+    return {"latency": time.perf_counter() - start, "ttft": first_token, "text": "".join(chunks), "chunks": len(chunks)}
+
+
+async def generate_request(client: httpx.AsyncClient, prompt: str, max_tokens: int, api_key: str) -> Dict[str, Any]:
+    """Skicka en förfrågan till /api/generate och mät latensen till hela svaret."""
+    body = {"prompt": prompt, "max_tokens": max_tokens, "temperature": 0.7, "top_p": 0.95}
+    headers = {"Authorization": f"Bearer {api_key}"}
+    start = time.perf_counter()
+    response = await client.post("/api/generate", json=body, headers=headers)
+    latency = time.perf_counter() - start
+    if response.status_code != 200:
+        return {"error": f"HTTP {response.status_code}: {response.text}"}
+    # Utan strömning finns inga textbitar att räkna
+    return {"latency": latency, "ttft": None, "text": response.json()["response"], "chunks": None}
+
+
+async def run_requests(send, concurrency: int, requests: int):
+    """Kör send(index) för requests förfrågningar med concurrency samtidiga klienter."""
+    results: List[Dict[str, Any]] = []
+    pending = iter(range(requests))
+
+    async def worker():
+        for index in pending:
+            results.append(await send(index))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results, time.perf_counter() - start
+
+
+def count_total_tokens(count_tokens, results: List[Dict[str, Any]]) -> Optional[int]:
+    """Antal genererade tokens, eller None om de inte går att räkna (utan tokenizer och strömning)."""
+    counts = [count_tokens(r) for r in results]
+    return None if any(count is None for count in counts) else sum(counts)
+
+
+async def run_config(
+    client: httpx.AsyncClient,
+    count_tokens,
+    concurrency: int,
+    prompt_tokens: int,
+    max_tokens: int,
+    requests: int,
+    api_key: str,
+) -> Dict[str, Any]:
+    """Kör requests förfrågningar med concurrency samtidiga klienter, först strömmande och sedan utan strömning."""
+    results, wall_time = await run_requests(
+        lambda index: stream_request(client, make_prompt(prompt_tokens, index), max_tokens, api_key), concurrency, requests
+    )
+    generated, generate_wall_time = await run_requests(
+        lambda index: generate_request(client, make_prompt(prompt_tokens, index), max_tokens, api_key), concurrency, requests
+    )
+
+    ok = [r for r in results if "error" not in r]
+    tokens = count_total_tokens(count_tokens, ok)
+    generate_ok = [r for r in generated if "error" not in r]
+    generate_tokens = count_total_tokens(count_tokens, generate_ok)
+    return {
+        "concurrency": concurrency,
+        "prompt_tokens": prompt_tokens,
+        "max_tokens": max_tokens,
+        "requests": requests,
+        "errors": len(results) - len(ok),
+        "wall_time_s": wall_time,
+        "requests_per_s": len(ok) / wall_time if wall_time else None,
+        "tokens_per_s": tokens / wall_time if tokens is not None and wall_time else None,
+        "latency_s": percentiles(sorted(r["latency"] for r in ok)),
+        "ttft_s": percentiles(sorted(r["ttft"] for r in ok if r["ttft"] is not None)),
+        # /api/generate: hela svaret på en gång, så latensen är tiden till sista token
+        "generate_errors": len(generated) - len(generate_ok),
+        "generate_requests_per_s": len(generate_ok) / generate_wall_time if generate_wall_time else None,
+        "generate_tokens_per_s": generate_tokens / generate_wall_time if generate_tokens is not None and generate_wall_time else None,
+        "generate_latency_s": percentiles(sorted(r["latency"] for r in generate_ok)),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def compare_with_baseline(results: List[Dict[str, Any]], baseline_path: str, tolerance: float) -> List[str]:
+    """Jämför med ett tidigare resultat och returnera en lista med regressioner."""
+    with open(baseline_path) as f:
+        baseline = {
+            (r["concurrency"], r["prompt_tokens"], r["max_tokens"]): r for r in json.load(f)["results"]
+        }
+
+    regressions = []
+    for result in results:
+        key = (result["concurrency"], result["prompt_tokens"], result["max_tokens"])
+        previous = baseline.get(key)
+        if not previous:
+            continue
+        for metric in ("latency_s", "ttft_s", "generate_latency_s"):
+            if metric not in previous:
+                # Baseline från en äldre version av benchmarken
+                continue
+            old, new = previous[metric]["p95"], result[metric]["p95"]
+            if old and new and new > old * (1 + tolerance):
+                regressions.append(f"{key}: {metric} p95 {old:.4f}s -> {new:.4f}s")
+        old, new = previous["tokens_per_s"], result["tokens_per_s"]
+        if old and new and new < old * (1 - tolerance):
+            regressions.append(f"{key}: tokens_per_s {old:.1f} -> {new:.1f}")
+    return regressions
+
+
+async def wait_until_ready(client: httpx.AsyncClient, timeout: float = 600.0):
+    """Vänta tills /health svarar 200, dvs. tills modellen är laddad."""
+    deadline = time.monotonic() + timeout
+    while True:
+        health = await client.get("/health")
+        if health.status_code == 200:
+            return
+        status = health.json()
+        if status["status"] == "failed":
+            raise RuntimeError(f"Modellen kunde inte laddas: {status['error']}")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Modellen laddades inte inom {timeout:.0f} s")
+        await asyncio.sleep(0.2)
+
+
+def parse_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",") if item]
+
+
+async def main_async(args) -> Dict[str, Any]:
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=None)
+        api_key = args.api_key
+        # Utan tokenizer räknas varje strömmad textbit som en token; svar utan strömning räknas inte
+        count_tokens = lambda result: result["chunks"]
+        target = args.url
+    else:
+        model_dir = args.model or create_tiny_model(tempfile.mkdtemp(prefix="benchmark-model-"))
+        os.environ.setdefault("BASE_MODEL_PATH", model_dir)
+        os.environ.setdefault("LORA_PATH", os.path.join(model_dir, "no-adapter"))
+        os.environ["API_KEY"] = api_key = BENCHMARK_API_KEY
+        os.environ["RESPONSE_CACHE"] = ""
+        # Benchmark av varje förfrågan; kön får inte avvisa någon
+        os.environ.setdefault("MAX_QUEUE_SIZE", "0")
+
+        import server
+
+        # Serverns startup-hook laddar modellen i bakgrunden, så den laddas inte här
+        client = httpx.AsyncClient(base_url=start_in_process_server(server.app), timeout=None)
+        count_tokens = lambda result: len(server.tokenizer.encode(result["text"], add_special_tokens=False))
+        target = os.environ["BASE_MODEL_PATH"]
+
+    results = []
+    async with client:
+        await wait_until_ready(client)
+        # Uppvärmning så att första konfigurationen inte får med laddningskostnader
+        await stream_request(client, make_prompt(16, 0), 4, api_key)
+        await generate_request(client, make_prompt(16, 0), 4, api_key)
+        for concurrency in parse_list(args.concurrency):
+            for prompt_tokens in parse_list(args.prompt_tokens):
+                for max_tokens in parse_list(args.max_tokens):
+                    result = await run_config(
+                        client, count_tokens, concurrency, prompt_tokens, max_tokens, args.requests or concurrency * 4, api_key
+                    )
+                    print(
+                        f"concurrency={concurrency} prompt_tokens={prompt_tokens} max_tokens={max_tokens}: "
+                        f"p50={result['latency_s']['p50']:.3f}s ttft_p50={result['ttft_s']['p50']:.3f}s "
+                        f"{result['tokens_per_s'] or 0:.1f} tokens/s, "
+                        f"/api/generate p50={result['generate_latency_s']['p50']:.3f}s",
+                        file=sys.stderr,
+                    )
+                    results.append(result)
+
+    return {"target": target, "in_process": not args.url, "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark för /api/generate i server.py")
+    parser.add_argument("--url", help="Kör mot en server som redan är igång i stället för i samma process")
+    parser.add_argument("--api-key", default=os.environ.get("API_KEY", ""), help="API-nyckel när --url används")
+    parser.add_argument("--model", help="Lokal modell att använda i stället för den genererade testmodellen")
+    parser.add_argument("--concurrency", default="1,4,16", help="Kommaseparerade antal samtidiga klienter")
+    parser.add_argument("--prompt-tokens", default="32,256", help="Kommaseparerade promptlängder i tokens")
+    parser.add_argument("--max-tokens", default="16,64", help="Kommaseparerade värden för max_tokens")
+    parser.add_argument("--requests", type=int, default=0, help="Förfrågningar per konfiguration (standard 4 x concurrency)")
+    parser.add_argument("--output", help="Skriv resultatet som JSON till en fil i stället för stdout")
+    parser.add_argument("--baseline", help="Tidigare resultat att jämföra med")
+    parser.add_argument("--max-regression", type=float, default=0.1, help="Tillåten försämring mot baseline (andel)")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        regressions = compare_with_baseline(report["results"], args.baseline, args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,24 @@ This package provides functionality for controlling a web browser using AI
 to perform tasks specified by the user.
 """
 
+from .browser_pool import BrowserLease, BrowserPool, close_browser_pools, get_browser_pool, prewarm_browser_pools
 from .config import ComputerUseConfig
+from .context import ContextCompactor
+from .llm_pool import LLMClientPool, close_llm_pool, get_llm_pool
 from .service import ComputerUseAgent
+from .vision import VisionOptimizer
 
-__all__ = ["ComputerUseConfig", "ComputerUseAgent"] 
\ No newline at end of file
+__all__ = [
+    "BrowserLease",
+    "BrowserPool",
+    "ComputerUseConfig",
+    "ComputerUseAgent",
+    "ContextCompactor",
+    "LLMClientPool",
+    "VisionOptimizer",
+    "close_browser_pools",
+    "close_llm_pool",
+    "get_browser_pool",
+    "get_llm_pool",
+    "prewarm_browser_pools",
+] 
\ No newline at end of file
@@ -0,0 +1,157 @@
+"""
+Agent Metrics
+
+This module turns the counters that the computer use components already
+keep (the task scheduler and store, browser pools, the LLM pool, step
+timings and screencasts) into metric families for the /metrics endpoint of
+main.py and api.py. Everything is read at scrape time, so the agents' hot
+paths are not touched. Families are plain (name, type, help, samples)
+tuples, the shape of metrics.MetricFamily.
+"""
+
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from .browser_pool import browser_pool_stats
+from .llm_pool import llm_pool_stats
+from .screencast import screencast_stats
+from .timings import span_error_counts, timing_histograms
+
+Family = Tuple[str, str, str, List[Tuple[str, Dict[str, str], float]]]
+
+# Finished tasks by final status
+_finished: Dict[str, int] = {}
+
+
+def record_task_finished(status: Optional[str]):
+    """Count a task that has finished, by its final status."""
+    status = status or "unknown"
+    _finished[status] = _finished.get(status, 0) + 1
+
+
+def browser_memory_bytes() -> Optional[int]:
+    """
+    Resident memory of the browsers, i.e. of every descendant process.
+
+    Reads /proc, so it is only available on Linux.
+    """
+    try:
+        pids = [int(name) for name in os.listdir("/proc") if name.isdigit()]
+    except OSError:
+        return None
+    children: Dict[int, List[int]] = {}
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # The command name may contain spaces, so fields are counted after it
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(parent, []).append(pid)
+
+    total, pending = 0, list(children.get(os.getpid(), []))
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    while pending:
+        pid = pending.pop()
+        pending.extend(children.get(pid, []))
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                total += int(f.read().split()[1]) * page_size
+        except (OSError, ValueError, IndexError):
+            continue
+    return total
+
+
+def _histogram(name: str, documentation: str, histograms: List[Tuple[Dict[str, str], Dict[str, Any]]]) -> Family:
+    """A histogram family from timings.Histogram.to_dict() results."""
+    samples = []
+    for labels, histogram in histograms:
+        for bound, cumulative in histogram["buckets"]:
+            samples.append(("_bucket", {**labels, "le": str(bound)}, cumulative))
+        samples.append(("_sum", labels, histogram["sum"]))
+        samples.append(("_count", labels, histogram["count"]))
+    return (name, "histogram", documentation, samples)
+
+
+def agent_metric_families(scheduler: Any, task_store: Any = None) -> List[Family]:
+    """
+    Metric families for the computer use tasks of this process.
+
+    Args:
+        scheduler: The app's TaskScheduler.
+        task_store: The app's TaskStore, if it has one.
+
+    Returns:
+        The metric families.
+    """
+    scheduling = scheduler.stats()
+    families: List[Family] = [
+        ("computer_use_tasks", "gauge", "Tasks by scheduling state", [
+            ("", {"state": "running"}, scheduling["running"]),
+            ("", {"state": "queued"}, scheduling["queued"]),
+        ]),
+        ("computer_use_task_slots", "gauge", "Tasks that may run at the same time", [("", {}, scheduling["max_concurrent"])]),
+        ("computer_use_tasks_finished_total", "counter", "Finished tasks by final status", [
+            ("", {"status": status}, count) for status, count in _finished.items()
+        ]),
+    ]
+    if task_store is not None:
+        store = task_store.stats()
+        families.append(("computer_use_task_store_tasks", "gauge", "Tasks kept in memory and in the archive", [
+            ("", {"location": "memory"}, store["in_memory"]),
+            ("", {"location": "archive"}, store["archived"] or 0),
+        ]))
+
+    # Browsers
+    pools = browser_pool_stats()
+    browsers, launches, recycled = [], [], []
+    for pool in pools:
+        mode = "headless" if pool["headless"] else "headed"
+        browsers.append(("", {"mode": mode, "state": "idle"}, pool["idle"]))
+        browsers.append(("", {"mode": mode, "state": "leased"}, pool["leased"]))
+        launches.append(("", {"mode": mode}, pool["launches"]))
+        recycled.append(("", {"mode": mode}, pool["recycled"]))
+    families.append(("computer_use_browsers", "gauge", "Pooled browsers by mode and state", browsers))
+    families.append(("computer_use_browser_launches_total", "counter", "Browsers launched by the pools", launches))
+    families.append(("computer_use_browser_recycles_total", "counter", "Browsers recycled by the pools", recycled))
+    memory = browser_memory_bytes()
+    if memory is not None:
+        families.append(("computer_use_browser_memory_bytes", "gauge", "Resident memory of the browser processes", [("", {}, memory)]))
+
+    # Screenshots
+    histograms = timing_histograms()
+    screenshots = histograms.get("screenshot_bytes") or {"count": 0, "sum": 0}
+    screencast = screencast_stats()
+    families.append(("computer_use_screenshots_total", "counter", "Screenshots captured, by source", [
+        ("", {"source": "agent"}, screenshots["count"]),
+        ("", {"source": "screencast"}, screencast["frames_captured"]),
+    ]))
+    families.append(("computer_use_screenshot_bytes_total", "counter", "Bytes of captured screenshots, by source", [
+        ("", {"source": "agent"}, screenshots["sum"]),
+        ("", {"source": "screencast"}, screencast["bytes_captured"]),
+    ]))
+
+    # LLM calls and the other step spans
+    if "llm" in histograms:
+        families.append(_histogram("computer_use_llm_call_duration_seconds", "Duration of LLM calls", [({}, histograms["llm"])]))
+    families.append(("computer_use_llm_call_errors_total", "counter", "LLM calls that failed", [
+        ("", {}, span_error_counts().get("llm", 0)),
+    ]))
+    spans = [({"span": name}, histogram) for name, histogram in histograms.items() if name not in ("llm", "screenshot_bytes")]
+    if spans:
+        families.append(_histogram("computer_use_step_span_duration_seconds", "Duration of agent step spans, by span", spans))
+
+    keys = llm_pool_stats()["keys"]
+    for name, field, documentation in (
+        ("computer_use_llm_requests_total", "requests", "HTTP requests to LLM providers, by API key"),
+        ("computer_use_llm_errors_total", "errors", "HTTP requests to LLM providers that failed, by API key"),
+        ("computer_use_llm_rate_limited_total", "rate_limited", "HTTP requests answered with 429, by API key"),
+        ("computer_use_llm_retries_total", "retries", "HTTP requests retried after a 429, by API key"),
+    ):
+        families.append((name, "counter", documentation, [
+            ("", {"provider": key["provider"], "key": key["key"]}, key[field]) for key in keys
+        ]))
+    families.append(("computer_use_llm_requests_in_flight", "gauge", "HTTP requests to LLM providers in flight, by API key", [
+        ("", {"provider": key["provider"], "key": key["key"]}, key["in_flight"]) for key in keys
+    ]))
+    return families
@@ -0,0 +1,303 @@
+"""
+Browser Pool
+
+This module keeps a pool of pre-launched browsers so that computer use tasks
+do not pay the full Chromium launch cost. Each task leases a browser together
+with a fresh browser context, which isolates cookies and storage between
+tasks; closing the context on release clears them again.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from browser_use import Browser, BrowserConfig
+
+logger = logging.getLogger(__name__)
+
+# Pool defaults, overridable through the environment
+POOL_SIZE = int(os.environ.get("BROWSER_POOL_SIZE", "2"))
+POOL_MAX_USES = int(os.environ.get("BROWSER_POOL_MAX_USES", "20"))
+POOL_HEALTH_CHECK_INTERVAL = float(os.environ.get("BROWSER_POOL_HEALTH_CHECK_INTERVAL", "30"))
+# Browser modes to launch at startup, e.g. "headless,headed"
+POOL_PREWARM = os.environ.get("BROWSER_POOL_PREWARM", "")
+
+
+@dataclass
+class PooledBrowser:
+    """A browser owned by the pool together with its usage counters."""
+
+    browser: Browser
+    uses: int = 0
+    created_at: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class BrowserLease:
+    """A browser and an isolated context handed out to a single task."""
+
+    pooled: PooledBrowser
+    context: Any
+    pool: "BrowserPool"
+    released: bool = False
+
+    @property
+    def browser(self) -> Browser:
+        return self.pooled.browser
+
+    async def release(self):
+        """Return the browser to the pool. Safe to call more than once."""
+        if not self.released:
+            self.released = True
+            await self.pool.release(self)
+
+
+class BrowserPool:
+    """
+    Pool of warm browsers for one browser mode (headless or headed).
+
+    At most ``size`` browsers are alive at any time. A browser is recycled
+    after ``max_uses`` leases or when it fails a health check, and a
+    replacement is launched in the background so the pool stays warm.
+    """
+
+    def __init__(
+        self,
+        headless: bool = False,
+        viewport_width: int = 1280,
+        viewport_height: int = 800,
+        size: int = POOL_SIZE,
+        max_uses: int = POOL_MAX_USES,
+        health_check_interval: float = POOL_HEALTH_CHECK_INTERVAL,
+    ):
+        self.headless = headless
+        self.viewport_width = viewport_width
+        self.viewport_height = viewport_height
+        self.size = max(1, size)
+        self.max_uses = max_uses
+        self.health_check_interval = health_check_interval
+
+        self._idle: List[PooledBrowser] = []
+        self._total = 0
+        self._leased = 0
+        self._launches = 0
+        self._recycled = 0
+        self._condition = asyncio.Condition()
+        self._maintenance_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    async def start(self):
+        """Launch browsers until the pool is full and start the health checks."""
+        if self._maintenance_task is None:
+            self._maintenance_task = asyncio.ensure_future(self._maintain())
+        await asyncio.gather(*(self._add_browser() for _ in range(self.size - self._total)))
+
+    async def acquire(self) -> BrowserLease:
+        """
+        Lease a browser with a fresh, isolated context.
+
+        Waits until a browser is available if all of them are leased.
+
+        Returns:
+            A lease that must be released when the task is done.
+        """
+        if self._maintenance_task is None:
+            await self.start()
+
+        async with self._condition:
+            while not self._idle:
+                if self._closed:
+                    raise RuntimeError("Browser pool is closed")
+                if self._total < self.size:
+                    break
+                await self._condition.wait()
+            pooled = self._idle.pop() if self._idle else None
+            if pooled is None:
+                # Reserve the slot before launching outside the lock
+                self._total += 1
+            self._leased += 1
+
+        try:
+            if pooled is None:
+                pooled = PooledBrowser(browser=await self._launch())
+            elif not await self._is_healthy(pooled):
+                logger.warning("Discarding unhealthy pooled browser")
+                await self._close_browser(pooled)
+                pooled = PooledBrowser(browser=await self._launch())
+            context = await pooled.browser.new_context()
+        except Exception:
+            if pooled is not None:
+                await self._close_browser(pooled)
+            async with self._condition:
+                self._total -= 1
+                self._leased -= 1
+                self._condition.notify()
+            raise
+
+        pooled.uses += 1
+        return BrowserLease(pooled=pooled, context=context, pool=self)
+
+    async def release(self, lease: BrowserLease):
+        """Close the lease's context and return its browser to the pool."""
+        pooled = lease.pooled
+        try:
+            await lease.context.close()
+        except Exception as e:
+            logger.error(f"Error closing browser context: {e}", exc_info=True)
+            pooled.uses = self.max_uses
+
+        recycle = self._closed or pooled.uses >= self.max_uses
+        async with self._condition:
+            self._leased -= 1
+            if recycle:
+                self._total -= 1
+                self._recycled += 1
+            else:
+                self._idle.append(pooled)
+            self._condition.notify()
+
+        if recycle:
+            await self._close_browser(pooled)
+            if not self._closed:
+                asyncio.ensure_future(self._add_browser())
+
+    async def close(self):
+        """Close all idle browsers. Leased browsers are closed when released."""
+        self._closed = True
+        if self._maintenance_task:
+            self._maintenance_task.cancel()
+        async with self._condition:
+            idle, self._idle = self._idle, []
+            self._total -= len(idle)
+            self._condition.notify_all()
+        await asyncio.gather(*(self._close_browser(pooled) for pooled in idle))
+
+    def stats(self) -> Dict[str, Any]:
+        """Current pool utilization."""
+        return {
+            "headless": self.headless,
+            "size": self.size,
+            "browsers": self._total,
+            "idle": len(self._idle),
+            "leased": self._leased,
+            "launches": self._launches,
+            "recycled": self._recycled,
+            "max_uses": self.max_uses,
+        }
+
+    async def _launch(self) -> Browser:
+        browser = Browser(
+            config=BrowserConfig(
+                headless=self.headless,
+                viewport_width=self.viewport_width,
+                viewport_height=self.viewport_height,
+            )
+        )
+        # Browser launches lazily; force it now so the lease gets a warm browser
+        await browser.get_playwright_browser()
+        self._launches += 1
+        return browser
+
+    async def _add_browser(self):
+        """Launch one browser into the idle list if there is room for it."""
+        async with self._condition:
+            if self._closed or self._total >= self.size:
+                return
+            self._total += 1
+        try:
+            pooled = PooledBrowser(browser=await self._launch())
+        except Exception as e:
+            logger.error(f"Error launching pooled browser: {e}", exc_info=True)
+            async with self._condition:
+                self._total -= 1
+                self._condition.notify()
+            return
+        async with self._condition:
+            self._idle.append(pooled)
+            self._condition.notify()
+
+    async def _is_healthy(self, pooled: PooledBrowser) -> bool:
+        try:
+            playwright_browser = await pooled.browser.get_playwright_browser()
+            return playwright_browser.is_connected()
+        except Exception:
+            return False
+
+    async def _close_browser(self, pooled: PooledBrowser):
+        try:
+            await pooled.browser.close()
+        except Exception as e:
+            logger.error(f"Error closing pooled browser: {e}", exc_info=True)
+
+    async def _maintain(self):
+        """Periodically drop idle browsers that have died and refill the pool."""
+        try:
+            while not self._closed:
+                await asyncio.sleep(self.health_check_interval)
+                for pooled in list(self._idle):
+                    if await self._is_healthy(pooled):
+                        continue
+                    async with self._condition:
+                        if pooled not in self._idle:
+                            continue
+                        self._idle.remove(pooled)
+                        self._total -= 1
+                        self._recycled += 1
+                    logger.warning("Pooled browser failed health check; replacing it")
+                    await self._close_browser(pooled)
+                await self.start()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Error in browser pool maintenance: {e}", exc_info=True)
+
+
+# One pool per browser mode and viewport size
+_pools: Dict[Tuple[bool, int, int], BrowserPool] = {}
+
+
+def get_browser_pool(headless: bool, viewport_width: int = 1280, viewport_height: int = 800) -> BrowserPool:
+    """
+    Get the shared pool for a browser mode, creating it on first use.
+
+    Args:
+        headless: Whether the pool launches headless browsers.
+        viewport_width: Viewport width of the pooled browsers.
+        viewport_height: Viewport height of the pooled browsers.
+
+    Returns:
+        The process-wide pool for this configuration.
+    """
+    key = (headless, viewport_width, viewport_height)
+    if key not in _pools:
+        _pools[key] = BrowserPool(headless=headless, viewport_width=viewport_width, viewport_height=viewport_height)
+    return _pools[key]
+
+
+def prewarm_browser_pools(modes: str = POOL_PREWARM):
+    """
+    Start filling the pools for the given browser modes in the background.
+
+    Args:
+        modes: Comma-separated list of "headless" and/or "headed".
+    """
+    for mode in filter(None, (m.strip() for m in modes.split(","))):
+        if mode not in ("headless", "headed"):
+            logger.warning(f"Unknown browser pool mode: {mode}")
+            continue
+        asyncio.ensure_future(get_browser_pool(headless=mode == "headless").start())
+
+
+async def close_browser_pools():
+    """Close every shared browser pool."""
+    pools = list(_pools.values())
+    _pools.clear()
+    await asyncio.gather(*(pool.close() for pool in pools))
+
+
+def browser_pool_stats() -> List[Dict[str, Any]]:
+    """Utilization of every shared browser pool."""
+    return [pool.stats() for pool in _pools.values()]
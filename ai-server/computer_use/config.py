@@ -21,22 +21,42 @@ class ComputerUseConfig(BaseModel):
     deepseek_api_key: Optional[str] = None
     deepseek_endpoint: Optional[str] = None
     
-    # For future DeepSeek integration
-    # When DeepSeek's API is fully operational, enable these settings:
-    # - deepseek_model: Optional[str] = "deepseek-coder-6.7b-instruct"
-    # - deepseek_max_tokens: int = 4096
-    # - deepseek_temperature: float = 0.0
-    # - deepseek_top_p: float = 0.95
+    deepseek_adapter: Optional[str] = None  # LoRA adapter on the server, None for its default
+    deepseek_max_tokens: int = 1024
+    deepseek_temperature: float = 0.0
+    deepseek_top_p: float = 0.95
+    deepseek_timeout: float = 120.0  # Seconds a whole call may take, streamed or not
+    deepseek_streaming: bool = False
     
     # Browser settings
     headless: bool = False
     viewport_width: int = 1280
     viewport_height: int = 800
+    use_browser_pool: bool = True  # Lease a warm browser from the shared pool
+    
+    # LLM settings
+    use_llm_pool: bool = True  # Share HTTP connections and per-key limits between agents
     
     # Agent settings
     use_vision: bool = True
     max_steps: int = 20
     
+    # Vision settings: screenshots are shrunk before they are sent to the LLM
+    optimize_vision: bool = True
+    vision_max_width: int = 1024
+    vision_max_height: int = 768
+    vision_jpeg_quality: int = 70
+    vision_skip_unchanged: bool = True  # Leave out screenshots that look like the previous one
+    vision_hash_threshold: int = 2  # Perceptual hash bits that may differ for "looks the same"
+    vision_crop_changes: bool = False  # Send only the changed region when little changed
+    vision_crop_max_fraction: float = 0.5
+    
+    # Context settings: old steps are folded into a digest to keep each prompt within budget
+    compact_context: bool = True
+    context_token_budget: int = 16000  # Tokens per prompt, screenshots included
+    context_recent_messages: int = 6  # Messages kept as they are
+    context_recent_steps: int = 5  # Steps of the agent history kept as they are
+    
     def __init__(self, **data):
         """Initialize with environment variables as fallbacks."""
         # Set API keys from environment if not provided
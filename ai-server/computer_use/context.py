@@ -0,0 +1,464 @@
+"""
+Context Compaction
+
+This module keeps the prompt an agent sends for each step within a token
+budget, so that per-step latency and cost stay flat as tasks get longer.
+Old steps are folded into a rolling digest with one line per step, every
+screenshot before the newest full one is dropped, and if the prompt is still too
+large the largest text (usually the page's DOM dump) is truncated. Tokens
+are counted locally with tiktoken, or estimated from the text length when
+it is not installed.
+"""
+
+import asyncio
+import contextvars
+import hashlib
+import json
+import logging
+import re
+import threading
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from .timings import span
+from .vision import current_vision_optimizer, is_crop_note, is_screenshot_note
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - tiktoken comes with langchain-openai
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Tokens every message costs on top of its content
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Longest line a message or step is shortened to in the digest
+DIGEST_LINE_CHARS = 200
+
+# Older page states larger than this are cut to their first line
+STALE_TEXT_TOKENS = 200
+
+# Token counts kept per task, keyed by a hash of the text
+CACHE_SIZE = 256
+
+DIGEST_HEADER = "Summary of earlier steps (screenshots and page contents left out):"
+
+TRUNCATION_NOTE = "\n[... truncated to fit the context budget ...]"
+
+# Steps in browser-use's <agent_history> block
+HISTORY_BLOCK = re.compile(r"<agent_history>(.*?)</agent_history>", re.DOTALL)
+HISTORY_STEP = re.compile(r"<step_(\d+)>\s*(.*?)\s*</step_\1>\s*", re.DOTALL)
+
+# The compactor of the task whose LLM calls are being made; set by ComputerUseAgent.run
+current_context_compactor: contextvars.ContextVar[Optional["ContextCompactor"]] = contextvars.ContextVar(
+    "current_context_compactor", default=None
+)
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Count the tokens of a text with tiktoken, or estimate them as one per four characters."""
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        return len(_encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def shorten(text: str, limit: int = DIGEST_LINE_CHARS) -> str:
+    """Collapse whitespace and cut a text to at most limit characters."""
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[: limit - 3] + "..."
+
+
+def message_text(message: Dict[str, Any]) -> str:
+    """The text of an OpenAI chat message, without its images."""
+    content = message.get("content")
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return ""
+
+
+def is_image_part(part: Any) -> bool:
+    """Whether a message part is an image (a screenshot)."""
+    return isinstance(part, dict) and part.get("type") == "image_url"
+
+
+def summarize_model_output(output: Dict[str, Any]) -> Optional[str]:
+    """Summarize a browser-use model output ({"current_state": ..., "action": [...]}) in one line."""
+    if not isinstance(output, dict) or "action" not in output:
+        return None
+    state = output.get("current_state") or {}
+    goal = state.get("next_goal") or state.get("memory") or output.get("next_goal") or output.get("memory")
+    actions = []
+    for action in output.get("action") or []:
+        if isinstance(action, dict) and action:
+            name, params = next(iter(action.items()))
+            actions.append(f"{name}({shorten(json.dumps(params, ensure_ascii=False), 60)})")
+    line = f"{goal} -> " if goal else ""
+    return line + (", ".join(actions) or "no action")
+
+
+@dataclass
+class ContextStats:
+    """Counters for the prompts of one task."""
+
+    requests: int = 0
+    tokens_before: int = 0
+    tokens_after: int = 0
+    last_prompt_tokens: int = 0
+    max_prompt_tokens: int = 0
+    steps_folded: int = 0
+    images_dropped: int = 0
+    truncated: int = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        stats = asdict(self)
+        stats["tokens_saved"] = self.tokens_before - self.tokens_after
+        return stats
+
+
+class ContextCompactor:
+    """
+    Prompt compaction for one task.
+
+    Args:
+        token_budget: Most tokens a prompt may have, images included.
+        recent_messages: Messages at the end of the conversation that are
+            kept as they are; older ones are folded into the digest.
+        recent_steps: Steps of browser-use's <agent_history> block that are
+            kept as they are; older ones are folded into the digest.
+        digest_max_lines: Lines kept in the digest; the oldest are dropped.
+        image_tokens: Tokens counted for each screenshot.
+    """
+
+    def __init__(
+        self,
+        token_budget: int = 16000,
+        recent_messages: int = 6,
+        recent_steps: int = 5,
+        digest_max_lines: int = 50,
+        image_tokens: int = 765,
+    ):
+        self.token_budget = token_budget
+        self.recent_messages = max(1, recent_messages)
+        self.recent_steps = max(1, recent_steps)
+        self.digest_max_lines = digest_max_lines
+        self.image_tokens = image_tokens
+        self.stats = ContextStats()
+        self._token_cache: Dict[bytes, int] = {}
+        self._lock = threading.Lock()
+
+    async def compact_messages(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Compact the messages of a chat completion request to the token budget.
+
+        Counting the tokens of large DOM dumps takes a while, so the work runs
+        in a worker thread.
+
+        Args:
+            messages: Messages in the OpenAI format.
+
+        Returns:
+            New messages; the input is not changed.
+        """
+        return await asyncio.to_thread(self._compact, messages)
+
+    def _compact(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        with self._lock:
+            before = self.prompt_tokens(messages)
+            messages = self._fold_messages(messages)
+            messages = [self._fold_history_block(message) for message in messages]
+            messages = self._drop_stale_pages(messages)
+            messages = self._drop_old_images(messages)
+            after = self.prompt_tokens(messages)
+            if after > self.token_budget:
+                messages = self._truncate(messages, after - self.token_budget)
+                after = self.prompt_tokens(messages)
+
+            self.stats.requests += 1
+            self.stats.tokens_before += before
+            self.stats.tokens_after += after
+            self.stats.last_prompt_tokens = after
+            self.stats.max_prompt_tokens = max(self.stats.max_prompt_tokens, after)
+            return messages
+
+    def text_tokens(self, text: str) -> int:
+        """Count the tokens of a text, caching the counts of texts seen before."""
+        if len(text) < 256:
+            return count_tokens(text)
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        tokens = self._token_cache.get(key)
+        if tokens is None:
+            if len(self._token_cache) >= CACHE_SIZE:
+                self._token_cache.clear()
+            tokens = self._token_cache[key] = count_tokens(text)
+        return tokens
+
+    def prompt_tokens(self, messages: List[Dict[str, Any]]) -> int:
+        """Count the tokens of a prompt, with a fixed count for every image."""
+        total = 0
+        for message in messages:
+            total += MESSAGE_OVERHEAD_TOKENS
+            content = message.get("content")
+            if isinstance(content, str):
+                total += self.text_tokens(content)
+            elif isinstance(content, list):
+                for part in content:
+                    if isinstance(part, dict) and part.get("type") == "text":
+                        total += self.text_tokens(part.get("text", ""))
+                    elif isinstance(part, dict) and part.get("type") == "image_url":
+                        total += self.image_tokens
+            for call in message.get("tool_calls") or []:
+                total += self.text_tokens(json.dumps(call, ensure_ascii=False))
+        return total
+
+    def _fold_messages(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Replace the messages between the task and the recent ones with a digest."""
+        # The system prompt and the first user message (the task) are always kept
+        head = 0
+        while head < len(messages) and messages[head].get("role") == "system":
+            head += 1
+        head += 1
+        start = len(messages) - self.recent_messages
+        # Tool results must stay with the assistant message that called the tool
+        while start > head and messages[start].get("role") == "tool":
+            start -= 1
+        if start - head < 2:
+            return messages
+
+        lines = [line for line in (self._digest_line(message) for message in messages[head:start]) if line]
+        self.stats.steps_folded += sum(1 for message in messages[head:start] if message.get("role") == "assistant")
+        digest = {"role": "user", "content": self._digest_text(lines)}
+        return messages[:head] + [digest] + messages[start:]
+
+    def _fold_history_block(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        """Replace all but the recent steps of an <agent_history> block with a digest."""
+        content = message.get("content")
+        if isinstance(content, str):
+            folded = self._fold_history_text(content)
+            return message if folded is content else {**message, "content": folded}
+        if isinstance(content, list):
+            parts = []
+            changed = False
+            for part in content:
+                if isinstance(part, dict) and part.get("type") == "text":
+                    folded = self._fold_history_text(part.get("text", ""))
+                    if folded is not part.get("text"):
+                        part, changed = {**part, "text": folded}, True
+                parts.append(part)
+            return {**message, "content": parts} if changed else message
+        return message
+
+    def _fold_history_text(self, text: str) -> str:
+        block = HISTORY_BLOCK.search(text) if "<agent_history>" in text else None
+        if block is None:
+            return text
+        steps = list(HISTORY_STEP.finditer(block.group(1)))
+        if len(steps) <= self.recent_steps:
+            return text
+
+        old, inner = steps[: -self.recent_steps], block.group(1)
+        lines = [f"Step {step.group(1)}: {self._step_line(step.group(2))}" for step in old]
+        self.stats.steps_folded += len(old)
+        folded = (
+            inner[: old[0].start()]
+            + f"<earlier_steps>\n{self._digest_text(lines)}\n</earlier_steps>\n"
+            + inner[old[-1].end():]
+        )
+        return text[: block.start(1)] + folded + text[block.end(1):]
+
+    def _digest_text(self, lines: List[str]) -> str:
+        if len(lines) > self.digest_max_lines:
+            omitted = len(lines) - self.digest_max_lines
+            lines = [f"({omitted} earlier entries omitted)"] + lines[-self.digest_max_lines:]
+        return DIGEST_HEADER + "\n" + "\n".join(
+            f"- {line}" for line in lines
+        )
+
+    @staticmethod
+    def _step_line(step: str) -> str:
+        """One line for a step of browser-use's history: its goal and action results."""
+        fields = {}
+        for line in step.splitlines():
+            label, _, value = line.partition(":")
+            if value.strip():
+                fields.setdefault(label.strip().lower(), value.strip())
+        goal = fields.get("next goal") or fields.get("memory")
+        results = [value for label, value in fields.items() if label.startswith("action")]
+        if goal or results:
+            return shorten(" -> ".join(filter(None, [goal, "; ".join(results)])))
+        return shorten(step)
+
+    @staticmethod
+    def _digest_line(message: Dict[str, Any]) -> Optional[str]:
+        """One line for a folded message, or None if it is not worth keeping."""
+        role = message.get("role")
+        if role == "assistant":
+            outputs = []
+            for call in message.get("tool_calls") or []:
+                try:
+                    outputs.append(json.loads(call.get("function", {}).get("arguments") or "{}"))
+                except ValueError:
+                    pass
+            text = message_text(message)
+            if text:
+                try:
+                    outputs.append(json.loads(text))
+                except ValueError:
+                    return f"Agent: {shorten(text)}"
+            summaries = [summary for summary in map(summarize_model_output, outputs) if summary]
+            return f"Agent: {shorten('; '.join(summaries))}" if summaries else None
+
+        # Page states are mostly DOM; their first line (the URL) is what is worth keeping
+        text = message_text(message).strip()
+        if not text:
+            return None
+        first_line = text.splitlines()[0]
+        return f"{'Result' if role == 'tool' else 'Input'}: {shorten(first_line)}"
+
+    def _drop_stale_pages(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Cut the page states (DOM dumps) of all but the newest user message to their first line."""
+        users = [index for index, message in enumerate(messages) if message.get("role") == "user"]
+        # The first user message is the task and the last one the current page
+        stale = {index for index in users[1:-1] if not message_text(messages[index]).startswith(DIGEST_HEADER)}
+        if not stale:
+            return messages
+
+        compacted = []
+        for index, message in enumerate(messages):
+            if index in stale:
+                text = message_text(message)
+                if self.text_tokens(text) > STALE_TEXT_TOKENS:
+                    first_line = shorten(text.strip().splitlines()[0])
+                    cut = f"{first_line}\n[earlier page contents left out]"
+                    content = message.get("content")
+                    if isinstance(content, list):
+                        # Images and the vision optimizer's notes are handled by _drop_old_images
+                        images = [part for part in content if is_image_part(part) or is_screenshot_note(part)]
+                        message = {**message, "content": [{"type": "text", "text": cut}] + images}
+                    else:
+                        message = {**message, "content": cut}
+            compacted.append(message)
+        return compacted
+
+    def _drop_old_images(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Remove every screenshot before the newest full one.
+
+        Cropped regions after it are kept, since they only make sense
+        together with it. The vision optimizer's notes refer to the
+        screenshot before them, so notes among the dropped screenshots are
+        dropped too.
+        """
+        # The newest image that is not a cropped region (those follow a crop note)
+        keep_from: Optional[Tuple[int, int]] = None
+        for index, message in enumerate(messages):
+            content = message.get("content")
+            if isinstance(content, list):
+                for position, part in enumerate(content):
+                    if is_image_part(part) and not (position > 0 and is_crop_note(content[position - 1])):
+                        keep_from = (index, position)
+        if keep_from is None:
+            return messages
+
+        compacted = []
+        for index, message in enumerate(messages):
+            content = message.get("content")
+            if index <= keep_from[0] and isinstance(content, list):
+                parts = [
+                    part for position, part in enumerate(content)
+                    if (index, position) >= keep_from or not (is_image_part(part) or is_screenshot_note(part))
+                ]
+                if len(parts) < len(content):
+                    self.stats.images_dropped += sum(map(is_image_part, content)) - sum(map(is_image_part, parts))
+                    message = {**message, "content": parts or ""}
+            compacted.append(message)
+        return compacted
+
+    def _truncate(self, messages: List[Dict[str, Any]], excess: int) -> List[Dict[str, Any]]:
+        """Cut the largest texts, outside the system prompt, until the prompt fits the budget."""
+        messages = list(messages)
+        for _ in range(len(messages)):
+            if excess <= 0:
+                break
+            # Find the largest text, as (tokens, message index, part index or None)
+            largest: Optional[Tuple[int, int, Optional[int]]] = None
+            for index, message in enumerate(messages):
+                if message.get("role") == "system":
+                    continue
+                content = message.get("content")
+                if isinstance(content, str):
+                    candidates = [(self.text_tokens(content), index, None)]
+                elif isinstance(content, list):
+                    candidates = [
+                        (self.text_tokens(part.get("text", "")), index, position)
+                        for position, part in enumerate(content)
+                        if isinstance(part, dict) and part.get("type") == "text"
+                    ]
+                else:
+                    candidates = []
+                for candidate in candidates:
+                    if largest is None or candidate[0] > largest[0]:
+                        largest = candidate
+            if largest is None or largest[0] <= excess:
+                break
+
+            tokens, index, position = largest
+            message = messages[index]
+            text = message["content"] if position is None else message["content"][position]["text"]
+            keep = max(0, int(len(text) * (tokens - excess) / tokens) - len(TRUNCATION_NOTE))
+            cut = text[:keep] + TRUNCATION_NOTE
+            if position is None:
+                messages[index] = {**message, "content": cut}
+            else:
+                parts = list(message["content"])
+                parts[position] = {**parts[position], "text": cut}
+                messages[index] = {**message, "content": parts}
+            self.stats.truncated += 1
+            excess -= tokens - self.text_tokens(cut)
+        return messages
+
+
+class OptimizingCompletions:
+    """
+    Wraps an OpenAI chat completions resource so that the screenshots of a
+    task's prompts are optimized by its VisionOptimizer and the prompts then
+    compacted by its ContextCompactor before they are sent, and the call is
+    timed.
+
+    The wrapped resource is shared between tasks, so the compactor, the
+    optimizer and the timings are taken from context variables that
+    ComputerUseAgent.run sets.
+    """
+
+    def __init__(self, completions: Any):
+        self._completions = completions
+
+    async def create(self, *args: Any, messages: Optional[List[Dict[str, Any]]] = None, **kwargs: Any) -> Any:
+        # Screenshots are optimized first, so that compaction sees the optimizer's
+        # notes and can drop them together with the screenshots they refer to
+        optimizer = current_vision_optimizer.get()
+        if optimizer is not None and messages:
+            with span("vision"):
+                messages = await optimizer.optimize_messages(messages)
+        compactor = current_context_compactor.get()
+        if compactor is not None and messages:
+            with span("compaction"):
+                messages = await compactor.compact_messages(messages)
+        with span("llm", provider="openai", model=kwargs.get("model"), stream=bool(kwargs.get("stream"))) as attributes:
+            response = await self._completions.create(*args, messages=messages, **kwargs)
+            # Streamed responses have no usage; the span then only covers the time to the first chunk
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                attributes["prompt_tokens"] = usage.prompt_tokens
+                attributes["completion_tokens"] = usage.completion_tokens
+            return response
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._completions, name)
@@ -0,0 +1,329 @@
+"""
+DeepSeek Chat Model
+
+This module provides a LangChain chat model backed by our self-hosted
+inference server (server.py), or any server with the same API: POST
+/api/generate returning {"response": ...} and POST /api/generate/stream
+sending the text as Server-Sent Events. Requests go through the shared LLM
+client pool, so connections are reused and per-key limits apply. The server
+has no tool calling, so structured output (the agent's actions) is written
+by the model as JSON and parsed here.
+"""
+
+import asyncio
+import json
+import logging
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+import httpx
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel, agenerate_from_stream
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, SystemMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable, RunnableLambda
+
+from .llm_pool import get_llm_pool
+from .timings import span
+
+logger = logging.getLogger(__name__)
+
+# Separates the turns of the DeepSeek Coder instruct prompt format
+END_OF_TURN = "<|EOT|>"
+
+
+def message_text(message: BaseMessage) -> str:
+    """Get the text of a message; images are left out since the server is text-only."""
+    if isinstance(message.content, str):
+        return message.content
+    parts = []
+    for part in message.content:
+        if isinstance(part, str):
+            parts.append(part)
+        elif isinstance(part, dict) and part.get("type") == "text":
+            parts.append(part.get("text", ""))
+    return "\n".join(parts)
+
+
+def tool_call_text(message: AIMessage) -> str:
+    """The arguments of an AI message's tool calls as JSON, the way the model writes them."""
+    return "\n".join(json.dumps(call["args"], ensure_ascii=False) for call in getattr(message, "tool_calls", None) or [])
+
+
+def format_prompt(messages: List[BaseMessage]) -> str:
+    """
+    Render chat messages in the DeepSeek Coder instruct format.
+
+    Args:
+        messages: The conversation so far.
+
+    Returns:
+        A prompt that ends where the model should write its response.
+    """
+    prompt = []
+    for message in messages:
+        text = message_text(message)
+        if isinstance(message, ToolMessage) and not text:
+            # browser-use acknowledges each structured output with an empty tool result
+            continue
+        if isinstance(message, SystemMessage):
+            prompt.append(f"{text}\n")
+        elif isinstance(message, AIMessage):
+            # Earlier structured outputs are kept as tool calls in the history
+            text = text or tool_call_text(message)
+            prompt.append(f"### Response:\n{text}\n{END_OF_TURN}\n")
+        else:
+            prompt.append(f"### Instruction:\n{text}\n")
+    prompt.append("### Response:\n")
+    return "".join(prompt)
+
+
+def truncate_at_stop(text: str, stop: Optional[List[str]]) -> str:
+    """Cut the text at the first stop sequence, since the server does not support them."""
+    for sequence in (stop or []) + [END_OF_TURN]:
+        index = text.find(sequence)
+        if index != -1:
+            text = text[:index]
+    return text
+
+
+def extract_json(text: str) -> Any:
+    """
+    Parse the JSON object in a response.
+
+    Models often wrap it in a ```json block or add a sentence around it, so
+    the text from the first "{" to the last "}" is parsed.
+
+    Raises:
+        ValueError: If the response has no valid JSON object.
+    """
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end < start:
+        raise ValueError(f"No JSON object in the response: {text[:200]!r}")
+    return json.loads(text[start:end + 1])
+
+
+def parse_structured_output(text: str, schema: Any) -> Any:
+    """Parse a response into a Pydantic model class, or a dict for a JSON schema."""
+    data = extract_json(text)
+    if isinstance(schema, type):
+        return schema.model_validate(data) if hasattr(schema, "model_validate") else schema.parse_obj(data)
+    return data
+
+
+def partial_stop_length(text: str, stops: List[str]) -> int:
+    """Length of the longest end of the text that is the beginning of a stop sequence."""
+    longest = 0
+    for sequence in stops:
+        for length in range(min(len(sequence) - 1, len(text)), longest, -1):
+            if text.endswith(sequence[:length]):
+                longest = length
+                break
+    return longest
+
+
+class DeepSeekChatModel(BaseChatModel):
+    """
+    LangChain chat model for the self-hosted DeepSeek server.
+
+    Attributes:
+        api_key: The server's API key, sent as a bearer token.
+        endpoint: Base URL of the server, e.g. http://localhost:8080.
+        max_tokens: Maximum number of tokens to generate per call.
+        temperature: Sampling temperature.
+        top_p: Nucleus sampling threshold.
+        adapter: LoRA adapter to use, or None for the server's default.
+        timeout: Seconds a whole call may take, streamed or not.
+        streaming: Whether to use the streaming endpoint by default.
+    """
+
+    api_key: str
+    endpoint: str
+    max_tokens: int = 1024
+    temperature: float = 0.0
+    top_p: float = 0.95
+    adapter: Optional[str] = None
+    timeout: float = 120.0
+    streaming: bool = False
+
+    @property
+    def _llm_type(self) -> str:
+        return "deepseek-server"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {
+            "endpoint": self.endpoint,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "adapter": self.adapter,
+        }
+
+    def _url(self, path: str) -> str:
+        base = self.endpoint.rstrip("/")
+        # Accept the generate URL itself as well as the server's base URL
+        for suffix in ("/api/generate/stream", "/api/generate"):
+            if base.endswith(suffix):
+                base = base[: -len(suffix)]
+        return base + path
+
+    def _request(self, messages: List[BaseMessage], **kwargs: Any) -> Dict[str, Any]:
+        payload = {
+            "prompt": format_prompt(messages),
+            "max_tokens": kwargs.get("max_tokens", self.max_tokens),
+            "temperature": kwargs.get("temperature", self.temperature),
+            "top_p": kwargs.get("top_p", self.top_p),
+        }
+        adapter = kwargs.get("adapter", self.adapter)
+        if adapter:
+            payload["adapter"] = adapter
+        return {
+            "json": payload,
+            "headers": {"Authorization": f"Bearer {self.api_key}"},
+            "timeout": httpx.Timeout(kwargs.get("timeout", self.timeout), connect=10.0),
+        }
+
+    def _client(self) -> httpx.AsyncClient:
+        return get_llm_pool().http_client("deepseek", self.api_key)
+
+    @staticmethod
+    def _result(text: str) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def with_structured_output(self, schema: Any, *, include_raw: bool = False, **kwargs: Any) -> Runnable:
+        """
+        Return the model's JSON response parsed into the schema.
+
+        browser-use asks for the agent's next action this way. The server
+        has no tool calling, so the JSON the system prompt asks for is parsed
+        from the text instead; a method such as "function_calling" is ignored.
+
+        Args:
+            schema: A Pydantic model class, or a JSON schema dict (parsed to a dict).
+            include_raw: Return {"raw", "parsed", "parsing_error"} instead of
+                raising when the response cannot be parsed.
+        """
+
+        def parse(message: AIMessage) -> Any:
+            try:
+                parsed, error = parse_structured_output(message_text(message), schema), None
+            except ValueError as e:  # Also Pydantic's ValidationError
+                if not include_raw:
+                    raise
+                logger.warning(f"Could not parse the DeepSeek response as {getattr(schema, '__name__', 'JSON')}: {e}")
+                parsed, error = None, e
+            return {"raw": message, "parsed": parsed, "parsing_error": error} if include_raw else parsed
+
+        return self | RunnableLambda(parse)
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        # Synchronous calls are rare (browser-use is async), so they use a one-off client
+        response = httpx.post(self._url("/api/generate"), **self._request(messages, **kwargs))
+        response.raise_for_status()
+        return self._result(truncate_at_stop(response.json()["response"], stop))
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        stream = kwargs.pop("stream", self.streaming)
+        timeout = kwargs.get("timeout", self.timeout)
+        with span("llm", provider="deepseek", stream=stream):
+            if stream:
+                call = agenerate_from_stream(self._astream(messages, stop, run_manager, **kwargs))
+            else:
+                call = self._agenerate_once(messages, stop, **kwargs)
+            # httpx only limits each read, so a server that trickles tokens would never time out
+            try:
+                return await asyncio.wait_for(call, timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"DeepSeek server did not respond within {timeout} s") from None
+
+    async def _agenerate_once(self, messages: List[BaseMessage], stop: Optional[List[str]], **kwargs: Any) -> ChatResult:
+        response = await self._client().post(self._url("/api/generate"), **self._request(messages, **kwargs))
+        response.raise_for_status()
+        return self._result(truncate_at_stop(response.json()["response"], stop))
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        result = self._generate(messages, stop, run_manager, **kwargs)
+        yield ChatGenerationChunk(message=AIMessageChunk(content=result.generations[0].message.content))
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        stops = (stop or []) + [END_OF_TURN]
+        text = ""
+        emitted = 0
+        finished = False
+        async for chunk in self._stream_text(messages, **kwargs):
+            # Stop sequences may span chunks, so they are checked on the whole text
+            text += chunk
+            truncated = truncate_at_stop(text, stop)
+            finished = len(truncated) < len(text)
+            # Hold back a tail that could be the start of a stop sequence
+            ready = len(truncated) if finished else len(truncated) - partial_stop_length(truncated, stops)
+            if ready > emitted:
+                new_text, emitted = truncated[emitted:ready], ready
+                if run_manager:
+                    await run_manager.on_llm_new_token(new_text)
+                yield ChatGenerationChunk(message=AIMessageChunk(content=new_text))
+            if finished:
+                # Closing the stream removes the request from the server's batch
+                break
+
+        if not finished and len(text) > emitted:
+            # The stream ended on what only looked like the start of a stop sequence
+            if run_manager:
+                await run_manager.on_llm_new_token(text[emitted:])
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text[emitted:]))
+
+    async def _stream_text(self, messages: List[BaseMessage], **kwargs: Any) -> AsyncIterator[str]:
+        """Yield text chunks from the server's Server-Sent Events stream, within the call's timeout."""
+        request = self._request(messages, **kwargs)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + kwargs.get("timeout", self.timeout)
+        async with self._client().stream("POST", self._url("/api/generate/stream"), **request) as response:
+            if response.status_code >= 400:
+                await response.aread()
+                response.raise_for_status()
+
+            event = "message"
+            lines = response.aiter_lines()
+            while True:
+                try:
+                    line = await asyncio.wait_for(lines.__anext__(), max(deadline - loop.time(), 0))
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    raise TimeoutError("DeepSeek stream did not finish within the timeout") from None
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        return
+                    payload = json.loads(data)
+                    if event == "error":
+                        raise RuntimeError(payload.get("detail", "Generation failed"))
+                    yield payload.get("text", "")
+                elif not line:
+                    event = "message"
@@ -0,0 +1,153 @@
+"""
+Task Events
+
+This module provides a per-task publish/subscribe bus for task updates.
+Publishers report only the fields that changed, and every update gets a
+sequence number so subscribers can detect gaps and ask for a full snapshot.
+Screenshots are delivered separately as raw bytes.
+"""
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Updates buffered per subscriber before it is considered too slow and resynced
+SUBSCRIBER_QUEUE_SIZE = 256
+
+
+@dataclass(frozen=True)
+class TaskEvent:
+    """A single message for a subscriber."""
+
+    type: str  # "snapshot", "update" or "frame"
+    seq: int
+    data: Any = None
+
+    def to_json(self) -> Dict[str, Any]:
+        key = "state" if self.type == "snapshot" else "changes"
+        return {"type": self.type, "seq": self.seq, key: self.data}
+
+
+class Subscription:
+    """
+    A subscriber's view of a task topic.
+
+    JSON events are queued in order. Frames are not queued: only the latest
+    one is kept, so a slow viewer skips frames instead of falling behind.
+    """
+
+    def __init__(self, topic: "TaskTopic"):
+        self.topic = topic
+        self._events: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self._frame: Optional[bytes] = None
+        self._wakeup = asyncio.Event()
+        self.closed = False
+
+    def push(self, event: TaskEvent):
+        try:
+            self._events.put_nowait(event)
+        except asyncio.QueueFull:
+            # Too far behind: drop the backlog and send the full state instead
+            while not self._events.empty():
+                self._events.get_nowait()
+            self._events.put_nowait(self.topic.snapshot())
+        self._wakeup.set()
+
+    def push_frame(self, frame: bytes):
+        self._frame = frame
+        self._wakeup.set()
+
+    def resync(self):
+        """Queue a full snapshot, e.g. after the client detected a gap."""
+        self.push(self.topic.snapshot())
+
+    async def next(self) -> TaskEvent:
+        """Wait for the next event. Frames are returned after pending updates."""
+        while True:
+            if not self._events.empty():
+                return self._events.get_nowait()
+            if self._frame is not None:
+                frame, self._frame = self._frame, None
+                return TaskEvent(type="frame", seq=self.topic.seq, data=frame)
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.topic.subscribers.discard(self)
+
+
+class TaskTopic:
+    """Latest state of one task and the subscribers watching it."""
+
+    def __init__(self, task_id: str, state: Optional[Dict[str, Any]] = None):
+        self.task_id = task_id
+        self.state: Dict[str, Any] = dict(state or {})
+        self.seq = 0
+        self.subscribers: Set[Subscription] = set()
+
+    def snapshot(self) -> TaskEvent:
+        return TaskEvent(type="snapshot", seq=self.seq, data=dict(self.state))
+
+    def publish(self, changes: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Apply changes to the state and notify subscribers of the fields that differ.
+
+        Returns:
+            The fields that actually changed.
+        """
+        delta = {key: value for key, value in changes.items() if self.state.get(key, object()) != value}
+        if not delta:
+            return delta
+        self.state.update(delta)
+        self.seq += 1
+        event = TaskEvent(type="update", seq=self.seq, data=delta)
+        for subscriber in self.subscribers:
+            subscriber.push(event)
+        return delta
+
+    def publish_frame(self, frame: bytes):
+        for subscriber in self.subscribers:
+            subscriber.push_frame(frame)
+
+    def subscribe(self) -> Subscription:
+        """Subscribe to the topic. The first event is always a snapshot."""
+        subscription = Subscription(self)
+        subscription.push(self.snapshot())
+        self.subscribers.add(subscription)
+        return subscription
+
+
+class TaskEventBus:
+    """Registry of task topics."""
+
+    def __init__(self):
+        self._topics: Dict[str, TaskTopic] = {}
+
+    def topic(self, task_id: str) -> TaskTopic:
+        if task_id not in self._topics:
+            self._topics[task_id] = TaskTopic(task_id)
+        return self._topics[task_id]
+
+    def publish(self, task_id: str, **changes: Any) -> Dict[str, Any]:
+        return self.topic(task_id).publish(changes)
+
+    def publish_frame(self, task_id: str, frame: bytes):
+        topic = self._topics.get(task_id)
+        if topic:
+            topic.publish_frame(frame)
+
+    def has_subscribers(self, task_id: str) -> bool:
+        topic = self._topics.get(task_id)
+        return bool(topic and topic.subscribers)
+
+    def subscribe(self, task_id: str) -> Subscription:
+        return self.topic(task_id).subscribe()
+
+    def remove(self, task_id: str):
+        """Forget a task's topic once nobody needs its updates any more."""
+        self._topics.pop(task_id, None)
@@ -0,0 +1,340 @@
+"""
+LLM Client Pool
+
+This module shares LLM clients between ComputerUseAgent instances. All
+clients send their requests through one keep-alive connection pool (HTTP/2
+when the h2 package is installed), so TLS handshakes and connection setup
+are not repeated for every task. Each API key gets its own concurrency and
+rate limit, and requests that are answered with 429 are retried with
+jittered backoff, honouring Retry-After.
+"""
+
+import asyncio
+import hashlib
+import importlib.util
+import logging
+import os
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import httpx
+from langchain_openai import ChatOpenAI
+from openai import AsyncOpenAI
+
+from .context import OptimizingCompletions
+
+logger = logging.getLogger(__name__)
+
+# Pool defaults, overridable through the environment
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE = int(os.environ.get("LLM_MAX_KEEPALIVE", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", "60"))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "120"))
+LLM_CONCURRENCY_PER_KEY = int(os.environ.get("LLM_CONCURRENCY_PER_KEY", "8"))
+LLM_REQUESTS_PER_MINUTE = float(os.environ.get("LLM_REQUESTS_PER_MINUTE", "0"))  # Per key; 0 disables the limit
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "4"))  # Retries after a 429
+LLM_RETRY_BASE_DELAY = float(os.environ.get("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.environ.get("LLM_RETRY_MAX_DELAY", "30"))
+
+# HTTP/2 needs the optional h2 package
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+def key_fingerprint(api_key: str) -> str:
+    """Short identifier for an API key that is safe to show in metrics."""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:8]
+
+
+@dataclass
+class KeyStats:
+    """Counters for one API key."""
+
+    requests: int = 0
+    retries: int = 0
+    rate_limited: int = 0
+    errors: int = 0
+    wait_seconds: float = 0.0
+
+
+class KeyLimiter:
+    """
+    Concurrency and rate limit for one API key.
+
+    Args:
+        max_concurrency: Requests in flight at the same time.
+        requests_per_minute: Requests started per minute, or 0 for no limit.
+    """
+
+    def __init__(self, max_concurrency: int = LLM_CONCURRENCY_PER_KEY, requests_per_minute: float = LLM_REQUESTS_PER_MINUTE):
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_interval = 60.0 / requests_per_minute if requests_per_minute > 0 else 0.0
+        self.in_flight = 0
+        self.waiting = 0
+        self.stats = KeyStats()
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._next_start = 0.0
+
+    async def acquire(self):
+        """Wait for a free slot and for the rate limit."""
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+            # Reserve the next start time before sleeping so that waiters are spaced out
+            now = time.monotonic()
+            start_at = max(now, self._next_start)
+            self._next_start = start_at + self.min_interval
+            if start_at > now:
+                try:
+                    await asyncio.sleep(start_at - now)
+                except BaseException:
+                    self._semaphore.release()
+                    raise
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        self.stats.requests += 1
+        self.stats.wait_seconds += time.monotonic() - started
+
+    def release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    def back_off(self, delay: float):
+        """Hold back every request of this key for a while, e.g. after a 429."""
+        self._next_start = max(self._next_start, time.monotonic() + delay)
+
+
+class _ReleaseOnClose(httpx.AsyncByteStream):
+    """Response body that frees the request's slot once it has been read or closed."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, release: Callable[[], None]):
+        self._stream = stream
+        self._release = release
+        self._released = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if not self._released:
+                self._released = True
+                self._release()
+
+
+def retry_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """
+    Delay before retrying a rate-limited request.
+
+    Args:
+        attempt: Number of retries so far.
+        retry_after: The Retry-After header, in seconds, if the server sent one.
+
+    Returns:
+        Seconds to wait: the server's delay plus some jitter, or exponential
+        backoff with full jitter.
+    """
+    if retry_after:
+        try:
+            return min(LLM_RETRY_MAX_DELAY, float(retry_after)) + random.uniform(0, LLM_RETRY_BASE_DELAY)
+        except ValueError:
+            pass
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+class LimitedTransport(httpx.AsyncBaseTransport):
+    """
+    Transport for one API key on top of the shared connection pool.
+
+    Applies the key's limits and retries 429 responses. Closing it leaves
+    the shared pool open.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, limiter: KeyLimiter, max_retries: int = LLM_MAX_RETRIES):
+        self._transport = transport
+        self.limiter = limiter
+        self.max_retries = max_retries
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            await self.limiter.acquire()
+            try:
+                response = await self._transport.handle_async_request(request)
+            except BaseException:
+                self.limiter.stats.errors += 1
+                self.limiter.release()
+                raise
+
+            if response.status_code != 429 or attempt == self.max_retries:
+                if response.status_code == 429:
+                    self.limiter.stats.rate_limited += 1
+                elif response.status_code >= 400:
+                    self.limiter.stats.errors += 1
+                return httpx.Response(
+                    status_code=response.status_code,
+                    headers=response.headers,
+                    stream=_ReleaseOnClose(response.stream, self.limiter.release),
+                    extensions=response.extensions,
+                )
+
+            await response.aclose()
+            self.limiter.release()
+            self.limiter.stats.rate_limited += 1
+            self.limiter.stats.retries += 1
+            delay = retry_delay(attempt, response.headers.get("retry-after"))
+            self.limiter.back_off(delay)
+            logger.info(f"LLM request rate limited, retrying in {delay:.1f}s (attempt {attempt + 1})")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def aclose(self):
+        pass
+
+
+class LLMClientPool:
+    """
+    Process-wide registry of LLM clients.
+
+    HTTP clients are shared per (provider, API key) and chat models per
+    (provider, API key, model); all of them use one connection pool.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = LLM_MAX_CONNECTIONS,
+        max_keepalive: int = LLM_MAX_KEEPALIVE,
+        keepalive_expiry: float = LLM_KEEPALIVE_EXPIRY,
+        timeout: float = LLM_TIMEOUT,
+        http2: bool = HTTP2_AVAILABLE,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(timeout, connect=10.0)
+        self.http2 = http2
+        self._transport: Optional[httpx.AsyncHTTPTransport] = None
+        self._clients: Dict[Tuple[str, str], httpx.AsyncClient] = {}
+        self._limiters: Dict[Tuple[str, str], KeyLimiter] = {}
+        self._models: Dict[Tuple[str, str, str], Any] = {}
+
+    def _shared_transport(self) -> httpx.AsyncHTTPTransport:
+        if self._transport is None:
+            self._transport = httpx.AsyncHTTPTransport(http2=self.http2, limits=self.limits)
+        return self._transport
+
+    def http_client(self, provider: str, api_key: str) -> httpx.AsyncClient:
+        """
+        Get the HTTP client for an API key.
+
+        Args:
+            provider: Name of the LLM provider, e.g. "openai".
+            api_key: The API key the client's requests are made with.
+
+        Returns:
+            An AsyncClient that applies the key's limits and shares the pool.
+        """
+        key = (provider, api_key)
+        if key not in self._clients:
+            self._limiters[key] = KeyLimiter()
+            self._clients[key] = httpx.AsyncClient(
+                transport=LimitedTransport(self._shared_transport(), self._limiters[key]),
+                timeout=self.timeout,
+            )
+        return self._clients[key]
+
+    def chat_openai(self, api_key: str, model: str = "gpt-4o", temperature: float = 0.0):
+        """
+        Get a shared ChatOpenAI model for an API key.
+
+        Args:
+            api_key: The OpenAI API key.
+            model: The model name.
+            temperature: Sampling temperature.
+
+        Returns:
+            A ChatOpenAI instance whose async requests go through the pool,
+            with the prompts and screenshots of the calling task optimized.
+        """
+        key = ("openai", api_key, f"{model}@{temperature}")
+        if key not in self._models:
+            async_client = AsyncOpenAI(api_key=api_key, http_client=self.http_client("openai", api_key))
+            self._models[key] = ChatOpenAI(
+                model=model,
+                openai_api_key=api_key,
+                temperature=temperature,
+                async_client=OptimizingCompletions(async_client.chat.completions),
+            )
+        return self._models[key]
+
+    def stats(self) -> Dict[str, Any]:
+        """Utilization of the connection pool and of every API key."""
+        pool = getattr(self._transport, "_pool", None)
+        connections = getattr(pool, "connections", None)
+        return {
+            "http2": self.http2,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "open_connections": len(connections) if connections is not None else None,
+            "models": len(self._models),
+            "keys": [
+                {
+                    "provider": provider,
+                    "key": key_fingerprint(api_key),
+                    "in_flight": limiter.in_flight,
+                    "waiting": limiter.waiting,
+                    "max_concurrency": limiter.max_concurrency,
+                    "utilization": limiter.in_flight / limiter.max_concurrency,
+                    "requests": limiter.stats.requests,
+                    "retries": limiter.stats.retries,
+                    "rate_limited": limiter.stats.rate_limited,
+                    "errors": limiter.stats.errors,
+                    "wait_seconds_total": round(limiter.stats.wait_seconds, 3),
+                }
+                for (provider, api_key), limiter in self._limiters.items()
+            ],
+        }
+
+    async def close(self):
+        """Close every client and the shared connection pool."""
+        clients = list(self._clients.values())
+        self._clients.clear()
+        self._limiters.clear()
+        self._models.clear()
+        for client in clients:
+            await client.aclose()
+        if self._transport is not None:
+            transport, self._transport = self._transport, None
+            await transport.aclose()
+
+
+_pool: Optional[LLMClientPool] = None
+
+
+def get_llm_pool() -> LLMClientPool:
+    """Get the process-wide LLM client pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        _pool = LLMClientPool()
+    return _pool
+
+
+async def close_llm_pool():
+    """Close the process-wide LLM client pool."""
+    global _pool
+    if _pool is not None:
+        pool, _pool = _pool, None
+        await pool.close()
+
+
+def llm_pool_stats() -> Dict[str, Any]:
+    """Utilization of the process-wide LLM client pool."""
+    return get_llm_pool().stats() if _pool is not None else {"keys": [], "models": 0}
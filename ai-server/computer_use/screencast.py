@@ -0,0 +1,314 @@
+"""
+Browser Screencast
+
+This module streams a live view of an agent's browser to viewers. Frames
+are only captured while at least one viewer is subscribed. Chromium's own
+screencast (which only emits frames when the page repaints) is preferred,
+with periodic compressed screenshots as a fallback. Unchanged frames are
+skipped, and the frame rate follows how fast viewers consume frames.
+"""
+
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Stream defaults, overridable through the environment
+SCREENCAST_FORMAT = os.environ.get("SCREENCAST_FORMAT", "jpeg")  # "jpeg" or "webp"
+SCREENCAST_QUALITY = int(os.environ.get("SCREENCAST_QUALITY", "60"))
+SCREENCAST_MAX_WIDTH = int(os.environ.get("SCREENCAST_MAX_WIDTH", "1280"))
+SCREENCAST_MAX_HEIGHT = int(os.environ.get("SCREENCAST_MAX_HEIGHT", "800"))
+SCREENCAST_MAX_FPS = float(os.environ.get("SCREENCAST_MAX_FPS", "10"))
+
+# How long to wait for a viewer before capturing the next frame anyway
+CONSUMER_TIMEOUT = 1.0
+
+# Frames of every screencast in this process, for metrics
+_totals = {"frames_captured": 0, "frames_skipped": 0, "bytes_captured": 0}
+
+
+@dataclass(frozen=True)
+class Frame:
+    """
+    An immutable encoded image with an ETag.
+
+    The bytes are never modified after creation, so the same frame can be
+    sent to any number of viewers concurrently without copying.
+    """
+
+    data: bytes
+    media_type: str
+    etag: str
+
+    @classmethod
+    def from_bytes(cls, data: bytes, media_type: str) -> "Frame":
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        return cls(data=data, media_type=media_type, etag=f'"{digest}"')
+
+
+class ScreencastSubscription:
+    """
+    A viewer of a screencast.
+
+    Only the latest frame is kept, so a slow viewer skips frames instead of
+    building up a backlog.
+    """
+
+    def __init__(self, screencast: "BrowserScreencast"):
+        self.screencast = screencast
+        self._frame: Optional[bytes] = None
+        self._ready = asyncio.Event()
+        self.closed = False
+
+    def push(self, frame: bytes):
+        self._frame = frame
+        self._ready.set()
+
+    async def next(self) -> Optional[bytes]:
+        """Wait for the next frame. Returns None once the subscription is closed."""
+        if self.closed:
+            return None
+        await self._ready.wait()
+        self._ready.clear()
+        frame, self._frame = self._frame, None
+        if frame is not None:
+            self.screencast._frame_consumed()
+        return frame
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        frame = await self.next()
+        if frame is None:
+            raise StopAsyncIteration
+        return frame
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._ready.set()
+            self.screencast.unsubscribe(self)
+
+
+class BrowserScreencast:
+    """
+    Live view of the current page of a browser.
+
+    Args:
+        get_page: Coroutine function returning the page to stream, or None.
+        format: "jpeg" uses Chromium's screencast; "webp" polls compressed
+            screenshots since the screencast only supports JPEG and PNG.
+        quality: Compression quality (0-100).
+        max_width: Frames are downscaled to at most this width.
+        max_height: Frames are downscaled to at most this height.
+        max_fps: Upper bound on the frame rate.
+        on_frame: Called with every new frame, e.g. to keep a still image.
+    """
+
+    def __init__(
+        self,
+        get_page: Callable[[], Awaitable[Any]],
+        format: str = SCREENCAST_FORMAT,
+        quality: int = SCREENCAST_QUALITY,
+        max_width: int = SCREENCAST_MAX_WIDTH,
+        max_height: int = SCREENCAST_MAX_HEIGHT,
+        max_fps: float = SCREENCAST_MAX_FPS,
+        on_frame: Optional[Callable[[Frame], None]] = None,
+    ):
+        self.get_page = get_page
+        self.on_frame = on_frame
+        self.format = format
+        self.quality = quality
+        self.max_width = max_width
+        self.max_height = max_height
+        self.min_interval = 1.0 / max_fps if max_fps > 0 else 0.0
+
+        self.last_frame: Optional[bytes] = None
+        self.frames_captured = 0
+        self.frames_skipped = 0
+        self._last_hash: Optional[str] = None
+        self._subscribers: Set[ScreencastSubscription] = set()
+        self._consumed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._use_screencast = format == "jpeg"
+
+    @property
+    def media_type(self) -> str:
+        return f"image/{self.format}"
+
+    @property
+    def viewers(self) -> int:
+        return len(self._subscribers)
+
+    def subscribe(self) -> ScreencastSubscription:
+        """Add a viewer and start capturing if it is the first one."""
+        subscription = ScreencastSubscription(self)
+        if self.last_frame is not None:
+            subscription.push(self.last_frame)
+        self._subscribers.add(subscription)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        return subscription
+
+    def unsubscribe(self, subscription: ScreencastSubscription):
+        """Remove a viewer and stop capturing when none are left."""
+        self._subscribers.discard(subscription)
+        if not self._subscribers and self._task:
+            self._task.cancel()
+            self._task = None
+
+    def close(self):
+        for subscription in list(self._subscribers):
+            subscription.close()
+
+    def _publish(self, frame: bytes) -> bool:
+        """Send a frame to all viewers unless it is identical to the previous one."""
+        digest = hashlib.blake2b(frame, digest_size=16).hexdigest()
+        if digest == self._last_hash:
+            self.frames_skipped += 1
+            _totals["frames_skipped"] += 1
+            return False
+        self._last_hash = digest
+        self.last_frame = frame
+        self.frames_captured += 1
+        _totals["frames_captured"] += 1
+        _totals["bytes_captured"] += len(frame)
+        self._consumed.clear()
+        for subscription in self._subscribers:
+            subscription.push(frame)
+        if self.on_frame:
+            self.on_frame(Frame(data=frame, media_type=self.media_type, etag=f'"{digest}"'))
+        return True
+
+    def _frame_consumed(self):
+        self._consumed.set()
+
+    async def _wait_for_consumer(self):
+        """Wait until a viewer has taken the latest frame, or give up after a while."""
+        try:
+            await asyncio.wait_for(self._consumed.wait(), timeout=CONSUMER_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        try:
+            while self._subscribers:
+                page = await self.get_page()
+                if page is None:
+                    await asyncio.sleep(CONSUMER_TIMEOUT)
+                    continue
+                try:
+                    if self._use_screencast:
+                        await self._stream_screencast(page)
+                    else:
+                        await self._stream_screenshots(page)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    if self._use_screencast:
+                        logger.info(f"Browser screencast unavailable, falling back to screenshots: {e}")
+                        self._use_screencast = False
+                    else:
+                        logger.debug(f"Error capturing browser frame: {e}")
+                        await asyncio.sleep(CONSUMER_TIMEOUT)
+        except asyncio.CancelledError:
+            pass
+
+    async def _stream_screencast(self, page):
+        """
+        Stream with Chromium's Page.startScreencast until the page changes.
+
+        Chromium sends a new frame only after the previous one has been
+        acknowledged, so acknowledgements are delayed until a viewer has
+        taken the frame and the frame rate limit allows another one.
+        """
+        cdp = await page.context.new_cdp_session(page)
+        pending_ack = {"session_id": None}
+        last_ack = 0.0
+
+        def on_frame(params):
+            pending_ack["session_id"] = params["sessionId"]
+            if not self._publish(base64.b64decode(params["data"])):
+                # Nothing new for viewers; acknowledge right away
+                self._consumed.set()
+
+        cdp.on("Page.screencastFrame", on_frame)
+        await cdp.send(
+            "Page.startScreencast",
+            {
+                "format": "jpeg",
+                "quality": self.quality,
+                "maxWidth": self.max_width,
+                "maxHeight": self.max_height,
+            },
+        )
+        try:
+            while self._subscribers and await self.get_page() is page:
+                await self._wait_for_consumer()
+                session_id = pending_ack["session_id"]
+                if session_id is None:
+                    continue
+                delay = last_ack + self.min_interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                pending_ack["session_id"] = None
+                await cdp.send("Page.screencastFrameAck", {"sessionId": session_id})
+                last_ack = time.monotonic()
+        finally:
+            try:
+                await cdp.send("Page.stopScreencast")
+                await cdp.detach()
+            except Exception:
+                pass
+
+    async def _stream_screenshots(self, page):
+        """Poll compressed screenshots until the page changes."""
+        try:
+            cdp = await page.context.new_cdp_session(page)
+        except Exception:
+            # Not a Chromium browser; use Playwright's JPEG screenshots
+            cdp = None
+            self.format = "jpeg"
+
+        try:
+            while self._subscribers and await self.get_page() is page:
+                started = time.monotonic()
+                if self._publish(await self._capture(page, cdp)):
+                    await self._wait_for_consumer()
+                delay = started + self.min_interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        finally:
+            if cdp is not None:
+                try:
+                    await cdp.detach()
+                except Exception:
+                    pass
+
+    async def _capture(self, page, cdp) -> bytes:
+        if cdp is None:
+            return await page.screenshot(type="jpeg", quality=self.quality)
+
+        viewport = page.viewport_size or {"width": self.max_width, "height": self.max_height}
+        scale = min(1.0, self.max_width / viewport["width"], self.max_height / viewport["height"])
+        result = await cdp.send(
+            "Page.captureScreenshot",
+            {
+                "format": self.format,
+                "quality": self.quality,
+                "clip": {"x": 0, "y": 0, "width": viewport["width"], "height": viewport["height"], "scale": scale},
+            },
+        )
+        return base64.b64decode(result["data"])
+
+
+def screencast_stats() -> Dict[str, int]:
+    """Frames captured and skipped by every screencast in this process."""
+    return dict(_totals)
@@ -7,7 +7,10 @@ AI-controlled computer usage within our application.
 
 import os
 import asyncio
-from typing import Dict, Any, Optional, List
+import base64
+import inspect
+from contextlib import contextmanager
+from typing import Callable, Dict, Any, Optional, List
 import logging
 
 from langchain_openai import ChatOpenAI
@@ -16,10 +19,33 @@ from langchain.schema import HumanMessage
 
 # Import browser-use components
 from browser_use import Agent, Browser, BrowserConfig, Controller
+from .browser_pool import BrowserLease, get_browser_pool
 from .config import ComputerUseConfig
+from .deepseek import DeepSeekChatModel
+from .llm_pool import get_llm_pool
+from .timings import StepTimings, current_step_timings, instrument_method, span
+from .context import ContextCompactor, OptimizingCompletions, current_context_compactor
+from .vision import VisionOptimizer, current_vision_optimizer, estimate_image_tokens
 
 logger = logging.getLogger(__name__)
 
+# browser-use methods timed as spans, where the installed version has them; capturing
+# the state includes waiting for the page to load, so those spans overlap
+BROWSER_SPANS = {
+    "get_state": "state",
+    "get_state_summary": "state",
+    "take_screenshot": "screenshot",
+    "_wait_for_page_and_frames_load": "page_load",
+}
+
+class TimedController(Controller):
+    """Controller that records every action it runs as a span."""
+    
+    async def act(self, action, *args, **kwargs):
+        action_type = next(iter(action.model_dump(exclude_unset=True)), None)
+        with span("action", type=action_type):
+            return await super().act(action, *args, **kwargs)
+
 class ComputerUseAgent:
     """
     Agent for computer use capabilities powered by browser-use.
@@ -34,16 +60,52 @@ class ComputerUseAgent:
         """
         self.config = config or ComputerUseConfig()
         self.llm = self._initialize_llm()
-        self.controller = Controller()
-        self.browser = Browser(
-            config=BrowserConfig(
-                headless=self.config.headless,
-                viewport_width=self.config.viewport_width,
-                viewport_height=self.config.viewport_height,
+        # Shrinks the screenshots this agent sends through the pooled OpenAI client
+        self.vision_optimizer: Optional[VisionOptimizer] = None
+        if self.config.optimize_vision:
+            self.vision_optimizer = VisionOptimizer(
+                max_width=self.config.vision_max_width,
+                max_height=self.config.vision_max_height,
+                jpeg_quality=self.config.vision_jpeg_quality,
+                skip_unchanged=self.config.vision_skip_unchanged,
+                hash_threshold=self.config.vision_hash_threshold,
+                crop_changes=self.config.vision_crop_changes,
+                crop_max_fraction=self.config.vision_crop_max_fraction,
+            )
+        # Keeps the prompt of every step within a token budget
+        self.context_compactor: Optional[ContextCompactor] = None
+        if self.config.compact_context:
+            if self.vision_optimizer:
+                image_size = (self.config.vision_max_width, self.config.vision_max_height)
+            else:
+                image_size = (self.config.viewport_width, self.config.viewport_height)
+            self.context_compactor = ContextCompactor(
+                token_budget=self.config.context_token_budget,
+                recent_messages=self.config.context_recent_messages,
+                recent_steps=self.config.context_recent_steps,
+                image_tokens=estimate_image_tokens(*image_size),
+            )
+        self.controller = TimedController()
+        self.timings = StepTimings()
+        # With the browser pool enabled the browser is leased in create_agent
+        self.browser = None
+        self.browser_context = None
+        self._lease: Optional[BrowserLease] = None
+        if not self.config.use_browser_pool:
+            self.browser = Browser(
+                config=BrowserConfig(
+                    headless=self.config.headless,
+                    viewport_width=self.config.viewport_width,
+                    viewport_height=self.config.viewport_height,
+                )
             )
-        )
         self.agent = None
-        self._paused = False
+        # Set while the agent may run; cleared by pause()
+        self._resumed = asyncio.Event()
+        self._resumed.set()
+        self._stopped = asyncio.Event()
+        self._run_future: Optional[asyncio.Future] = None
+        self._step_listeners: List[Callable[[Dict[str, Any]], None]] = []
         
     def _initialize_llm(self) -> BaseChatModel:
         """
@@ -59,12 +121,17 @@ class ComputerUseAgent:
                 
             if not api_key:
                 raise ValueError("OpenAI API key not found. Please set it in the config or VITE_OPENAI_API_KEY environment variable.")
+            
+            if self.config.use_llm_pool:
+                return get_llm_pool().chat_openai(api_key=api_key, model="gpt-4o", temperature=0.0)
                 
-            return ChatOpenAI(
+            llm = ChatOpenAI(
                 model="gpt-4o",
                 openai_api_key=api_key,
                 temperature=0.0
             )
+            llm.async_client = OptimizingCompletions(llm.async_client)
+            return llm
         elif self.config.provider == "deepseek":
             # DeepSeek integration
             api_key = self.config.deepseek_api_key
@@ -79,29 +146,17 @@ class ComputerUseAgent:
             if not api_key or not endpoint:
                 raise ValueError("DeepSeek API key or endpoint not found. Please set them in the config or environment variables.")
                 
-            # Placeholder for DeepSeek integration
-            # In the future, we'll implement a proper DeepSeek LLM adapter
-            try:
-                from langchain.chat_models.base import BaseChatModel
-                
-                class DeepSeekChatModel(BaseChatModel):
-                    """Custom LangChain model for DeepSeek integration."""
-                    
-                    def __init__(self, api_key: str, endpoint: str):
-                        super().__init__()
-                        self.api_key = api_key
-                        self.endpoint = endpoint
-                    
-                    def _generate(self, messages, stop=None, **kwargs):
-                        raise NotImplementedError("DeepSeek integration is still under development")
-                    
-                    async def _agenerate(self, messages, stop=None, **kwargs):
-                        raise NotImplementedError("DeepSeek integration is still under development")
-                
-                return DeepSeekChatModel(api_key=api_key, endpoint=endpoint)
-            except Exception as e:
-                logger.error(f"Failed to initialize DeepSeek model: {e}")
-                raise ValueError(f"DeepSeek integration is not yet fully implemented: {e}")
+            # Our own inference server (server.py) or a compatible endpoint
+            return DeepSeekChatModel(
+                api_key=api_key,
+                endpoint=endpoint,
+                adapter=self.config.deepseek_adapter,
+                max_tokens=self.config.deepseek_max_tokens,
+                temperature=self.config.deepseek_temperature,
+                top_p=self.config.deepseek_top_p,
+                timeout=self.config.deepseek_timeout,
+                streaming=self.config.deepseek_streaming,
+            )
         
         raise ValueError(f"Unsupported provider: {self.config.provider}")
     
@@ -115,36 +170,184 @@ class ComputerUseAgent:
         Returns:
             A configured Agent instance.
         """
+        if self.config.use_browser_pool and self._lease is None:
+            pool = get_browser_pool(
+                headless=self.config.headless,
+                viewport_width=self.config.viewport_width,
+                viewport_height=self.config.viewport_height,
+            )
+            self._lease = await pool.acquire()
+            self.browser = self._lease.browser
+            self.browser_context = self._lease.context
+
+        # browser-use asks the LLM for actions through with_structured_output; for
+        # DeepSeek that parses the JSON the model writes, since the server has no tool calling
         self.agent = Agent(
             task=task,
             llm=self.llm,
             controller=self.controller,
             browser=self.browser,
-            use_vision=self.config.use_vision,
+            browser_context=self.browser_context,
+            # The DeepSeek server only takes text
+            use_vision=self.config.use_vision and self.config.provider != "deepseek",
             max_actions_per_step=1,
+            register_new_step_callback=self._on_new_step,
         )
+        
+        browser = self.browser_context or getattr(self.agent, "browser_context", None) or getattr(self.agent, "browser_session", None)
+        if browser is not None:
+            for method, name in BROWSER_SPANS.items():
+                instrument_method(browser, method, name)
         return self.agent
     
+    async def get_current_page(self):
+        """
+        Get the page the agent is currently working on.
+        
+        Returns:
+            The Playwright page, or None if the browser has not started yet.
+        """
+        context = self.browser_context or getattr(self.agent, "browser_context", None)
+        # Asking an unopened context for a page would launch a browser
+        if context is None or getattr(context, "session", None) is None:
+            return None
+        try:
+            return await context.get_current_page()
+        except Exception as e:
+            logger.debug(f"Could not get current page: {e}")
+            return None
+    
+    def add_step_listener(self, listener: Callable[[Dict[str, Any]], None]):
+        """
+        Register a callback that is called after every agent step.
+        
+        Args:
+            listener: Called with a dict containing the step number, the
+                current URL, the agent's reasoning, the chosen actions, the
+                screenshot (PNG bytes) if one was taken and the vision and
+                context counters.
+        """
+        self._step_listeners.append(listener)
+    
+    def _on_new_step(self, state, model_output, step: int):
+        """Summarize a browser-use step and pass it to the step listeners."""
+        update: Dict[str, Any] = {"step": step, "url": getattr(state, "url", None)}
+        
+        current_state = getattr(model_output, "current_state", None)
+        if current_state is not None:
+            parts = [
+                ("Evaluation", getattr(current_state, "evaluation_previous_goal", None)),
+                ("Memory", getattr(current_state, "memory", None)),
+                ("Next goal", getattr(current_state, "next_goal", None)),
+            ]
+            update["reasoning"] = "\n".join(f"{label}: {value}" for label, value in parts if value)
+        
+        actions = getattr(model_output, "action", None) or []
+        update["actions"] = [
+            next(iter(action.model_dump(exclude_unset=True)), None) for action in actions
+        ]
+        
+        screenshot = getattr(state, "screenshot", None)
+        if screenshot:
+            update["screenshot"] = base64.b64decode(screenshot)
+        self.timings.end_step(step, update["url"], len(update["screenshot"]) if screenshot else None)
+        update["vision"] = self.vision_stats()
+        update["context"] = self.context_stats()
+        
+        for listener in self._step_listeners:
+            try:
+                listener(update)
+            except Exception as e:
+                logger.error(f"Error in step listener: {e}", exc_info=True)
+    
+    @contextmanager
+    def _task_context(self):
+        """Set the context variables through which shared clients find this agent's compactor, optimizer and timings."""
+        tokens = [
+            (current_context_compactor, current_context_compactor.set(self.context_compactor)),
+            (current_vision_optimizer, current_vision_optimizer.set(self.vision_optimizer)),
+            (current_step_timings, current_step_timings.set(self.timings)),
+        ]
+        try:
+            yield
+        finally:
+            for variable, token in reversed(tokens):
+                variable.reset(token)
+    
+    def vision_stats(self) -> Optional[Dict[str, Any]]:
+        """Screenshots sent so far and the bytes and image tokens saved, or None if vision optimization is off."""
+        return self.vision_optimizer.stats.to_dict() if self.vision_optimizer else None
+    
+    def context_stats(self) -> Optional[Dict[str, Any]]:
+        """Prompt sizes so far and the tokens saved by compaction, or None if compaction is off."""
+        return self.context_compactor.stats.to_dict() if self.context_compactor else None
+    
+    @property
+    def paused(self) -> bool:
+        return not self._resumed.is_set()
+    
+    @property
+    def stopped(self) -> bool:
+        return self._stopped.is_set()
+    
+    async def wait_until_resumed(self):
+        """Wait until the agent is not paused."""
+        await self._resumed.wait()
+    
+    async def wait_until_stopped(self):
+        """Wait until stop() has been called."""
+        await self._stopped.wait()
+    
+    async def _signal_agent(self, method: str):
+        """Call a browser-use control method, which is synchronous in some versions and async in others."""
+        signal = getattr(self.agent, method, None)
+        if callable(signal):
+            result = signal()
+            if inspect.isawaitable(result):
+                await result
+    
     async def run(self, task: str) -> Dict[str, Any]:
         """
         Run the agent to perform the specified task.
         
+        The run ends early, without an error, if stop() is called.
+        
         Args:
             task: The task description for the agent to perform.
             
         Returns:
             Results from the agent's execution.
         """
+        if self.stopped:
+            return {"success": False, "stopped": True, "error": "Agent was stopped", "history": []}
+        
         if not self.agent or self.agent.task != task:
             self.agent = await self.create_agent(task)
+        if self.paused:
+            # Paused before the browser-use agent existed
+            await self._signal_agent("pause")
         
+        # Run in a separate task so that stop() can cancel it. The task copies the
+        # context, which tells the shared LLM client and browser whose task it is.
+        with self._task_context():
+            self._run_future = asyncio.ensure_future(self.agent.run(max_steps=self.config.max_steps))
         try:
-            result = await self.agent.run(max_steps=self.config.max_steps)
+            result = await self._run_future
             return {
                 "success": True,
                 "result": result,
                 "history": self.agent.history,
             }
+        except asyncio.CancelledError:
+            if not self.stopped:
+                raise
+            logger.info("Agent stopped")
+            return {
+                "success": False,
+                "stopped": True,
+                "error": "Agent was stopped",
+                "history": self.agent.history,
+            }
         except Exception as e:
             logger.error(f"Error running agent: {e}", exc_info=True)
             return {
@@ -152,6 +355,9 @@ class ComputerUseAgent:
                 "error": str(e),
                 "history": self.agent.history if self.agent else []
             }
+        finally:
+            self._run_future = None
+            self.timings.finish()
     
     async def pause(self) -> bool:
         """
@@ -160,13 +366,12 @@ class ComputerUseAgent:
         Returns:
             True if the agent was paused, False otherwise.
         """
+        self._resumed.clear()
         if not self.agent:
             return False
             
-        self._paused = True
         # Signal the agent to pause
-        if hasattr(self.agent, "pause") and callable(getattr(self.agent, "pause")):
-            await self.agent.pause()
+        await self._signal_agent("pause")
         return True
         
     async def resume(self) -> bool:
@@ -176,28 +381,31 @@ class ComputerUseAgent:
         Returns:
             True if the agent was resumed, False otherwise.
         """
+        self._resumed.set()
         if not self.agent:
             return False
             
-        self._paused = False
         # Signal the agent to resume
-        if hasattr(self.agent, "resume") and callable(getattr(self.agent, "resume")):
-            await self.agent.resume()
+        await self._signal_agent("resume")
         return True
         
     async def stop(self) -> bool:
         """
-        Stop the current agent execution.
+        Stop the current agent execution by cancelling its run.
         
         Returns:
             True if the agent was stopped, False otherwise.
         """
+        self._stopped.set()
+        # Let anything waiting for a resume notice the stop
+        self._resumed.set()
         if not self.agent:
             return False
             
-        # Signal the agent to stop
-        if hasattr(self.agent, "stop") and callable(getattr(self.agent, "stop")):
-            await self.agent.stop()
+        # Signal the agent to stop, then cancel whatever step it is in
+        await self._signal_agent("stop")
+        if self._run_future and not self._run_future.done():
+            self._run_future.cancel()
         return True
     
     async def add_user_message(self, message: str) -> bool:
@@ -234,6 +442,11 @@ class ComputerUseAgent:
             return False
     
     async def close(self):
-        """Close the browser and release resources."""
-        if self.browser:
+        """Return the browser to the pool (or close it) and release resources."""
+        if self._lease:
+            lease, self._lease = self._lease, None
+            self.browser = None
+            self.browser_context = None
+            await lease.release()
+        elif self.browser:
             await self.browser.close() 
\ No newline at end of file
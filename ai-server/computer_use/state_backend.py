@@ -0,0 +1,320 @@
+"""
+State Backend
+
+This module shares computer use task state between server workers so the
+apps can run with ``uvicorn --workers N`` or as several replicas. Each worker
+publishes the state of the tasks it runs, and control commands (pause,
+resume, stop, message) for a task are routed to the worker that owns it.
+
+Backends are selected with STATE_BACKEND:
+
+- ``memory`` (default): a single process; nothing is shared.
+- ``sqlite:///path/to/state.sqlite3``: workers on the same host.
+- ``redis://host:6379/0``: workers on any number of hosts. Requires the
+  ``redis`` package.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from .task_store import TASK_ARCHIVE_TTL, to_jsonable
+
+logger = logging.getLogger(__name__)
+
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")
+# Seconds between checks for control commands in the SQLite backend
+CONTROL_POLL_INTERVAL = float(os.environ.get("STATE_CONTROL_POLL_INTERVAL", "0.2"))
+
+# Identifies this worker process in task ownership and control routing
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class StateBackend:
+    """
+    Interface for shared task state.
+
+    Records are the JSON-serializable part of a task's state. Finished
+    records expire after ``finished_ttl`` seconds.
+    """
+
+    # Whether other workers can see what this backend stores
+    shared = True
+
+    def __init__(self, finished_ttl: float = TASK_ARCHIVE_TTL):
+        self.finished_ttl = finished_ttl
+
+    async def save_task(self, task_id: str, record: Dict[str, Any], owner: str, finished: bool = False):
+        """Store a task's state and the worker that owns it."""
+        raise NotImplementedError
+
+    async def load_task(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """Get a task's state, or None if it is unknown."""
+        raise NotImplementedError
+
+    async def task_owner(self, task_id: str) -> Optional[str]:
+        """Get the ID of the worker running a task."""
+        raise NotImplementedError
+
+    async def list_tasks(self, offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """List task states, most recently created first, so that offsets stay stable."""
+        raise NotImplementedError
+
+    async def send_control(self, worker_id: str, command: Dict[str, Any]):
+        """Deliver a control command to a worker."""
+        raise NotImplementedError
+
+    def control_messages(self, worker_id: str) -> AsyncIterator[Dict[str, Any]]:
+        """Yield control commands sent to a worker, in order."""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    @staticmethod
+    def _dumps(record: Dict[str, Any]) -> str:
+        return json.dumps(record, default=to_jsonable)
+
+
+class MemoryStateBackend(StateBackend):
+    """
+    Backend for a single worker process.
+
+    Task state already lives in the worker's own task store, so nothing is
+    stored here and control commands never need to be routed.
+    """
+
+    shared = False
+
+    def __init__(self, finished_ttl: float = TASK_ARCHIVE_TTL):
+        super().__init__(finished_ttl)
+        self._queues: Dict[str, asyncio.Queue] = {}
+
+    async def save_task(self, task_id: str, record: Dict[str, Any], owner: str, finished: bool = False):
+        pass
+
+    async def load_task(self, task_id: str) -> Optional[Dict[str, Any]]:
+        return None
+
+    async def task_owner(self, task_id: str) -> Optional[str]:
+        return None
+
+    async def list_tasks(self, offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        return []
+
+    async def send_control(self, worker_id: str, command: Dict[str, Any]):
+        await self._queue(worker_id).put(command)
+
+    async def control_messages(self, worker_id: str) -> AsyncIterator[Dict[str, Any]]:
+        queue = self._queue(worker_id)
+        while True:
+            yield await queue.get()
+
+    def _queue(self, worker_id: str) -> asyncio.Queue:
+        if worker_id not in self._queues:
+            self._queues[worker_id] = asyncio.Queue()
+        return self._queues[worker_id]
+
+
+class SQLiteStateBackend(StateBackend):
+    """Backend for several workers on the same host, sharing one SQLite file."""
+
+    def __init__(self, path: str, finished_ttl: float = TASK_ARCHIVE_TTL):
+        super().__init__(finished_ttl)
+        self.path = path
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS task_state ("
+            "task_id TEXT PRIMARY KEY, record TEXT NOT NULL, owner TEXT NOT NULL, "
+            "updated_at REAL NOT NULL, expires_at REAL, created_at REAL)"
+        )
+        if "created_at" not in {row[1] for row in self._conn.execute("PRAGMA table_info(task_state)")}:
+            # Files written before tasks were listed by creation time
+            self._conn.execute("ALTER TABLE task_state ADD COLUMN created_at REAL")
+            self._conn.execute("UPDATE task_state SET created_at = updated_at")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS task_state_updated ON task_state (updated_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS task_state_created ON task_state (created_at)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS control ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, worker_id TEXT NOT NULL, command TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS control_worker ON control (worker_id, id)")
+        self._conn.commit()
+
+    async def _run(self, fn, *args):
+        def locked():
+            with self._lock:
+                return fn(*args)
+
+        return await asyncio.to_thread(locked)
+
+    async def save_task(self, task_id: str, record: Dict[str, Any], owner: str, finished: bool = False):
+        now = time.time()
+        expires_at = now + self.finished_ttl if finished else None
+        data = self._dumps(record)
+
+        def save():
+            # The first save of a task records when it was created
+            self._conn.execute(
+                "INSERT INTO task_state (task_id, record, owner, updated_at, expires_at, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (task_id) DO UPDATE SET "
+                "record = excluded.record, owner = excluded.owner, "
+                "updated_at = excluded.updated_at, expires_at = excluded.expires_at",
+                (task_id, data, owner, now, expires_at, now),
+            )
+            self._conn.execute("DELETE FROM task_state WHERE expires_at < ?", (now,))
+            self._conn.commit()
+
+        await self._run(save)
+
+    async def load_task(self, task_id: str) -> Optional[Dict[str, Any]]:
+        row = await self._run(self._select, "record", task_id)
+        return json.loads(row[0]) if row else None
+
+    async def task_owner(self, task_id: str) -> Optional[str]:
+        row = await self._run(self._select, "owner", task_id)
+        return row[0] if row else None
+
+    def _select(self, column: str, task_id: str):
+        return self._conn.execute(
+            f"SELECT {column} FROM task_state WHERE task_id = ? AND (expires_at IS NULL OR expires_at >= ?)",
+            (task_id, time.time()),
+        ).fetchone()
+
+    async def list_tasks(self, offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        def select():
+            return self._conn.execute(
+                "SELECT record FROM task_state WHERE expires_at IS NULL OR expires_at >= ? "
+                "ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                (time.time(), -1 if limit is None else limit, offset),
+            ).fetchall()
+
+        return [json.loads(row[0]) for row in await self._run(select)]
+
+    async def send_control(self, worker_id: str, command: Dict[str, Any]):
+        def insert():
+            self._conn.execute(
+                "INSERT INTO control (worker_id, command) VALUES (?, ?)", (worker_id, json.dumps(command))
+            )
+            self._conn.commit()
+
+        await self._run(insert)
+
+    async def control_messages(self, worker_id: str) -> AsyncIterator[Dict[str, Any]]:
+        def take():
+            rows = self._conn.execute(
+                "SELECT id, command FROM control WHERE worker_id = ? ORDER BY id", (worker_id,)
+            ).fetchall()
+            if rows:
+                self._conn.execute("DELETE FROM control WHERE worker_id = ? AND id <= ?", (worker_id, rows[-1][0]))
+                self._conn.commit()
+            return rows
+
+        while True:
+            rows = await self._run(take)
+            for _, command in rows:
+                yield json.loads(command)
+            if not rows:
+                await asyncio.sleep(CONTROL_POLL_INTERVAL)
+
+    async def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisStateBackend(StateBackend):
+    """
+    Backend for workers on any number of hosts, using a Redis-protocol server.
+
+    Control commands are pushed onto a list per worker and received with a
+    blocking pop, so idle workers do not poll.
+    """
+
+    def __init__(self, url: str, finished_ttl: float = TASK_ARCHIVE_TTL, prefix: str = "ai-server:"):
+        super().__init__(finished_ttl)
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("The Redis state backend requires the redis package (pip install redis)") from e
+        self.url = url
+        self.prefix = prefix
+        self._redis = redis.from_url(url)
+
+    def _key(self, *parts: str) -> str:
+        return self.prefix + ":".join(parts)
+
+    async def save_task(self, task_id: str, record: Dict[str, Any], owner: str, finished: bool = False):
+        ttl = int(self.finished_ttl) if finished else None
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.set(self._key("task", task_id), self._dumps(record), ex=ttl)
+            pipe.set(self._key("owner", task_id), owner, ex=ttl)
+            # Scored by the first save, when the task was created
+            pipe.zadd(self._key("tasks"), {task_id: time.time()}, nx=True)
+            await pipe.execute()
+
+    async def load_task(self, task_id: str) -> Optional[Dict[str, Any]]:
+        data = await self._redis.get(self._key("task", task_id))
+        return json.loads(data) if data else None
+
+    async def task_owner(self, task_id: str) -> Optional[str]:
+        owner = await self._redis.get(self._key("owner", task_id))
+        return owner.decode() if isinstance(owner, bytes) else owner
+
+    async def list_tasks(self, offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        end = -1 if limit is None else offset + limit - 1
+        task_ids = await self._redis.zrevrange(self._key("tasks"), offset, end)
+        if not task_ids:
+            return []
+        task_ids = [task_id.decode() if isinstance(task_id, bytes) else task_id for task_id in task_ids]
+        records = await self._redis.mget([self._key("task", task_id) for task_id in task_ids])
+
+        # Expired records leave their ID behind in the sorted set
+        expired = [task_id for task_id, data in zip(task_ids, records) if data is None]
+        if expired:
+            await self._redis.zrem(self._key("tasks"), *expired)
+        return [json.loads(data) for data in records if data is not None]
+
+    async def send_control(self, worker_id: str, command: Dict[str, Any]):
+        await self._redis.rpush(self._key("control", worker_id), json.dumps(command))
+
+    async def control_messages(self, worker_id: str) -> AsyncIterator[Dict[str, Any]]:
+        key = self._key("control", worker_id)
+        while True:
+            item = await self._redis.blpop([key], timeout=0)
+            if item:
+                yield json.loads(item[1])
+
+    async def close(self):
+        await self._redis.close()
+
+
+def create_state_backend(url: str = STATE_BACKEND) -> StateBackend:
+    """
+    Create the state backend described by a URL.
+
+    Args:
+        url: "memory", "sqlite:///path" or "redis://host:port/db".
+
+    Returns:
+        The configured backend.
+    """
+    if url == "memory":
+        return MemoryStateBackend()
+    if url.startswith("sqlite:///"):
+        return SQLiteStateBackend(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStateBackend(url)
+    raise ValueError(f"Unsupported state backend: {url}")
@@ -0,0 +1,219 @@
+"""
+Task Scheduler
+
+This module limits how many computer use agents run at the same time.
+Tasks beyond the limit wait in a bounded queue. The queue is ordered by
+priority, and tasks with equal priority are served round-robin across API
+keys so that one client cannot starve the others.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Scheduler defaults, overridable through the environment
+MAX_CONCURRENT_TASKS = int(os.environ.get("MAX_CONCURRENT_TASKS", "4"))
+MAX_QUEUED_TASKS = int(os.environ.get("MAX_QUEUED_TASKS", "32"))
+
+
+class TaskQueueFullError(RuntimeError):
+    """Raised when a task is submitted while the queue is at its limit."""
+
+
+@dataclass
+class ScheduledTask:
+    """A task known to the scheduler and its timing information."""
+
+    task_id: str
+    run: Callable[[], Awaitable[Any]]
+    owner: str
+    priority: int = 0
+    status: str = "queued"  # "queued", "running", "finished" or "cancelled"
+    submitted_at: float = field(default_factory=time.monotonic)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    future: Optional[asyncio.Future] = None
+
+    @property
+    def queue_wait(self) -> float:
+        """Seconds spent waiting in the queue so far."""
+        end = self.started_at or self.finished_at or time.monotonic()
+        return end - self.submitted_at
+
+    @property
+    def run_time(self) -> Optional[float]:
+        """Seconds spent running so far, or None if the task never started."""
+        if self.started_at is None:
+            return None
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+
+# A waiting task in its owner's heap: (-priority, submission order, task)
+QueueEntry = Tuple[int, int, ScheduledTask]
+
+
+class TaskScheduler:
+    """
+    Admission control for computer use tasks.
+
+    At most ``max_concurrent`` tasks run at once. Up to ``max_queued`` more
+    wait in the queue; further submissions raise TaskQueueFullError.
+    """
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_TASKS, max_queued: int = MAX_QUEUED_TASKS):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queued = max_queued
+        self._tasks: Dict[str, ScheduledTask] = {}
+        # Heaps of waiting tasks per owner, keyed on (-priority, submission order),
+        # and the owners in round-robin order
+        self._queues: "OrderedDict[str, List[QueueEntry]]" = OrderedDict()
+        self._sequence = itertools.count()
+        self._queued = 0
+        self._running = 0
+
+    def submit(
+        self,
+        task_id: str,
+        run: Callable[[], Awaitable[Any]],
+        owner: Optional[str] = None,
+        priority: int = 0,
+    ) -> ScheduledTask:
+        """
+        Queue a task and start it as soon as a slot is free.
+
+        Args:
+            task_id: The ID of the task.
+            run: Callable returning the coroutine that runs the task.
+            owner: Key used for fairness, typically the client's API key.
+            priority: Higher priorities are started first.
+
+        Returns:
+            The scheduled task.
+
+        Raises:
+            TaskQueueFullError: If the queue is full.
+        """
+        if self._running >= self.max_concurrent and self._queued >= self.max_queued:
+            raise TaskQueueFullError(f"Task queue is full ({self.max_queued} tasks waiting)")
+
+        scheduled = ScheduledTask(task_id=task_id, run=run, owner=owner or "anonymous", priority=priority)
+        self._tasks[task_id] = scheduled
+        heapq.heappush(self._queues.setdefault(scheduled.owner, []), (-priority, next(self._sequence), scheduled))
+        self._queued += 1
+        self._dispatch()
+        return scheduled
+
+    def cancel(self, task_id: str, running: bool = True) -> bool:
+        """
+        Remove a queued task or cancel a running one.
+
+        Args:
+            task_id: The ID of the task.
+            running: Whether to cancel the task if it has already started.
+
+        Returns:
+            True if the task was removed or cancelled, False otherwise.
+        """
+        scheduled = self._tasks.get(task_id)
+        if scheduled is None:
+            return False
+        if scheduled.status == "queued":
+            queue = self._queues[scheduled.owner]
+            queue[:] = [entry for entry in queue if entry[2] is not scheduled]
+            heapq.heapify(queue)
+            if not queue:
+                del self._queues[scheduled.owner]
+            self._queued -= 1
+            scheduled.status = "cancelled"
+            scheduled.finished_at = time.monotonic()
+            return True
+        if running and scheduled.status == "running" and scheduled.future:
+            scheduled.future.cancel()
+            return True
+        return False
+
+    def forget(self, task_id: str):
+        """Drop the bookkeeping for a finished or cancelled task."""
+        scheduled = self._tasks.get(task_id)
+        if scheduled and scheduled.status in ("finished", "cancelled"):
+            del self._tasks[task_id]
+
+    def queue_position(self, task_id: str) -> Optional[int]:
+        """1-based position in the queue, or None if the task is not queued."""
+        for position, scheduled in enumerate(self._dispatch_order(), start=1):
+            if scheduled.task_id == task_id:
+                return position
+        return None
+
+    def info(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """Scheduling status and timing for a task."""
+        scheduled = self._tasks.get(task_id)
+        if scheduled is None:
+            return None
+        return {
+            "status": scheduled.status,
+            "priority": scheduled.priority,
+            "queue_position": self.queue_position(task_id) if scheduled.status == "queued" else None,
+            "queue_wait_seconds": scheduled.queue_wait,
+            "run_seconds": scheduled.run_time,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._running,
+            "queued": self._queued,
+            "max_concurrent": self.max_concurrent,
+            "max_queued": self.max_queued,
+        }
+
+    def _dispatch_order(self) -> Iterator[ScheduledTask]:
+        """Yield queued tasks in the order they would be started."""
+        queues = OrderedDict((owner, list(queue)) for owner, queue in self._queues.items())
+        while queues:
+            owner = self._next_owner(queues)
+            queue = queues.pop(owner)
+            yield heapq.heappop(queue)[2]
+            if queue:
+                queues[owner] = queue
+
+    @staticmethod
+    def _next_owner(queues: "OrderedDict[str, List[QueueEntry]]") -> str:
+        # Each heap's head is the owner's highest priority task; the owner
+        # served least recently wins ties
+        return max(enumerate(queues), key=lambda item: (-queues[item[1]][0][0], -item[0]))[1]
+
+    def _dispatch(self):
+        """Start queued tasks while there are free slots."""
+        while self._queues and self._running < self.max_concurrent:
+            owner = self._next_owner(self._queues)
+            queue = self._queues.pop(owner)
+            scheduled = heapq.heappop(queue)[2]
+            if queue:
+                # Re-inserting moves the owner to the back of the round-robin order
+                self._queues[owner] = queue
+            self._queued -= 1
+            self._start(scheduled)
+
+    def _start(self, scheduled: ScheduledTask):
+        scheduled.status = "running"
+        scheduled.started_at = time.monotonic()
+        self._running += 1
+        logger.info(f"Starting task {scheduled.task_id} after {scheduled.queue_wait:.2f}s in queue")
+        scheduled.future = asyncio.ensure_future(scheduled.run())
+        scheduled.future.add_done_callback(lambda _: self._finish(scheduled))
+
+    def _finish(self, scheduled: ScheduledTask):
+        scheduled.status = "cancelled" if scheduled.future.cancelled() else "finished"
+        scheduled.finished_at = time.monotonic()
+        self._running -= 1
+        if not scheduled.future.cancelled() and scheduled.future.exception():
+            logger.error(f"Task {scheduled.task_id} raised: {scheduled.future.exception()}")
+        self._dispatch()
@@ -0,0 +1,331 @@
+"""
+Task Store
+
+This module keeps computer use task records in memory while they run and
+bounds the memory used by finished tasks. When a task finishes its record is
+compacted: live objects such as the agent and browser handles are dropped and
+the history is serialized. Compacted records are kept in memory until they
+expire or the memory budget is exceeded, and are then archived to SQLite,
+from where they are still readable. The archive is written and read in
+worker threads, off the event loop.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Store defaults, overridable through the environment
+TASK_STORE_MAX_MB = float(os.environ.get("TASK_STORE_MAX_MB", "64"))  # Memory budget for finished tasks
+TASK_STORE_TTL = float(os.environ.get("TASK_STORE_TTL", "3600"))  # Seconds finished tasks stay in memory
+TASK_ARCHIVE_PATH = os.environ.get("TASK_ARCHIVE_PATH", "./cache/tasks.sqlite3")  # Empty disables the archive
+TASK_ARCHIVE_TTL = float(os.environ.get("TASK_ARCHIVE_TTL", str(7 * 24 * 3600)))  # Seconds archived tasks are kept
+
+
+def task_created_at(record: Dict[str, Any]) -> Optional[str]:
+    """When a task was created as an ISO timestamp; records without one fall back to their last update."""
+    return record.get("created_at") or record.get("last_update")
+
+
+def to_jsonable(value: Any) -> Any:
+    """JSON fallback for objects such as browser-use histories."""
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json")
+    if hasattr(value, "dict"):
+        return value.dict()
+    if isinstance(value, (set, tuple)):
+        return list(value)
+    if isinstance(value, bytes):
+        return None
+    return str(value)
+
+
+class TaskStore:
+    """
+    Dict-like store of task records with a memory budget for finished tasks.
+
+    The dict interface only sees tasks in memory, so it never touches the
+    disk. Evicted tasks are written to the archive in a worker thread, and
+    archived tasks are read with the async methods aget, acontains and
+    archived_page.
+
+    Args:
+        archive_path: SQLite file for archived tasks. Empty or None drops
+            evicted tasks instead of archiving them.
+        max_bytes: Budget for finished tasks kept in memory, measured as
+            the size of their serialized records.
+        ttl: Seconds a finished task stays in memory.
+        archive_ttl: Seconds an archived task is kept on disk.
+        compact: Turns a finished record into one that only holds
+            serializable data. Defaults to keeping the record as is.
+        on_evict: Called with the task ID when a task leaves memory.
+    """
+
+    def __init__(
+        self,
+        archive_path: Optional[str] = TASK_ARCHIVE_PATH,
+        max_bytes: int = int(TASK_STORE_MAX_MB * 1024 * 1024),
+        ttl: float = TASK_STORE_TTL,
+        archive_ttl: float = TASK_ARCHIVE_TTL,
+        compact: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+        on_evict: Optional[Callable[[str], None]] = None,
+    ):
+        self.archive_path = archive_path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.archive_ttl = archive_ttl
+        self.compact = compact
+        self.on_evict = on_evict
+
+        self._records: Dict[str, Dict[str, Any]] = {}
+        # Finished tasks in the order they finished: task_id -> (finished_at, size)
+        self._finished: "OrderedDict[str, Tuple[float, int]]" = OrderedDict()
+        self._finished_bytes = 0
+        self.archived = 0
+
+        # Archive changes not yet written: task_id -> record, or None to delete it
+        self._pending: Dict[str, Optional[Dict[str, Any]]] = {}
+        self._flushing: Optional[asyncio.Task] = None
+        # The connection is used from worker threads
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        if archive_path:
+            directory = os.path.dirname(archive_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(archive_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "task_id TEXT PRIMARY KEY, record BLOB NOT NULL, archived_at REAL NOT NULL, "
+                "status TEXT, created_at TEXT)"
+            )
+            self._migrate()
+            self._conn.execute("CREATE INDEX IF NOT EXISTS tasks_archived ON tasks (archived_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS tasks_created ON tasks (created_at)")
+            self._conn.commit()
+
+    def __setitem__(self, task_id: str, record: Dict[str, Any]):
+        self._records[task_id] = record
+
+    def __getitem__(self, task_id: str) -> Dict[str, Any]:
+        record = self.get(task_id)
+        if record is None:
+            raise KeyError(task_id)
+        return record
+
+    def __contains__(self, task_id: str) -> bool:
+        self._evict()
+        return task_id in self._records
+
+    def get(self, task_id: str, default: Any = None) -> Any:
+        """Get a task record from memory; use aget to include archived tasks."""
+        self._evict()
+        return self._records.get(task_id, default)
+
+    async def aget(self, task_id: str, default: Any = None) -> Any:
+        """Get a task record from memory or, if it has been archived, from disk."""
+        self._evict()
+        if task_id in self._records:
+            return self._records[task_id]
+        if task_id in self._pending:
+            record = self._pending[task_id]
+        else:
+            record = await asyncio.to_thread(self._load, task_id)
+        return default if record is None else record
+
+    async def acontains(self, task_id: str) -> bool:
+        """Whether a task is in memory or in the archive."""
+        return await self.aget(task_id) is not None
+
+    def pop(self, task_id: str, default: Any = None) -> Any:
+        """Remove a task from memory and from the archive."""
+        record = self._records.pop(task_id, default)
+        if task_id in self._finished:
+            self._finished_bytes -= self._finished.pop(task_id)[1]
+        if self._conn is not None:
+            self._pending[task_id] = None
+            self._flush()
+        return record
+
+    def is_in_memory(self, task_id: str) -> bool:
+        return task_id in self._records
+
+    def is_finished(self, task_id: str) -> bool:
+        """Whether a task in memory has been compacted; its record must not change after that."""
+        return task_id in self._finished
+
+    def items(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Tasks held in memory."""
+        self._evict()
+        return iter(list(self._records.items()))
+
+    async def archived_page(
+        self,
+        statuses: Optional[Set[str]] = None,
+        offset: int = 0,
+        limit: Optional[int] = None,
+    ) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        Read a page of archived tasks, most recently created first.
+
+        Args:
+            statuses: Only return tasks with one of these statuses.
+            offset: Number of matching tasks to skip.
+            limit: Maximum number of tasks to return; None returns all.
+
+        Returns:
+            A list of (task_id, record) pairs.
+        """
+        if self._conn is None:
+            return []
+        # Evicted tasks must reach the disk for the page to include them
+        await self.flush()
+        return await asyncio.to_thread(self._read_page, statuses, offset, limit)
+
+    async def flush(self):
+        """Wait until evicted tasks have been written to the archive."""
+        while self._flushing is not None and not self._flushing.done():
+            await asyncio.shield(self._flushing)
+
+    def finish(self, task_id: str):
+        """
+        Compact a finished task and make it eligible for eviction.
+
+        Args:
+            task_id: The ID of the finished task.
+        """
+        record = self._records.get(task_id)
+        if record is None or task_id in self._finished:
+            return
+        compacted = self.compact(record) if self.compact else record
+        data = json.dumps(compacted, default=to_jsonable)
+        self._records[task_id] = json.loads(data)
+        self._finished[task_id] = (time.monotonic(), len(data))
+        self._finished_bytes += len(data)
+        self._evict()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_memory": len(self._records),
+            "finished_in_memory": len(self._finished),
+            "finished_bytes": self._finished_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "archived": self.archived,
+            "archive_pending": len(self._pending),
+            "archive_path": self.archive_path or None,
+        }
+
+    def _evict(self):
+        """Archive finished tasks that have expired or exceed the memory budget."""
+        now = time.monotonic()
+        evicted = False
+        while self._finished:
+            task_id, (finished_at, _) = next(iter(self._finished.items()))
+            if self._finished_bytes <= self.max_bytes and now - finished_at < self.ttl:
+                break
+            self._archive(task_id)
+            evicted = True
+        if evicted:
+            self._flush()
+
+    def _archive(self, task_id: str):
+        record = self._records.pop(task_id)
+        self._finished_bytes -= self._finished.pop(task_id)[1]
+        if self._conn is not None:
+            self._pending[task_id] = record
+        if self.on_evict:
+            try:
+                self.on_evict(task_id)
+            except Exception as e:
+                logger.error(f"Error in eviction callback for task {task_id}: {e}", exc_info=True)
+
+    def _flush(self):
+        """Write pending archive changes in a worker thread, or right away outside an event loop."""
+        if not self._pending or (self._flushing is not None and not self._flushing.done()):
+            # A running flush picks up the new changes
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(dict(self._pending))
+            self._pending.clear()
+            return
+        self._flushing = loop.create_task(self._flush_pending())
+
+    async def _flush_pending(self):
+        while self._pending:
+            batch = dict(self._pending)
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except Exception as e:
+                logger.error(f"Error archiving {len(batch)} tasks: {e}", exc_info=True)
+            for task_id, record in batch.items():
+                # Keep changes made while the batch was written
+                if task_id in self._pending and self._pending[task_id] is record:
+                    del self._pending[task_id]
+
+    def _write(self, batch: Dict[str, Optional[Dict[str, Any]]]):
+        now = time.time()
+        rows = []
+        for task_id, record in batch.items():
+            if record is not None:
+                blob = zlib.compress(json.dumps(record, default=to_jsonable).encode("utf-8"))
+                rows.append((task_id, blob, now, record.get("status"), task_created_at(record)))
+        deleted = [(task_id,) for task_id, record in batch.items() if record is None]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO tasks (task_id, record, archived_at, status, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.executemany("DELETE FROM tasks WHERE task_id = ?", deleted)
+            self._conn.execute("DELETE FROM tasks WHERE archived_at < ?", (now - self.archive_ttl,))
+            self._conn.commit()
+        self.archived += len(rows)
+
+    def _load(self, task_id: str) -> Optional[Dict[str, Any]]:
+        if self._conn is None:
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT record FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return json.loads(zlib.decompress(row[0])) if row else None
+
+    def _read_page(
+        self, statuses: Optional[Set[str]], offset: int, limit: Optional[int]
+    ) -> List[Tuple[str, Dict[str, Any]]]:
+        query = "SELECT task_id, record FROM tasks"
+        params: List[Any] = []
+        if statuses is not None:
+            query += f" WHERE status IN ({', '.join('?' * len(statuses))})"
+            params.extend(sorted(statuses))
+        query += " ORDER BY created_at DESC, archived_at DESC LIMIT ? OFFSET ?"
+        params.extend([-1 if limit is None else limit, offset])
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [(task_id, json.loads(zlib.decompress(blob))) for task_id, blob in rows]
+
+    def _migrate(self):
+        """Add the status and created_at columns to archives written before they existed."""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(tasks)")}
+        if "status" in columns:
+            return
+        self._conn.execute("ALTER TABLE tasks ADD COLUMN status TEXT")
+        self._conn.execute("ALTER TABLE tasks ADD COLUMN created_at TEXT")
+        rows = self._conn.execute("SELECT task_id, record FROM tasks").fetchall()
+        for task_id, blob in rows:
+            record = json.loads(zlib.decompress(blob))
+            self._conn.execute(
+                "UPDATE tasks SET status = ?, created_at = ? WHERE task_id = ?",
+                (record.get("status"), task_created_at(record), task_id),
+            )
+        self._conn.commit()
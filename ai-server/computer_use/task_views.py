@@ -0,0 +1,113 @@
+"""
+Task Views
+
+This module helps the HTTP endpoints serve task state to polling clients
+cheaply: agent histories are returned in pages, task lists are paginated,
+and responses carry an ETag derived from a cheap version key so that an
+unchanged poll is answered with 304 before the response is even built.
+"""
+
+import hashlib
+import itertools
+import json
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import Response
+
+from .task_store import to_jsonable
+
+# Default and maximum number of items in one page
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def history_steps(history: Any) -> List[Any]:
+    """
+    Get the list of steps from an agent history.
+
+    Histories are browser-use AgentHistoryList objects while a task runs and
+    plain lists or serialized dicts once the task has been compacted.
+    """
+    if history is None:
+        return []
+    if isinstance(history, list):
+        return history
+    if isinstance(history, dict):
+        return history.get("history") or []
+    return list(getattr(history, "history", None) or [])
+
+
+def history_page(history: Any, since: int = 0, limit: int = DEFAULT_PAGE_SIZE) -> Dict[str, Any]:
+    """
+    Get the steps of a history after a cursor.
+
+    Args:
+        history: The agent history.
+        since: Number of steps the client already has.
+        limit: Maximum number of steps to return.
+
+    Returns:
+        The steps, the cursor to use for the next request and the total
+        number of steps.
+    """
+    steps = history_steps(history)
+    page = steps[since:since + limit]
+    return {"steps": page, "since": since, "next": since + len(page), "total": len(steps)}
+
+
+def paginate(items: Iterable[Any], offset: int = 0, limit: int = DEFAULT_PAGE_SIZE) -> Tuple[List[Any], Optional[int]]:
+    """
+    Take one page from an iterable without consuming more than needed.
+
+    Returns:
+        The page and the offset of the next page, or None if this is the last one.
+    """
+    page = list(itertools.islice(items, offset, offset + limit + 1))
+    if len(page) > limit:
+        return page[:limit], offset + limit
+    return page, None
+
+
+def etag_for(version: Any) -> str:
+    """
+    Make a weak ETag from a version key.
+
+    The tag is weak because responses may differ in details such as elapsed
+    times while the version is unchanged.
+    """
+    digest = hashlib.blake2b(repr(version).encode("utf-8"), digest_size=12).hexdigest()
+    return f'W/"{digest}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Check If-None-Match against an ETag using weak comparison."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*" or (tag[2:] if tag.startswith("W/") else tag) == opaque:
+            return True
+    return False
+
+
+def cached_json_response(request: Request, version: Any, build: Callable[[], Any]) -> Response:
+    """
+    Serve JSON with an ETag, or 304 Not Modified if the client is up to date.
+
+    Args:
+        request: The incoming request, checked for If-None-Match.
+        version: A cheap key that changes whenever the response changes.
+        build: Builds the response body; only called if it is needed.
+
+    Returns:
+        The JSON response or an empty 304 response.
+    """
+    etag = etag_for(version)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    body = json.dumps(build(), default=to_jsonable)
+    return Response(content=body, media_type="application/json", headers=headers)
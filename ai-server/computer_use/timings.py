@@ -0,0 +1,256 @@
+"""
+Step Timings
+
+This module records where an agent's time goes, step by step: the LLM call
+(with prompt and completion tokens), prompt compaction and screenshot
+optimization, each browser action, page-load waits and capturing the page
+state, and the size of every screenshot. Spans are recorded on the task's
+StepTimings, found through a context variable that ComputerUseAgent.run
+sets, and are also added to process-wide histograms.
+"""
+
+import bisect
+import contextvars
+import functools
+import inspect
+import logging
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the histogram buckets
+DURATION_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Upper bounds, in bytes, of the screenshot size buckets
+SIZE_BUCKETS = (1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6)
+
+# Steps kept per task; the oldest are dropped after that
+MAX_STEPS = 500
+
+# The timings of the task whose agent is running; set by ComputerUseAgent.run
+current_step_timings: contextvars.ContextVar[Optional["StepTimings"]] = contextvars.ContextVar(
+    "current_step_timings", default=None
+)
+
+
+class Histogram:
+    """
+    Cumulative histogram of durations, as Prometheus exposes them.
+
+    Args:
+        buckets: Upper bounds of the buckets, in increasing order.
+    """
+
+    def __init__(self, buckets: Sequence[float] = DURATION_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self) -> Dict[str, Any]:
+        cumulative, buckets = 0, []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            buckets.append(["+Inf" if bound == float("inf") else bound, cumulative])
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else None,
+            "buckets": buckets,
+        }
+
+
+# Durations of every span of every task in this process, by span name, and screenshot sizes
+_histograms: Dict[str, Histogram] = {}
+
+# Spans that ended with an exception, by span name
+_errors: Dict[str, int] = {}
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """The value below which the given fraction of the (sorted) values fall."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class StepTimings:
+    """
+    The timed spans of one task, grouped by agent step.
+
+    browser-use reports a step after its LLM call and before its actions,
+    so the spans recorded before a step is reported (capturing the page,
+    calling the LLM) and those recorded after it (the actions) make up the
+    step.
+    """
+
+    def __init__(self, max_steps: int = MAX_STEPS):
+        self.max_steps = max_steps
+        self.started = time.time()
+        self.steps: List[Dict[str, Any]] = []
+        self.steps_dropped = 0
+        self._pending: List[Dict[str, Any]] = []
+        self._current: Optional[Dict[str, Any]] = None
+
+    def record(self, name: str, started: float, duration: float, **attributes: Any):
+        """
+        Record a span.
+
+        Args:
+            name: What was timed, e.g. "llm" or "action".
+            started: When the span started, as time.time().
+            duration: How long it took, in seconds.
+            attributes: Details such as the action type or token counts.
+        """
+        span = {"name": name, "start": round(started - self.started, 4), "duration": round(duration, 4), **attributes}
+        # Actions run after browser-use has reported their step
+        if name == "action" and self._current is not None:
+            self._current["spans"].append(span)
+        else:
+            self._pending.append(span)
+        _histograms.setdefault(name, Histogram()).observe(duration)
+        if attributes.get("error"):
+            _errors[name] = _errors.get(name, 0) + 1
+
+    def end_step(self, step: int, url: Optional[str] = None, screenshot_bytes: Optional[int] = None):
+        """Start a new step, now that browser-use has reported it; the previous one is complete."""
+        self._close_current()
+        self._current = {"step": step, "url": url, "screenshot_bytes": screenshot_bytes, "spans": self._pending}
+        self._pending = []
+        if screenshot_bytes is not None:
+            _histograms.setdefault("screenshot_bytes", Histogram(SIZE_BUCKETS)).observe(screenshot_bytes)
+
+    def finish(self):
+        """Complete the last step when the task ends."""
+        self._close_current()
+        if self._pending:
+            # Spans of a step that never got reported, e.g. a failed LLM call
+            self._append({"step": None, "url": None, "screenshot_bytes": None, "spans": self._pending})
+            self._pending = []
+
+    def _close_current(self):
+        if self._current is not None:
+            self._append(self._current)
+            self._current = None
+
+    def _append(self, step: Dict[str, Any]):
+        spans = step["spans"]
+        if spans:
+            # Spans are recorded when they end, so nested ones come before the span around them
+            step["start"] = min(span["start"] for span in spans)
+            step["duration"] = round(max(span["start"] + span["duration"] for span in spans) - step["start"], 4)
+        else:
+            step["start"], step["duration"] = None, 0.0
+        for name in ("llm", "action", "page_load", "state"):
+            step[f"{name}_seconds"] = round(sum(span["duration"] for span in spans if span["name"] == name), 4)
+        llm = [span for span in spans if span["name"] == "llm"]
+        step["prompt_tokens"] = sum(span.get("prompt_tokens") or 0 for span in llm)
+        step["completion_tokens"] = sum(span.get("completion_tokens") or 0 for span in llm)
+        step["actions"] = [span.get("type") for span in spans if span["name"] == "action"]
+        self.steps.append(step)
+        if len(self.steps) > self.max_steps:
+            del self.steps[0]
+            self.steps_dropped += 1
+
+    def summary(self) -> Dict[str, Any]:
+        """Count, total and percentiles of each span name over the task's steps."""
+        durations: Dict[str, List[float]] = {}
+        for step in self.all_steps():
+            for span in step["spans"]:
+                durations.setdefault(span["name"], []).append(span["duration"])
+        if self.steps:
+            durations["step"] = [step["duration"] for step in self.steps]
+        summary = {}
+        for name, values in durations.items():
+            values.sort()
+            histogram = Histogram()
+            for value in values:
+                histogram.observe(value)
+            summary[name] = {
+                **histogram.to_dict(),
+                "p50": percentile(values, 0.5),
+                "p95": percentile(values, 0.95),
+                "max": values[-1],
+            }
+        return summary
+
+    def all_steps(self) -> List[Dict[str, Any]]:
+        """The completed steps and the one in progress, if any."""
+        return self.steps + ([self._current] if self._current is not None else [])
+
+    def to_dict(self) -> Dict[str, Any]:
+        steps = self.steps + ([{**self._current, "in_progress": True}] if self._current is not None else [])
+        return {
+            "steps": steps,
+            "steps_dropped": self.steps_dropped,
+            "totals": {
+                "llm_seconds": round(sum(step.get("llm_seconds", 0.0) for step in self.steps), 4),
+                "action_seconds": round(sum(step.get("action_seconds", 0.0) for step in self.steps), 4),
+                "page_load_seconds": round(sum(step.get("page_load_seconds", 0.0) for step in self.steps), 4),
+                "state_seconds": round(sum(step.get("state_seconds", 0.0) for step in self.steps), 4),
+                "prompt_tokens": sum(step.get("prompt_tokens", 0) for step in self.steps),
+                "completion_tokens": sum(step.get("completion_tokens", 0) for step in self.steps),
+                "screenshot_bytes": sum(step.get("screenshot_bytes") or 0 for step in self.steps),
+            },
+            "histograms": self.summary(),
+        }
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Time a block and record it on the current task's timings, if there are any.
+
+    Yields:
+        The span's attributes, which the block may add to (e.g. token counts).
+    """
+    timings = current_step_timings.get()
+    if timings is None:
+        yield attributes
+        return
+    started, clock = time.time(), time.perf_counter()
+    try:
+        yield attributes
+    except BaseException:
+        attributes["error"] = True
+        raise
+    finally:
+        timings.record(name, started, time.perf_counter() - clock, **attributes)
+
+
+def instrument_method(target: Any, method: str, name: str):
+    """
+    Time every call of a coroutine method of an object as a span.
+
+    Used for browser-use internals that differ between versions, so a
+    missing method is skipped. The wrapper stays in place when a pooled
+    browser is reused, and is only installed once.
+    """
+    original = getattr(target, method, None)
+    if not inspect.iscoroutinefunction(original) or getattr(original, "_timed", False):
+        return
+
+    @functools.wraps(original)
+    async def timed(*args, **kwargs):
+        with span(name):
+            return await original(*args, **kwargs)
+
+    timed._timed = True
+    setattr(target, method, timed)
+
+
+def timing_histograms() -> Dict[str, Any]:
+    """Histograms of the span durations and screenshot sizes of every task in this process."""
+    return {name: histogram.to_dict() for name, histogram in _histograms.items()}
+
+
+def span_error_counts() -> Dict[str, int]:
+    """Number of spans of every task in this process that ended with an exception, by span name."""
+    return dict(_errors)
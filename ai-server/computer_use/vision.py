@@ -0,0 +1,367 @@
+"""
+Vision Payload Optimizer
+
+This module shrinks the screenshots that agents send to the LLM. Before a
+request leaves the process, each screenshot is downscaled to a resolution
+budget and re-encoded as JPEG. A screenshot that looks the same as the
+previous one (same perceptual hash) is replaced by a short note, and one
+where only a small part of the page changed can be cropped to that part.
+Per-task counters show how many bytes and image tokens were saved.
+
+Image processing needs Pillow. Without it, screenshots are sent as they
+are and only exact duplicates are skipped.
+"""
+
+import asyncio
+import base64
+import contextvars
+import hashlib
+import io
+import logging
+import math
+import threading
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    from PIL import Image, ImageChops
+except ImportError:  # pragma: no cover - Pillow is optional
+    Image = None
+    ImageChops = None
+
+logger = logging.getLogger(__name__)
+
+# Results kept per task, so that a screenshot still in the history is sent the same way every time
+CACHE_SIZE = 16
+
+# Pixel difference (0-255, grayscale) that counts as a change when looking for the changed region
+CHANGE_THRESHOLD = 24
+
+# Pixels of context kept around a cropped region
+CROP_PADDING = 32
+
+# Texts sent in place of a skipped screenshot and before a cropped region; both refer to the previous screenshot
+UNCHANGED_NOTE = "[Screenshot omitted: the page looks the same as in the previous screenshot.]"
+CROP_NOTE_PREFIX = "[Only part of the page changed since the previous screenshot."
+
+# The optimizer of the task whose LLM calls are being made; set by ComputerUseAgent.run
+current_vision_optimizer: contextvars.ContextVar[Optional["VisionOptimizer"]] = contextvars.ContextVar(
+    "current_vision_optimizer", default=None
+)
+
+
+def estimate_image_tokens(width: int, height: int, detail: str = "high") -> int:
+    """
+    Estimate the input tokens an image costs, using OpenAI's tiling rules.
+
+    Args:
+        width: Width of the image in pixels.
+        height: Height of the image in pixels.
+        detail: The image_url detail level; "low" images cost a flat amount.
+
+    Returns:
+        The estimated number of tokens.
+    """
+    if detail == "low" or width <= 0 or height <= 0:
+        return 85
+    # The image is fitted within 2048x2048, then its short side is scaled to at most 768
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def is_screenshot_note(part: Any) -> bool:
+    """Whether a message part is a note that the optimizer added for a skipped or cropped screenshot."""
+    if not isinstance(part, dict) or part.get("type") != "text":
+        return False
+    text = part.get("text", "")
+    return text == UNCHANGED_NOTE or text.startswith(CROP_NOTE_PREFIX)
+
+
+def is_crop_note(part: Any) -> bool:
+    """Whether a message part is the note before a cropped region."""
+    return is_screenshot_note(part) and part["text"].startswith(CROP_NOTE_PREFIX)
+
+
+def difference_hash(image: "Image.Image") -> int:
+    """64-bit perceptual hash (dHash): compares neighbouring pixels of a 9x8 grayscale thumbnail."""
+    pixels = list(image.convert("L").resize((9, 8), Image.BILINEAR).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return bits
+
+
+def hash_distance(a: int, b: int) -> int:
+    """Number of bits that differ between two perceptual hashes."""
+    return bin(a ^ b).count("1")
+
+
+def split_data_url(url: str) -> Optional[Tuple[str, str]]:
+    """Split a base64 data URL into its media type and data, or return None for other URLs."""
+    if not url.startswith("data:") or ";base64," not in url:
+        return None
+    header, data = url.split(";base64,", 1)
+    return header[len("data:"):], data
+
+
+def png_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """Read the width and height from a PNG header without decoding the image."""
+    if data[:8] != b"\x89PNG\r\n\x1a\n" or len(data) < 24:
+        return None
+    return int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+
+
+@dataclass
+class VisionStats:
+    """Counters for the screenshots of one task, counted every time a screenshot is sent."""
+
+    images: int = 0
+    skipped: int = 0
+    cropped: int = 0
+    bytes_before: int = 0
+    bytes_after: int = 0
+    tokens_before: int = 0
+    tokens_after: int = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        stats = asdict(self)
+        stats["bytes_saved"] = self.bytes_before - self.bytes_after
+        stats["tokens_saved"] = self.tokens_before - self.tokens_after
+        return stats
+
+
+@dataclass
+class _Outcome:
+    """What a screenshot was turned into, and what that saved."""
+
+    parts: List[Any]
+    kind: str  # "sent", "cropped" or "skipped"
+    bytes_before: int
+    bytes_after: int
+    tokens_before: int
+    tokens_after: int
+
+
+class VisionOptimizer:
+    """
+    Screenshot preprocessing for one task.
+
+    Args:
+        max_width: Screenshots are downscaled to fit within this width.
+        max_height: Screenshots are downscaled to fit within this height.
+        jpeg_quality: JPEG quality (1-95) screenshots are re-encoded with.
+        skip_unchanged: Replace a screenshot that looks the same as the
+            previous one with a note.
+        hash_threshold: Bits of the 64-bit perceptual hash that may differ
+            for a screenshot to still count as unchanged.
+        crop_changes: Send only the changed region when little changed.
+        crop_max_fraction: Largest part of the screenshot a changed region
+            may cover to be sent cropped.
+    """
+
+    def __init__(
+        self,
+        max_width: int = 1024,
+        max_height: int = 768,
+        jpeg_quality: int = 70,
+        skip_unchanged: bool = True,
+        hash_threshold: int = 2,
+        crop_changes: bool = False,
+        crop_max_fraction: float = 0.5,
+    ):
+        self.max_width = max_width
+        self.max_height = max_height
+        self.jpeg_quality = max(1, min(95, jpeg_quality))
+        self.skip_unchanged = skip_unchanged
+        self.hash_threshold = hash_threshold
+        self.crop_changes = crop_changes
+        self.crop_max_fraction = crop_max_fraction
+        self.stats = VisionStats()
+        # The last screenshot whose content the LLM has seen, to compare new ones with
+        self._reference: Optional["Image.Image"] = None
+        self._reference_hash: Optional[int] = None
+        self._reference_digest: Optional[bytes] = None
+        self._cache: "OrderedDict[bytes, _Outcome]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def optimize_messages(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Optimize the screenshots in the messages of a chat completion request.
+
+        Image processing runs in a worker thread so that it does not hold up
+        other tasks on the event loop.
+
+        Args:
+            messages: Messages in the OpenAI format; image parts with base64
+                data URLs are optimized.
+
+        Returns:
+            New messages with the screenshots replaced; the input is not changed.
+        """
+        if not any(isinstance(message.get("content"), list) for message in messages):
+            return messages
+        return await asyncio.to_thread(self._optimize_messages, messages)
+
+    def _optimize_messages(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        with self._lock:
+            optimized = []
+            for message in messages:
+                content = message.get("content")
+                if isinstance(content, list):
+                    # The text identifies the step, so that an identical screenshot taken
+                    # in a later step is still recognized as unchanged
+                    text = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+                    parts: List[Any] = []
+                    for part in content:
+                        parts.extend(self._optimize_part(part, text))
+                    message = {**message, "content": parts}
+                optimized.append(message)
+            return optimized
+
+    def _optimize_part(self, part: Any, text: str) -> List[Any]:
+        if not isinstance(part, dict) or part.get("type") != "image_url" or not isinstance(part.get("image_url"), dict):
+            return [part]
+        split = split_data_url(part["image_url"].get("url", ""))
+        if split is None:
+            return [part]
+
+        image_digest = hashlib.blake2b(split[1].encode("ascii"), digest_size=16).digest()
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16, key=image_digest).digest()
+        outcome = self._cache.get(key)
+        if outcome is not None:
+            # A screenshot that is still in the history, or a retried request, is sent the same way every time
+            self._cache.move_to_end(key)
+        else:
+            try:
+                outcome = self._process(part, split[1], image_digest)
+            except Exception as e:
+                logger.warning(f"Could not optimize screenshot, sending it as is: {e}")
+                size = len(part["image_url"]["url"])
+                outcome = _Outcome([part], "sent", size, size, 0, 0)
+            self._cache[key] = outcome
+            while len(self._cache) > CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+        self.stats.images += 1
+        self.stats.skipped += outcome.kind == "skipped"
+        self.stats.cropped += outcome.kind == "cropped"
+        self.stats.bytes_before += outcome.bytes_before
+        self.stats.bytes_after += outcome.bytes_after
+        self.stats.tokens_before += outcome.tokens_before
+        self.stats.tokens_after += outcome.tokens_after
+        return outcome.parts
+
+    def _process(self, part: Dict[str, Any], data: str, digest: bytes) -> _Outcome:
+        """Decide how to send a screenshot that has not been seen before."""
+        detail = part["image_url"].get("detail", "auto")
+        bytes_before = len(part["image_url"]["url"])
+        raw = base64.b64decode(data)
+
+        if Image is None:
+            # Without Pillow only exact duplicates can be recognized
+            size = png_size(raw)
+            tokens = estimate_image_tokens(*size, detail) if size else 0
+            if self.skip_unchanged and digest == self._reference_digest:
+                return _Outcome([self._unchanged_note()], "skipped", bytes_before, 0, tokens, 0)
+            self._reference_digest = digest
+            return _Outcome([part], "sent", bytes_before, bytes_before, tokens, tokens)
+
+        image = Image.open(io.BytesIO(raw))
+        image.load()
+        tokens_before = estimate_image_tokens(image.width, image.height, detail)
+        scaled = self._downscale(image.convert("RGB"))
+        image_hash = difference_hash(scaled)
+
+        if (
+            self.skip_unchanged
+            and self._reference_hash is not None
+            and hash_distance(image_hash, self._reference_hash) <= self.hash_threshold
+        ):
+            return _Outcome([self._unchanged_note()], "skipped", bytes_before, 0, tokens_before, 0)
+
+        region = self._changed_region(scaled) if self.crop_changes else None
+        self._reference, self._reference_hash = scaled, image_hash
+
+        if region is None:
+            image_part = self._image_part(part, scaled, bytes_before * scaled.width * scaled.height / (image.width * image.height))
+            if scaled.size == image.size and len(image_part["image_url"]["url"]) >= bytes_before:
+                # Nothing to gain over the original
+                image_part = part
+            return _Outcome(
+                [image_part], "sent", bytes_before, len(image_part["image_url"]["url"]),
+                tokens_before, estimate_image_tokens(scaled.width, scaled.height, detail),
+            )
+
+        cropped = scaled.crop(region)
+        image_part = self._image_part(part, cropped, bytes_before * cropped.width * cropped.height / (image.width * image.height))
+        # Tell the model where the region is, in the coordinates of the original screenshot
+        scale = image.width / scaled.width
+        left, top, right, bottom = (round(value * scale) for value in region)
+        note = {
+            "type": "text",
+            "text": (
+                f"{CROP_NOTE_PREFIX} The next image shows "
+                f"the region x={left}-{right}, y={top}-{bottom} of the {image.width}x{image.height} "
+                f"screenshot; the rest of the page looks the same as before.]"
+            ),
+        }
+        return _Outcome(
+            [note, image_part], "cropped", bytes_before, len(image_part["image_url"]["url"]),
+            tokens_before, estimate_image_tokens(cropped.width, cropped.height, detail),
+        )
+
+    def _downscale(self, image: "Image.Image") -> "Image.Image":
+        scale = min(1.0, self.max_width / image.width, self.max_height / image.height)
+        if scale >= 1.0:
+            return image
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        return image.resize(size, Image.LANCZOS)
+
+    def _changed_region(self, image: "Image.Image") -> Optional[Tuple[int, int, int, int]]:
+        """The padded box around what changed since the reference, if it is small enough to crop to."""
+        if self._reference is None or self._reference.size != image.size:
+            return None
+        difference = ImageChops.difference(self._reference.convert("L"), image.convert("L"))
+        box = difference.point(lambda value: 255 if value > CHANGE_THRESHOLD else 0).getbbox()
+        if box is None:
+            return None
+        left, top, right, bottom = box
+        box = (
+            max(0, left - CROP_PADDING),
+            max(0, top - CROP_PADDING),
+            min(image.width, right + CROP_PADDING),
+            min(image.height, bottom + CROP_PADDING),
+        )
+        area = (box[2] - box[0]) * (box[3] - box[1])
+        if area > self.crop_max_fraction * image.width * image.height:
+            return None
+        return box
+
+    def _image_part(self, part: Dict[str, Any], image: "Image.Image", budget: float) -> Dict[str, Any]:
+        """
+        Encode an image as JPEG, or as PNG if the JPEG is larger than the
+        original's share of bytes (as for flat, text-only pages).
+        """
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=self.jpeg_quality, optimize=True)
+        media_type, encoded = "image/jpeg", buffer.getvalue()
+        if len(encoded) * 4 / 3 > budget:
+            buffer = io.BytesIO()
+            image.save(buffer, format="PNG")
+            if buffer.tell() < len(encoded):
+                media_type, encoded = "image/png", buffer.getvalue()
+        data = base64.b64encode(encoded).decode("ascii")
+        return {**part, "image_url": {**part["image_url"], "url": f"data:{media_type};base64,{data}"}}
+
+    @staticmethod
+    def _unchanged_note() -> Dict[str, Any]:
+        return {
+            "type": "text",
+            "text": UNCHANGED_NOTE,
+        }
+
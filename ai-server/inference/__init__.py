@@ -0,0 +1,36 @@
+"""
+Inference Package
+
+Detta paket innehåller hjälpkomponenterna som server.py använder för att köra
+DeepSeek-modellen med LoRA-adapters effektivt.
+"""
+
+from .adapters import AdapterInUseError, AdapterRegistry
+from .prefix_cache import PrefixCache
+from .response_cache import (
+    MemoryResponseCache,
+    SQLiteResponseCache,
+    adapter_identity,
+    is_deterministic,
+    make_cache_key,
+)
+from .scheduler import BatchScheduler, EmptyPromptError, GenerationJob, QueueFullError, SchedulerStoppedError
+from .streaming import IncrementalDecoder, stream_job
+
+__all__ = [
+    "AdapterInUseError",
+    "AdapterRegistry",
+    "PrefixCache",
+    "MemoryResponseCache",
+    "SQLiteResponseCache",
+    "adapter_identity",
+    "is_deterministic",
+    "make_cache_key",
+    "BatchScheduler",
+    "EmptyPromptError",
+    "GenerationJob",
+    "QueueFullError",
+    "SchedulerStoppedError",
+    "IncrementalDecoder",
+    "stream_job",
+]
@@ -0,0 +1,149 @@
+"""
+Register för LoRA-adapters
+
+Håller flera LoRA-adapters ovanpå samma basmodell. Adapters kan registreras
+och avregistreras under drift, och högst max_resident av dem hålls laddade
+samtidigt (minst nyligen använd laddas ur först).
+"""
+
+import logging
+import os
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, Iterable, List, Optional
+
+from peft import PeftModel
+
+from .response_cache import adapter_identity
+
+logger = logging.getLogger(__name__)
+
+
+class AdapterInUseError(RuntimeError):
+    """Adaptern används av sekvenser som avkodas just nu."""
+
+
+class AdapterRegistry:
+    """
+    Register över LoRA-adapters för en basmodell.
+
+    Alla metoder som ändrar modellen ska anropas från schemaläggarens tråd
+    (se BatchScheduler.run_in_worker) så att de inte krockar med en
+    pågående forward-körning.
+    """
+
+    def __init__(self, model, max_resident: int = 4):
+        self.model = model
+        self.max_resident = max_resident
+        self._paths: Dict[str, str] = {}
+        # Identiteten läses från filsystemet vid registrering och laddning, inte per förfrågan
+        self._identities: Dict[str, Optional[str]] = {}
+        self._resident: "OrderedDict[str, None]" = OrderedDict()
+
+    def register(self, name: str, path: str, pinned: Iterable[Optional[str]] = ()):
+        """
+        Registrera en adapter. Den laddas först när den behövs.
+
+        En redan registrerad adapter med ny sökväg eller omskrivna filer laddas
+        ur, vilket inte får ske medan pågående förfrågningar (pinned) använder den.
+        """
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"LoRA-adapter hittades inte på {path}")
+        identity = adapter_identity(path)
+        if name in self._paths and (self._paths[name] != path or self._identities.get(name) != identity):
+            if name in pinned:
+                raise AdapterInUseError(f"Adaptern {name} används av pågående förfrågningar")
+            # Ny sökväg eller omskrivna filer: laddas om från disk vid nästa användning
+            self.unload(name)
+        self._paths[name] = path
+        self._identities[name] = identity
+
+    def unregister(self, name: str, pinned: Iterable[Optional[str]] = ()):
+        """Ladda ur och glöm en adapter."""
+        if name not in self._paths:
+            raise KeyError(name)
+        if name in pinned:
+            raise AdapterInUseError(f"Adaptern {name} används av pågående förfrågningar")
+        self.unload(name)
+        del self._paths[name]
+        self._identities.pop(name, None)
+
+    def is_registered(self, name: str) -> bool:
+        return name in self._paths
+
+    def identity(self, name: Optional[str]) -> Optional[str]:
+        """
+        Identitet för cachenycklar, ändras när adapterns filer skrivs om.
+
+        Anropas för varje förfrågan, så den läses inte från filsystemet här
+        utan sparas av register() och load().
+        """
+        if name is None:
+            return None
+        return self._identities.get(name)
+
+    def load(self, name: str, pinned: Iterable[Optional[str]] = ()):
+        """Se till att adaptern är laddad och markera den som senast använd."""
+        if name in self._resident:
+            self._resident.move_to_end(name)
+            return
+        if name not in self._paths:
+            raise KeyError(f"Okänd LoRA-adapter: {name}")
+
+        self._evict(set(pinned))
+        path = self._paths[name]
+        logger.info(f"Laddar LoRA-adapter {name} från: {path}")
+        if isinstance(self.model, PeftModel):
+            self.model.load_adapter(path, adapter_name=name)
+        else:
+            self.model = PeftModel.from_pretrained(self.model, path, adapter_name=name)
+        self.model.eval()
+        self._resident[name] = None
+        # Vikterna i minnet kommer från filerna som de ser ut nu
+        self._identities[name] = adapter_identity(path)
+
+    def unload(self, name: str):
+        """Ladda ur en adapter men behåll registreringen."""
+        if name not in self._resident:
+            return
+        logger.info(f"Laddar ur LoRA-adapter {name}")
+        del self._resident[name]
+        # Peft kan inte ta bort den aktiva adaptern, så byt till en annan först
+        if self._resident and self._active_adapter() == name:
+            self.model.set_adapter(next(reversed(self._resident)))
+        delete_adapter = getattr(self.model, "delete_adapter", None) or self.model.base_model.delete_adapter
+        delete_adapter(name)
+
+    def _active_adapter(self) -> Optional[str]:
+        active = getattr(self.model, "active_adapter", None)
+        return active[0] if isinstance(active, (list, tuple)) else active
+
+    def _evict(self, pinned: set):
+        """Ladda ur minst nyligen använda adapters tills det finns plats för en till."""
+        for name in list(self._resident):
+            if len(self._resident) < self.max_resident:
+                return
+            if name not in pinned:
+                self.unload(name)
+        if len(self._resident) >= self.max_resident:
+            logger.warning("Alla laddade LoRA-adapters används; överskrider tillfälligt max_resident")
+
+    @contextmanager
+    def use(self, name: Optional[str], pinned: Iterable[Optional[str]] = ()):
+        """Aktivera en adapter (eller basmodellen om name är None) under en forward-körning."""
+        if name is None:
+            disable = self.model.disable_adapter() if isinstance(self.model, PeftModel) else nullcontext()
+            with disable:
+                yield self.model
+            return
+        self.load(name, pinned)
+        if self._active_adapter() != name:
+            self.model.set_adapter(name)
+        yield self.model
+
+    def list(self) -> List[Dict[str, Any]]:
+        """Lista registrerade adapters och om de är laddade."""
+        return [
+            {"name": name, "path": path, "resident": name in self._resident}
+            for name, path in self._paths.items()
+        ]
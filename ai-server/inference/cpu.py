@@ -0,0 +1,65 @@
+"""
+CPU-optimerad inferens
+
+Hjälpfunktioner för att köra modellen på maskiner utan CUDA: val av
+datatyp, int8-kvantisering, antal trådar och torch.compile.
+"""
+
+import logging
+import os
+from typing import Dict, Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Datatyper som kan väljas med CPU_DTYPE. int8 laddas i float32 och kvantiseras efteråt.
+CPU_DTYPES = {
+    "bfloat16": torch.bfloat16,
+    "float32": torch.float32,
+    "int8": torch.float32,
+}
+
+
+def resolve_device(requested: str = "auto") -> str:
+    """Välj enhet för inferens: "cuda", "mps" eller "cpu"."""
+    if requested != "auto":
+        return requested
+    if torch.cuda.is_available():
+        return "cuda"
+    if getattr(torch.backends, "mps", None) and torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def configure_threads(intra_op: Optional[int] = None, inter_op: Optional[int] = None) -> Dict[str, int]:
+    """
+    Sätt antal trådar för PyTorch på CPU.
+
+    Antalet inter-op-trådar kan bara sättas innan PyTorch har startat något
+    parallellt arbete; annars behålls det nuvarande värdet.
+    """
+    torch.set_num_threads(intra_op or os.cpu_count() or 1)
+    if inter_op:
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError as e:
+            logger.warning(f"Kunde inte sätta antal inter-op-trådar: {e}")
+    return {"intra_op": torch.get_num_threads(), "inter_op": torch.get_num_interop_threads()}
+
+
+def quantize_int8(model):
+    """Kvantisera alla Linear-lager dynamiskt till int8 (vikter int8, aktiveringar float)."""
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def compile_model(model):
+    """
+    Kompilera modellens forward med torch.compile.
+
+    Den underliggande transformer-modellen kompileras på plats så att en
+    eventuell PeftModel-wrapper och dess adapters fortsätter att fungera.
+    """
+    target = model.get_base_model() if hasattr(model, "get_base_model") else model
+    target.forward = torch.compile(target.forward, dynamic=True)
+    return model
@@ -0,0 +1,131 @@
+"""
+Prefix-cache för KV-tillstånd
+
+Sparar modellens past_key_values för gemensamma promptprefix (t.ex. långa
+system- och instruktionstexter) så att prefill bara behöver köras på den
+nya delen av prompten.
+"""
+
+import hashlib
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+KVCache = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+@dataclass
+class _Block:
+    """KV-tillståndet för ett block av tokens, för alla lager."""
+
+    past_key_values: KVCache
+    nbytes: int
+
+
+class PrefixCache:
+    """
+    LRU-cache av KV-tillstånd nycklad på block av token-ID:n.
+
+    Prompten delas upp i block om block_size tokens. Varje block nycklas med
+    en hash av blocket och alla block före det, så två prompter delar nycklar
+    exakt så länge deras prefix är identiska. Endast blockets egen del av
+    KV-tillståndet lagras, och minnesanvändningen begränsas av max_bytes.
+    """
+
+    def __init__(self, max_bytes: int, block_size: int = 16):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self._blocks: "OrderedDict[bytes, _Block]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self.evictions = 0
+
+    def _block_keys(self, token_ids: List[int], limit: int, namespace: str) -> List[bytes]:
+        """Nycklar för alla hela block inom de första limit tokens."""
+        keys = []
+        digest = hashlib.blake2b(namespace.encode(), digest_size=16).digest()
+        for end in range(self.block_size, limit + 1, self.block_size):
+            block = array("q", token_ids[end - self.block_size:end]).tobytes()
+            digest = hashlib.blake2b(digest + block, digest_size=16).digest()
+            keys.append(digest)
+        return keys
+
+    def lookup(self, token_ids: List[int], namespace: str = "") -> Tuple[int, Optional[KVCache]]:
+        """
+        Hitta det längsta cachade prefixet av prompten.
+
+        Minst en token lämnas alltid utanför prefixet så att modellen har
+        något att köra prefill på. Returnerar (prefixlängd, past_key_values).
+        """
+        blocks = []
+        for key in self._block_keys(token_ids, len(token_ids) - 1, namespace):
+            block = self._blocks.get(key)
+            if block is None:
+                break
+            blocks.append((key, block))
+
+        if not blocks:
+            self.misses += 1
+            return 0, None
+
+        # Förälderblock markeras som använda sist så att löv evakueras först
+        for key, _ in reversed(blocks):
+            self._blocks.move_to_end(key)
+
+        self.hits += 1
+        prefix_length = len(blocks) * self.block_size
+        self.hit_tokens += prefix_length
+        layers = zip(*(block.past_key_values for _, block in blocks))
+        past_key_values = tuple(
+            (torch.cat([k for k, _ in layer], dim=2), torch.cat([v for _, v in layer], dim=2))
+            for layer in layers
+        )
+        return prefix_length, past_key_values
+
+    def insert(self, token_ids: List[int], past_key_values: KVCache, namespace: str = ""):
+        """Spara KV-tillståndet för alla hela block i prompten som inte redan finns."""
+        keys = self._block_keys(token_ids, len(token_ids), namespace)
+        for index, key in enumerate(keys):
+            if key in self._blocks:
+                continue
+            start, end = index * self.block_size, (index + 1) * self.block_size
+            # Kopiera blocket så att hela promptens KV-tensorer inte hålls kvar i minnet
+            block_kv = tuple(
+                (k[:, :, start:end].clone(), v[:, :, start:end].clone()) for k, v in past_key_values
+            )
+            nbytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in block_kv)
+            self._blocks[key] = _Block(past_key_values=block_kv, nbytes=nbytes)
+            self.total_bytes += nbytes
+        # Förälderblock markeras som använda sist så att löv evakueras först
+        for key in reversed(keys):
+            self._blocks.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._blocks:
+            _, block = self._blocks.popitem(last=False)
+            self.total_bytes -= block.nbytes
+            self.evictions += 1
+
+    def clear(self):
+        """Töm cachen."""
+        self._blocks.clear()
+        self.total_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Räknare för att kunna justera minnesbudgeten."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_tokens": self.hit_tokens,
+            "evictions": self.evictions,
+            "blocks": len(self._blocks),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "block_size": self.block_size,
+        }
@@ -0,0 +1,174 @@
+"""
+Svarscache för deterministiska genereringsförfrågningar
+
+När temperaturen är 0 eller klienten anger en seed blir svaret från
+/api/generate deterministiskt, och samma förfrågan kan besvaras från cachen
+i stället för att köras genom modellen igen.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+def is_deterministic(temperature: Optional[float], seed: Optional[int]) -> bool:
+    """Avgör om en förfrågan ger samma svar varje gång."""
+    return seed is not None or (temperature is not None and temperature <= 0)
+
+
+def adapter_identity(path: Optional[str]) -> Optional[str]:
+    """
+    Identifiera en LoRA-adapter med sökväg och senaste ändringstid.
+
+    Ändringstiden gör att cachade svar inte återanvänds efter att adaptern
+    tränats om och sparats på samma plats.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    if os.path.isdir(path):
+        mtimes = [os.path.getmtime(os.path.join(path, name)) for name in os.listdir(path)]
+        mtime = max(mtimes, default=os.path.getmtime(path))
+    else:
+        mtime = os.path.getmtime(path)
+    return f"{os.path.abspath(path)}@{mtime:.0f}"
+
+
+def make_cache_key(**fields: Any) -> str:
+    """Skapa en nyckel från alla fält som påverkar svaret."""
+    payload = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryResponseCache:
+    """LRU-cache i minnet med TTL och ett maximalt antal poster."""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        """Hämta ett svar, eller None om det saknas eller har gått ut."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: str, response: str):
+        """Spara ett svar och evakuera de minst nyligen använda posterna."""
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def aget(self, key: str) -> Optional[str]:
+        """Som get(); cachen ligger i minnet och blockerar därför inte event-loopen."""
+        return self.get(key)
+
+    async def aset(self, key: str, response: str):
+        """Som set()."""
+        self.set(key, response)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "memory",
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+        }
+
+
+class SQLiteResponseCache:
+    """LRU-cache på disk i SQLite som överlever omstarter av servern."""
+
+    def __init__(self, path: str, max_entries: int = 1024, ttl: float = 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+        self._conn.commit()
+        # Antal poster hålls uppdaterat av get() och set() så att stats() inte behöver fråga databasen
+        self.entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        """Hämta ett svar, eller None om det saknas eller har gått ut."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT response, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] < now:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._conn.commit()
+                    self.entries -= 1
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key: str, response: str):
+        """Spara ett svar och evakuera de minst nyligen använda posterna."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, response, now + self.ttl, now),
+            )
+            self._conn.execute("DELETE FROM responses WHERE expires_at < ?", (now,))
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+            self.entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    async def aget(self, key: str) -> Optional[str]:
+        """Som get(), men frågan körs i en tråd så att event-loopen inte väntar på disken."""
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key: str, response: str):
+        """Som set(), men skrivningen körs i en tråd."""
+        await asyncio.to_thread(self.set, key, response)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": self.entries,
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+        }
@@ -0,0 +1,541 @@
+"""
+Schemaläggare för kontinuerlig batchning
+
+Samlar samtidiga genereringsförfrågningar och kör dem genom modellen som en
+dynamiskt paddad batch. Nya sekvenser läggs till och färdiga sekvenser tas
+bort mellan avkodningsstegen, så att hårdvaran inte står stilla medan en
+enskild prompt avkodas.
+"""
+
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import torch
+
+from .adapters import AdapterRegistry
+from .prefix_cache import PrefixCache
+
+try:
+    from transformers import DynamicCache
+except ImportError:  # Äldre transformers använder tupler som KV-cache
+    DynamicCache = None
+
+logger = logging.getLogger(__name__)
+
+# Signal som får arbetstråden att avsluta
+_SHUTDOWN = object()
+# Signal som väcker arbetstråden så att den kör väntande kontrollanrop
+_WAKE = object()
+
+# Standardvärden när en förfrågan inte anger (eller anger None för) ett värde
+DEFAULT_MAX_TOKENS = 150
+DEFAULT_TEMPERATURE = 0.7
+DEFAULT_TOP_P = 0.95
+
+# Fönster, i sekunder, som genomströmningen i tokens/s räknas över
+THROUGHPUT_WINDOW = 10.0
+
+
+class QueueFullError(RuntimeError):
+    """Kön med väntande förfrågningar är full."""
+
+
+class SchedulerStoppedError(RuntimeError):
+    """Schemaläggarens arbetstråd körs inte."""
+
+
+class EmptyPromptError(ValueError):
+    """Prompten blir inga tokens och tokenizern har ingen BOS-token att börja med."""
+
+
+@dataclass
+class GenerationJob:
+    """En enskild genereringsförfrågan i schemaläggaren."""
+
+    prompt: str
+    max_tokens: int = DEFAULT_MAX_TOKENS
+    temperature: float = DEFAULT_TEMPERATURE
+    top_p: float = DEFAULT_TOP_P
+    seed: Optional[int] = None
+    adapter: Optional[str] = None
+    on_token: Optional[Callable[[int], None]] = None
+    future: Future = field(default_factory=Future)
+    generated: List[int] = field(default_factory=list)
+    cancelled: bool = False
+    generator: Optional[torch.Generator] = None
+
+    def __post_init__(self):
+        # None från API:et betyder standardvärdet, som för HF generate
+        if self.max_tokens is None:
+            self.max_tokens = DEFAULT_MAX_TOKENS
+        if self.temperature is None:
+            self.temperature = DEFAULT_TEMPERATURE
+        if self.top_p is None:
+            self.top_p = DEFAULT_TOP_P
+
+    def cancel(self):
+        """Avbryt sekvensen. Den tas bort ur batchen före nästa avkodningssteg."""
+        self.cancelled = True
+
+    def is_finished(self, eos_token_id: Optional[int]) -> bool:
+        """Kontrollera om sekvensen är klar."""
+        if self.cancelled or len(self.generated) >= self.max_tokens:
+            return True
+        return bool(self.generated) and eos_token_id is not None and self.generated[-1] == eos_token_id
+
+
+@dataclass
+class _RunningBatch:
+    """Sekvenser som avkodas tillsammans, vänsterpaddade till samma längd."""
+
+    jobs: List[GenerationJob]
+    past_key_values: Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+    attention_mask: torch.Tensor
+    next_tokens: torch.Tensor
+
+
+def _to_legacy_cache(past_key_values):
+    """Konvertera modellens KV-cache till tupelformatet (lager, (nycklar, värden))."""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    if hasattr(past_key_values, "layers"):
+        return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+    return past_key_values
+
+
+def _to_model_cache(past_key_values):
+    """Konvertera tupelformatet till det format modellen förväntar sig."""
+    if DynamicCache is None:
+        return past_key_values
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(past_key_values)
+    return DynamicCache(past_key_values)
+
+
+def _left_pad(tensor: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    """Vänsterpadda en tensor med nollor längs sekvensdimensionen."""
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+def _merge_batches(first: _RunningBatch, second: _RunningBatch) -> _RunningBatch:
+    """Slå ihop två batchar genom att vänsterpadda till gemensam längd."""
+    length = max(first.attention_mask.shape[1], second.attention_mask.shape[1])
+    past_key_values = tuple(
+        (
+            torch.cat([_left_pad(k1, length, 2), _left_pad(k2, length, 2)], dim=0),
+            torch.cat([_left_pad(v1, length, 2), _left_pad(v2, length, 2)], dim=0),
+        )
+        for (k1, v1), (k2, v2) in zip(first.past_key_values, second.past_key_values)
+    )
+    attention_mask = torch.cat(
+        [_left_pad(first.attention_mask, length, 1), _left_pad(second.attention_mask, length, 1)],
+        dim=0,
+    )
+    return _RunningBatch(
+        jobs=first.jobs + second.jobs,
+        past_key_values=past_key_values,
+        attention_mask=attention_mask,
+        next_tokens=torch.cat([first.next_tokens, second.next_tokens]),
+    )
+
+
+def _select_rows(batch: _RunningBatch, keep: List[int]) -> _RunningBatch:
+    """Behåll endast angivna rader och ta bort kolumner som bara innehåller padding."""
+    index = torch.tensor(keep, device=batch.attention_mask.device)
+    attention_mask = batch.attention_mask.index_select(0, index)
+    # Kolumner längst till vänster som är padding för alla rader kan kastas
+    start = int(attention_mask.any(dim=0).nonzero()[0])
+    past_key_values = tuple(
+        (k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:])
+        for k, v in batch.past_key_values
+    )
+    return _RunningBatch(
+        jobs=[batch.jobs[i] for i in keep],
+        past_key_values=past_key_values,
+        attention_mask=attention_mask[:, start:],
+        next_tokens=batch.next_tokens.index_select(0, index),
+    )
+
+
+def sample_tokens(
+    logits: torch.Tensor,
+    temperatures: torch.Tensor,
+    top_ps: torch.Tensor,
+    generators: Optional[List[Optional[torch.Generator]]] = None,
+) -> torch.Tensor:
+    """
+    Välj nästa token för varje rad med radens egen temperatur och top_p.
+
+    En temperatur på 0 eller lägre ger girig avkodning för den raden. Rader
+    med en egen generator (från en seed) samplas reproducerbart.
+    """
+    logits = logits.float()
+    greedy = logits.argmax(dim=-1)
+    probs = torch.softmax(logits / temperatures.clamp(min=1e-5).unsqueeze(-1), dim=-1)
+    sorted_probs, sorted_indices = probs.sort(dim=-1, descending=True)
+    # Nucleus sampling: behåll de mest sannolika tokens tills top_p har uppnåtts
+    outside_nucleus = sorted_probs.cumsum(dim=-1) - sorted_probs > top_ps.unsqueeze(-1)
+    sorted_probs = sorted_probs.masked_fill(outside_nucleus, 0.0)
+    if generators is None or all(generator is None for generator in generators):
+        choice = torch.multinomial(sorted_probs, num_samples=1)
+    else:
+        choice = torch.stack([
+            torch.multinomial(row, num_samples=1, generator=generator)
+            for row, generator in zip(sorted_probs, generators)
+        ])
+    sampled = sorted_indices.gather(-1, choice).squeeze(-1)
+    return torch.where(temperatures <= 0, greedy, sampled)
+
+
+class BatchScheduler:
+    """
+    Kör genereringsförfrågningar med kontinuerlig batchning i en egen tråd.
+
+    Förfrågningar läggs i en kö med submit(). Mellan varje avkodningssteg
+    tas nya förfrågningar in i den körande batchen och färdiga sekvenser
+    tas bort, så att varje sekvens avslutas så snart den är klar.
+
+    Med ett AdapterRegistry kan varje förfrågan välja en LoRA-adapter.
+    Förfrågningar för samma adapter avkodas i samma batch, och varje
+    avkodningssteg kör en forward-körning per adapter som används.
+
+    Högst max_queue_size förfrågningar får vänta på en plats i batchen;
+    därutöver avvisas de med QueueFullError. 0 betyder obegränsad kö.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size: int = 8,
+        max_queue_size: int = 0,
+        prefix_cache: Optional[PrefixCache] = None,
+        adapters: Optional[AdapterRegistry] = None,
+    ):
+        self._model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_queue_size = max_queue_size
+        self.prefix_cache = prefix_cache
+        self.adapters = adapters
+        self.eos_token_id = tokenizer.eos_token_id
+        self._queue: "queue.Queue" = queue.Queue()
+        self._controls: "queue.Queue" = queue.Queue()
+        self._batches: Dict[Optional[str], _RunningBatch] = {}
+        self._thread: Optional[threading.Thread] = None
+
+        # Räknare för /metrics. Endast arbetstråden skriver till dem, så de
+        # behöver inget lås; läsaren får en ögonblicksbild via stats().
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.generated_tokens = 0
+        self.completed_requests = 0
+        self.failed_requests = 0
+        self.decode_steps = 0
+        # Antal avkodningssteg per batchstorlek (index = antal sekvenser)
+        self.decode_batch_sizes = [0] * (max_batch_size + 1)
+        self._recent_tokens: deque = deque()
+
+    @property
+    def model(self):
+        # Registret byter ut modellen när den första adaptern laddas
+        return self.adapters.model if self.adapters else self._model
+
+    @property
+    def device(self) -> torch.device:
+        return self.model.device
+
+    @property
+    def batch_size(self) -> int:
+        """Antal sekvenser i de körande batcharna."""
+        return sum(len(batch.jobs) for batch in list(self._batches.values()))
+
+    @property
+    def queue_depth(self) -> int:
+        """Antal förfrågningar som väntar på en plats i batchen."""
+        return self._queue.qsize()
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def active_adapters(self) -> List[Optional[str]]:
+        """Adapters som används av sekvenser som avkodas just nu."""
+        return list(self._batches)
+
+    def start(self):
+        """Starta arbetstråden."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stoppa arbetstråden efter pågående steg."""
+        self._queue.put(_SHUTDOWN)
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def submit(
+        self,
+        prompt: str,
+        max_tokens: Optional[int] = DEFAULT_MAX_TOKENS,
+        temperature: Optional[float] = DEFAULT_TEMPERATURE,
+        top_p: Optional[float] = DEFAULT_TOP_P,
+        seed: Optional[int] = None,
+        adapter: Optional[str] = None,
+    ) -> Future:
+        """Lägg en förfrågan i kön och returnera en Future med den genererade texten."""
+        job = GenerationJob(
+            prompt=prompt,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            seed=seed,
+            adapter=adapter,
+        )
+        return self.enqueue(job)
+
+    def enqueue(self, job: GenerationJob) -> Future:
+        """Lägg ett färdigt jobb i kön, t.ex. ett med on_token för strömning."""
+        if not self.is_running:
+            raise SchedulerStoppedError("Schemaläggaren körs inte")
+        if not job.prompt and self.tokenizer.bos_token_id is None:
+            raise EmptyPromptError("Prompten är tom")
+        if self.max_queue_size and self.queue_depth >= self.max_queue_size:
+            raise QueueFullError(f"Kön är full ({self.max_queue_size} väntande förfrågningar)")
+        self._queue.put(job)
+        return job.future
+
+    def run_in_worker(self, fn: Callable[[], Any]) -> Future:
+        """
+        Kör fn i arbetstråden mellan två avkodningssteg.
+
+        Används för att ändra modellen (t.ex. ladda adapters) utan att krocka
+        med en pågående forward-körning.
+        """
+        if not self.is_running:
+            raise SchedulerStoppedError("Schemaläggaren körs inte")
+        future: Future = Future()
+        self._controls.put((fn, future))
+        self._queue.put(_WAKE)
+        return future
+
+    def _run(self):
+        with torch.inference_mode():
+            while True:
+                self._run_controls()
+                if not self._admit(block=not self._batches):
+                    break
+                for adapter in list(self._batches):
+                    try:
+                        self._decode_step(adapter)
+                    except Exception as e:
+                        logger.error(f"Fel vid avkodning av batch: {e}", exc_info=True)
+                        for job in self._batches.pop(adapter).jobs:
+                            job.future.set_exception(e)
+                            self.failed_requests += 1
+
+        # Förfrågningar som fortfarande körs när servern stängs ner får ett fel
+        for batch in self._batches.values():
+            for job in batch.jobs:
+                job.future.set_exception(RuntimeError("Schemaläggaren har stoppats"))
+        self._batches.clear()
+
+    def _run_controls(self):
+        while True:
+            try:
+                fn, future = self._controls.get_nowait()
+            except queue.Empty:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn())
+            except Exception as e:
+                future.set_exception(e)
+
+    def _admit(self, block: bool) -> bool:
+        """Ta in väntande förfrågningar i batchen. Returnerar False vid avstängning."""
+        while self.batch_size < self.max_batch_size:
+            try:
+                job = self._queue.get(block=block)
+            except queue.Empty:
+                break
+            if job is _SHUTDOWN:
+                return False
+            if job is _WAKE:
+                self._run_controls()
+                continue
+            block = False
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            if job.cancelled:
+                self._finish(job)
+                continue
+            try:
+                prefilled = self._prefill(job)
+                if prefilled is not None:
+                    running = self._batches.get(job.adapter)
+                    self._batches[job.adapter] = prefilled if running is None else _merge_batches(running, prefilled)
+            except Exception as e:
+                logger.error(f"Fel vid prefill: {e}", exc_info=True)
+                if not job.future.done():
+                    job.future.set_exception(e)
+                    self.failed_requests += 1
+        return True
+
+    def _use_adapter(self, adapter: Optional[str]):
+        """Aktivera förfrågans adapter under en forward-körning."""
+        if self.adapters is None:
+            return nullcontext(self.model)
+        return self.adapters.use(adapter, pinned=self._batches)
+
+    def _prefill(self, job: GenerationJob) -> Optional[_RunningBatch]:
+        """Kör prompten genom modellen och välj den första token."""
+        token_ids = self.tokenizer.encode(job.prompt)
+        if not token_ids:
+            # En tom prompt utan BOS från tokenizern börjar från BOS-token
+            if self.tokenizer.bos_token_id is None:
+                raise EmptyPromptError("Prompten gav inga tokens")
+            token_ids = [self.tokenizer.bos_token_id]
+        self.prompt_tokens += len(token_ids)
+        if job.seed is not None:
+            job.generator = torch.Generator(device=self.device).manual_seed(job.seed)
+
+        with self._use_adapter(job.adapter) as model:
+            # KV-tillståndet beror på adaptern, så varje adapter har egna prefix i cachen
+            namespace = (self.adapters.identity(job.adapter) if self.adapters else None) or ""
+            prefix_length, cached = (
+                self.prefix_cache.lookup(token_ids, namespace) if self.prefix_cache else (0, None)
+            )
+
+            # Vid träff i prefix-cachen körs prefill endast på resten av prompten
+            input_ids = torch.tensor([token_ids[prefix_length:]], dtype=torch.long, device=self.device)
+            kwargs = {}
+            if cached is not None:
+                kwargs = {
+                    "past_key_values": _to_model_cache(cached),
+                    "attention_mask": torch.ones((1, len(token_ids)), dtype=torch.long, device=self.device),
+                    "position_ids": torch.arange(prefix_length, len(token_ids), device=self.device).unsqueeze(0),
+                }
+            outputs = model(input_ids=input_ids, use_cache=True, **kwargs)
+        self.cached_prompt_tokens += prefix_length
+
+        past_key_values = _to_legacy_cache(outputs.past_key_values)
+        if self.prefix_cache:
+            self.prefix_cache.insert(token_ids, past_key_values, namespace)
+
+        next_tokens = self._sample(outputs.logits[:, -1, :], [job])
+        self._append_token(job, int(next_tokens[0]))
+        if job.is_finished(self.eos_token_id):
+            self._finish(job)
+            return None
+        return _RunningBatch(
+            jobs=[job],
+            past_key_values=past_key_values,
+            attention_mask=torch.ones((1, len(token_ids)), dtype=torch.long, device=self.device),
+            next_tokens=next_tokens,
+        )
+
+    def _decode_step(self, adapter: Optional[str]):
+        """Avkoda en token för varje sekvens i adapterns batch och ta bort de som är klara."""
+        batch = self._batches[adapter]
+        # Varje rad har sin egen position eftersom raderna är vänsterpaddade
+        position_ids = batch.attention_mask.sum(dim=1, keepdim=True)
+        attention_mask = torch.cat([batch.attention_mask, batch.attention_mask.new_ones((len(batch.jobs), 1))], dim=1)
+        with self._use_adapter(adapter) as model:
+            outputs = model(
+                input_ids=batch.next_tokens.unsqueeze(-1),
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=_to_model_cache(batch.past_key_values),
+                use_cache=True,
+            )
+        next_tokens = self._sample(outputs.logits[:, -1, :], batch.jobs)
+        self._record_decode_step(len(batch.jobs))
+        batch.past_key_values = _to_legacy_cache(outputs.past_key_values)
+        batch.attention_mask = attention_mask
+        batch.next_tokens = next_tokens
+
+        keep = []
+        for i, (job, token) in enumerate(zip(batch.jobs, next_tokens.tolist())):
+            self._append_token(job, token)
+            if job.is_finished(self.eos_token_id):
+                self._finish(job)
+            else:
+                keep.append(i)
+
+        if not keep:
+            del self._batches[adapter]
+        elif len(keep) < len(batch.jobs):
+            self._batches[adapter] = _select_rows(batch, keep)
+
+    def _append_token(self, job: GenerationJob, token: int):
+        job.generated.append(token)
+        self.generated_tokens += 1
+        if job.on_token is None:
+            return
+        try:
+            job.on_token(token)
+        except Exception as e:
+            # Ett fel hos en strömmande klient får inte stoppa resten av batchen
+            logger.error(f"Fel i on_token-callback: {e}", exc_info=True)
+            job.cancel()
+
+    def _sample(self, logits: torch.Tensor, jobs: List[GenerationJob]) -> torch.Tensor:
+        temperatures = torch.tensor([job.temperature for job in jobs], device=logits.device)
+        top_ps = torch.tensor([job.top_p for job in jobs], device=logits.device)
+        return sample_tokens(logits, temperatures, top_ps, [job.generator for job in jobs])
+
+    def _finish(self, job: GenerationJob):
+        """Dekodera svaret (utan prompten) och leverera det till anroparen."""
+        text = self.tokenizer.decode(job.generated, skip_special_tokens=True)
+        self.completed_requests += 1
+        job.future.set_result(text)
+
+    def _record_decode_step(self, size: int):
+        """Räkna ett avkodningssteg och dess tokens för genomströmningen."""
+        self.decode_steps += 1
+        self.decode_batch_sizes[min(size, self.max_batch_size)] += 1
+        now = time.monotonic()
+        self._recent_tokens.append((now, size))
+        while self._recent_tokens and self._recent_tokens[0][0] < now - THROUGHPUT_WINDOW:
+            self._recent_tokens.popleft()
+
+    @property
+    def tokens_per_second(self) -> float:
+        """Avkodade tokens per sekund under de senaste THROUGHPUT_WINDOW sekunderna."""
+        recent = list(self._recent_tokens)
+        now = time.monotonic()
+        return sum(tokens for at, tokens in recent if at >= now - THROUGHPUT_WINDOW) / THROUGHPUT_WINDOW
+
+    def stats(self) -> Dict[str, Any]:
+        """Räknare och aktuellt läge, för /metrics."""
+        return {
+            "batch_size": self.batch_size,
+            "max_batch_size": self.max_batch_size,
+            "queue_depth": self.queue_depth,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_prompt_tokens": self.cached_prompt_tokens,
+            "generated_tokens": self.generated_tokens,
+            "completed_requests": self.completed_requests,
+            "failed_requests": self.failed_requests,
+            "decode_steps": self.decode_steps,
+            "decode_batch_sizes": list(self.decode_batch_sizes),
+            "tokens_per_second": round(self.tokens_per_second, 2),
+        }
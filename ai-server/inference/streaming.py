@@ -0,0 +1,84 @@
+"""
+Strömning av genererade tokens
+
+Kopplar ihop schemaläggarens arbetstråd med event-loopen så att texten kan
+skickas till klienten medan den genereras.
+"""
+
+import asyncio
+from concurrent.futures import Future
+from typing import AsyncIterator, List
+
+from .scheduler import BatchScheduler, GenerationJob
+
+# Markerar att jobbet är klart i kön mellan tråden och event-loopen
+_END = object()
+
+
+class IncrementalDecoder:
+    """
+    Dekodera tokens stegvis och returnera endast den nya texten.
+
+    En token motsvarar inte alltid hela tecken, och hur en token dekodas kan
+    bero på den före (t.ex. inledande mellanslag). Därför dekodas ett litet
+    fönster: de senast skickade tokens (prefixet) plus de nya, och den nya
+    texten är det som tillkommit efter prefixets text. Fönstret flyttas fram
+    när text har skickats, så varje token kostar lika mycket oavsett hur
+    lång sekvensen är (som TextStreamer i transformers). Text som slutar med
+    ett ofullständigt UTF-8-tecken hålls kvar tills nästa token kommer.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.tokens: List[int] = []
+        # Fönstret är tokens[prefix_offset:]; tokens före read_offset har redan skickats
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def push(self, token: int) -> str:
+        """Lägg till en token och returnera texten som tillkommit sedan förra anropet."""
+        self.tokens.append(token)
+        prefix = self.tokenizer.decode(self.tokens[self.prefix_offset:self.read_offset], skip_special_tokens=True)
+        text = self.tokenizer.decode(self.tokens[self.prefix_offset:], skip_special_tokens=True)
+        if len(text) <= len(prefix) or text.endswith("�"):
+            return ""
+        self.prefix_offset, self.read_offset = self.read_offset, len(self.tokens)
+        return text[len(prefix):]
+
+
+def stream_job(scheduler: BatchScheduler, job: GenerationJob) -> AsyncIterator[str]:
+    """
+    Lägg ett jobb i schemaläggaren och returnera en iterator som ger texten bit för bit.
+
+    Jobbet köas direkt, så QueueFullError och SchedulerStoppedError kastas
+    innan något har skickats till klienten. Om konsumenten slutar läsa
+    (t.ex. när klienten kopplar ner) avbryts jobbet så att dess plats i
+    batchen frigörs.
+    """
+    loop = asyncio.get_running_loop()
+    chunks: asyncio.Queue = asyncio.Queue()
+    decoder = IncrementalDecoder(scheduler.tokenizer)
+
+    def on_token(token: int):
+        # Körs i schemaläggarens tråd
+        delta = decoder.push(token)
+        if delta:
+            loop.call_soon_threadsafe(chunks.put_nowait, delta)
+
+    job.on_token = on_token
+    future = scheduler.enqueue(job)
+    future.add_done_callback(lambda _: loop.call_soon_threadsafe(chunks.put_nowait, _END))
+    return _iterate_chunks(job, future, chunks)
+
+
+async def _iterate_chunks(job: GenerationJob, future: Future, chunks: asyncio.Queue) -> AsyncIterator[str]:
+    try:
+        while True:
+            chunk = await chunks.get()
+            if chunk is _END:
+                break
+            yield chunk
+        # Skicka vidare eventuella fel från schemaläggaren
+        future.result()
+    finally:
+        job.cancel()
@@ -0,0 +1,165 @@
+"""
+Load test for idle computer use tasks
+
+Measures how much CPU the API server spends on tasks that are running but
+idle (waiting for the LLM or the browser) or paused. The browser-use agent
+is replaced by one that waits until it is stopped, so only the server's own
+per-task overhead is measured: scheduling, message delivery and pause/stop
+handling. With event-driven tasks the CPU time per task should stay flat,
+close to zero, as the number of tasks grows.
+
+Examples:
+    python load_test_tasks.py --tasks 10,100,1000 --duration 5
+    python load_test_tasks.py --tasks 500 --paused-fraction 0.5 --output load.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import types
+from typing import Any, Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_api(max_tasks: int):
+    """
+    Import api.py, which imports its package as ai_server, from this directory.
+
+    Args:
+        max_tasks: Largest number of tasks that should run at the same time.
+
+    Returns:
+        The api module.
+    """
+    os.environ.setdefault("MAX_CONCURRENT_TASKS", str(max_tasks))
+    os.environ.setdefault("MAX_QUEUED_TASKS", str(max_tasks))
+    os.environ.setdefault("TASK_ARCHIVE_PATH", "")
+    os.environ.setdefault("BROWSER_POOL_PREWARM", "")
+    if "ai_server" not in sys.modules:
+        package = types.ModuleType("ai_server")
+        package.__path__ = [HERE]
+        sys.modules["ai_server"] = package
+    import ai_server.api as api
+
+    return api
+
+
+class IdleBrowserAgent:
+    """Stands in for a browser-use Agent that is busy for as long as the task lasts."""
+
+    def __init__(self, task: str):
+        self.task = task
+        self.history: List[Any] = []
+
+    async def run(self, max_steps: int):
+        await asyncio.Event().wait()
+
+
+def make_idle_agent_class(api):
+    class IdleAgent(api.ComputerUseAgent):
+        """A ComputerUseAgent without a browser or LLM calls."""
+
+        async def create_agent(self, task: str):
+            return IdleBrowserAgent(task)
+
+    return IdleAgent
+
+
+async def measure(api, count: int, duration: float, paused_fraction: float) -> Dict[str, Any]:
+    """
+    Start idle tasks, measure the process CPU time while they run, then stop them.
+
+    Args:
+        api: The api module.
+        count: Number of tasks to start.
+        duration: Seconds to measure for.
+        paused_fraction: Fraction of the tasks to pause before measuring.
+
+    Returns:
+        The measurements.
+    """
+    task_ids = []
+    for i in range(count):
+        request = api.ComputerUseRequest(task=f"idle task {i}", openai_api_key="load-test", headless=True)
+        response = await api.start_computer_use_task(request)
+        task_ids.append(response.task_id)
+
+    # Let the scheduler start every task
+    while any(api.task_states[task_id]["status"] != "running" for task_id in task_ids):
+        await asyncio.sleep(0.05)
+    for task_id in task_ids[: int(count * paused_fraction)]:
+        await api.pause_task(task_id)
+    await asyncio.sleep(0.2)
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    await asyncio.sleep(duration)
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+
+    for task_id in task_ids:
+        await api.stop_task(task_id)
+    while api.task_scheduler.stats()["running"]:
+        await asyncio.sleep(0.05)
+
+    return {
+        "tasks": count,
+        "paused": int(count * paused_fraction),
+        "duration_s": round(wall, 3),
+        "cpu_percent": round(100 * cpu / wall, 3),
+        "cpu_us_per_task_per_s": round(1e6 * cpu / wall / count, 3) if count else None,
+    }
+
+
+async def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    counts = [int(count) for count in args.tasks.split(",")]
+    api = import_api(max(counts))
+    api.ComputerUseAgent = make_idle_agent_class(api)
+
+    results = []
+    # Baseline with no tasks, to tell the server's own overhead from the event loop's
+    for count in [0] + counts:
+        if count == 0:
+            cpu_start, wall_start = time.process_time(), time.perf_counter()
+            await asyncio.sleep(args.duration)
+            result = {
+                "tasks": 0,
+                "paused": 0,
+                "duration_s": round(time.perf_counter() - wall_start, 3),
+                "cpu_percent": round(100 * (time.process_time() - cpu_start) / args.duration, 3),
+                "cpu_us_per_task_per_s": None,
+            }
+        else:
+            result = await measure(api, count, args.duration, args.paused_fraction)
+        results.append(result)
+        print(
+            f"{result['tasks']:>6} tasks ({result['paused']} paused): "
+            f"{result['cpu_percent']:.3f}% CPU, "
+            f"{result['cpu_us_per_task_per_s'] if count else '-'} us CPU per task per second",
+            file=sys.stderr,
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the CPU cost of idle computer use tasks")
+    parser.add_argument("--tasks", default="10,100,500", help="Comma-separated numbers of concurrent tasks")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds to measure for each count")
+    parser.add_argument("--paused-fraction", type=float, default=0.0, help="Fraction of tasks to pause")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,19 +6,30 @@ using browser-use and OpenAI.
 """
 
 import os
+import heapq
+import json
 import logging
-from typing import Dict, Any, Optional, List
+from typing import Callable, Dict, Any, Optional, List, Set
 from uuid import uuid4
 import asyncio
 from datetime import datetime
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 
+from metrics import REGISTRY, MetricsMiddleware, metrics_endpoint
+from computer_use.agent_metrics import agent_metric_families, record_task_finished
 from computer_use.service import ComputerUseAgent
 from computer_use.config import ComputerUseConfig
+from computer_use.browser_pool import browser_pool_stats, close_browser_pools, prewarm_browser_pools
+from computer_use.llm_pool import close_llm_pool, llm_pool_stats
+from computer_use.task_scheduler import TaskQueueFullError, TaskScheduler
+from computer_use.task_store import TaskStore
+from computer_use.state_backend import WORKER_ID, create_state_backend
+from computer_use.timings import StepTimings, timing_histograms
+from computer_use.task_views import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, cached_json_response, history_page, paginate
 
 # Load environment variables
 load_dotenv()
@@ -42,8 +53,96 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Store active tasks
-active_tasks: Dict[str, Dict[str, Any]] = {}
+# Time every request by route and serve the metrics in Prometheus format
+app.add_middleware(MetricsMiddleware)
+app.add_route("/metrics", metrics_endpoint, include_in_schema=False)
+
+# Limits how many agents run at once; the rest wait in a bounded queue
+task_scheduler = TaskScheduler()
+
+# Store tasks; finished tasks are compacted and eventually archived to disk
+active_tasks = TaskStore(
+    compact=lambda task_info: {k: v for k, v in task_info.items() if k != "agent"},
+    on_evict=task_scheduler.forget,
+)
+
+# Task, browser, screenshot and LLM metrics are read from the components at scrape time
+REGISTRY.register_collector(lambda: agent_metric_families(task_scheduler, active_tasks))
+
+# Shares task state with other workers and routes control commands to the worker running a task
+state_backend = create_state_backend()
+
+def public_task(task_id: str, task_info: Dict[str, Any]) -> Dict[str, Any]:
+    """A task's state without the agent and its timings, as returned to clients."""
+    task = {k: v for k, v in task_info.items() if k not in ("agent", "timings")}
+    if task_info.get("agent") is not None:
+        task["vision"] = task_info["agent"].vision_stats()
+        task["context"] = task_info["agent"].context_stats()
+    task["scheduling"] = task_scheduler.info(task_id) or task_info.get("scheduling")
+    return task
+
+def task_version(task: Dict[str, Any]) -> tuple:
+    """
+    A cheap key that changes whenever a task's public state changes.
+
+    Stored fields bump the task's version when they change (see update_task
+    and save_task). The vision and context counters are read live from the
+    agent, so they are part of the key themselves; they are small, unlike
+    the history. Of the live scheduling info only the status and queue
+    position count: run_seconds is a clock and would change every request.
+    """
+    scheduling = task.get("scheduling") or {}
+    live = json.dumps([task.get("vision"), task.get("context")], sort_keys=True, default=str)
+    return (task.get("id"), task.get("version", 0), scheduling.get("status"), scheduling.get("queue_position"), live)
+
+def update_task(task_id: str, **changes: Any):
+    """Change fields of a task's state and its version, so that polling clients see the change."""
+    if not active_tasks.is_in_memory(task_id) or active_tasks.is_finished(task_id):
+        # Compacted and counted records no longer change
+        return
+    task_info = active_tasks[task_id]
+    task_info.update(changes)
+    task_info["version"] = task_info.get("version", 0) + 1
+
+async def save_task(task_id: str, finished: bool = False):
+    """Record a change to a task's state and publish it so that other workers can serve it."""
+    if not active_tasks.is_in_memory(task_id) or active_tasks.is_finished(task_id):
+        return
+    task_info = active_tasks[task_id]
+    # Lets polling clients tell whether anything changed since their last request
+    task_info["version"] = task_info.get("version", 0) + 1
+    if not state_backend.shared:
+        return
+    try:
+        record = public_task(task_id, task_info)
+        await state_backend.save_task(task_id, record, owner=WORKER_ID, finished=finished)
+    except Exception as e:
+        logger.error(f"Error saving state of task {task_id}: {e}", exc_info=True)
+
+async def forward_control(task_id: str, command: str, **kwargs: Any) -> bool:
+    """
+    Send a control command to the worker running a task.
+
+    Returns:
+        True if another worker owns the task and the command was sent.
+    """
+    owner = await state_backend.task_owner(task_id)
+    if owner is None or owner == WORKER_ID:
+        return False
+    await state_backend.send_control(owner, {"task_id": task_id, "command": command, **kwargs})
+    return True
+
+async def finish_task(task_id: str):
+    """Release a finished task's agent and let the store compact it. Only the first call has an effect."""
+    if active_tasks.is_in_memory(task_id) and not active_tasks.is_finished(task_id):
+        scheduling = task_scheduler.info(task_id)
+        if scheduling and scheduling["status"] == "running":
+            # Called from the task itself, just before the scheduler sees it finish
+            scheduling["status"] = "finished"
+        active_tasks[task_id]["scheduling"] = scheduling
+        record_task_finished(active_tasks[task_id].get("status"))
+        await save_task(task_id, finished=True)
+        active_tasks.finish(task_id)
 
 # Models
 class TaskConfig(BaseModel):
@@ -51,24 +150,67 @@ class TaskConfig(BaseModel):
     openai_api_key: Optional[str] = None
     deepseek_api_key: Optional[str] = None
     deepseek_endpoint: Optional[str] = None
+    deepseek_adapter: Optional[str] = None
     headless: bool = False
     use_vision: bool = True
+    optimize_vision: bool = True
+    compact_context: bool = True
     max_steps: int = 20
     
 class TaskRequest(BaseModel):
     task: str
     config: Optional[TaskConfig] = None
+    priority: int = 0
     
 class MessageRequest(BaseModel):
     message: str
 
+@app.on_event("startup")
+async def startup():
+    prewarm_browser_pools()
+    if state_backend.shared:
+        app.state.control_listener = asyncio.create_task(handle_control_commands())
+
+@app.on_event("shutdown")
+async def shutdown():
+    if state_backend.shared:
+        app.state.control_listener.cancel()
+    await close_browser_pools()
+    await close_llm_pool()
+    await state_backend.close()
+    await active_tasks.flush()
+
+async def handle_control_commands():
+    """Apply control commands that other workers forwarded for tasks running here."""
+    handlers = {
+        "pause": pause_task,
+        "resume": resume_task,
+        "stop": stop_task,
+        "message": lambda task_id, message: send_message_to_task(task_id, MessageRequest(message=message)),
+    }
+    while True:
+        try:
+            async for command in state_backend.control_messages(WORKER_ID):
+                task_id = command.pop("task_id")
+                try:
+                    await handlers[command.pop("command")](task_id, **command)
+                except HTTPException as e:
+                    logger.warning(f"Control command for task {task_id} failed: {e.detail}")
+                except Exception as e:
+                    logger.error(f"Error applying control command for task {task_id}: {e}", exc_info=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error receiving control commands: {e}", exc_info=True)
+            await asyncio.sleep(1)
+
 # Routes
 @app.get("/")
 async def root():
     return {"status": "online", "message": "AI Server is running"}
 
 @app.post("/computer-use/tasks")
-async def create_task(request: TaskRequest, background_tasks: BackgroundTasks):
+async def create_task(request: TaskRequest):
     task_id = str(uuid4())
     
     # Create configuration
@@ -77,19 +219,33 @@ async def create_task(request: TaskRequest, background_tasks: BackgroundTasks):
         openai_api_key=request.config.openai_api_key if request.config else None,
         deepseek_api_key=request.config.deepseek_api_key if request.config else None,
         deepseek_endpoint=request.config.deepseek_endpoint if request.config else None,
+        deepseek_adapter=request.config.deepseek_adapter if request.config else None,
         headless=request.config.headless if request.config else False,
         use_vision=request.config.use_vision if request.config else True,
+        optimize_vision=request.config.optimize_vision if request.config else True,
+        compact_context=request.config.compact_context if request.config else True,
         max_steps=request.config.max_steps if request.config else 20,
     )
     
     # Create agent
     agent = ComputerUseAgent(config=config)
     
+    # Queue the task; it starts as soon as a slot is free
+    try:
+        task_scheduler.submit(
+            task_id,
+            lambda: run_task(task_id, request.task, agent),
+            owner=config.get_active_api_key(),
+            priority=request.priority,
+        )
+    except TaskQueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+    
     # Store task information
     active_tasks[task_id] = {
         "id": task_id,
         "task": request.task,
-        "status": "pending",
+        "status": "queued",
         "created_at": datetime.now().isoformat(),
         "agent": agent,
         "history": [],
@@ -97,34 +253,80 @@ async def create_task(request: TaskRequest, background_tasks: BackgroundTasks):
         "reasoning": None,
         "messages": [],
     }
-    
-    # Run task in background
-    background_tasks.add_task(run_task, task_id, request.task, agent)
+    await save_task(task_id)
     
     return {
         "task_id": task_id,
-        "status": "pending",
-        "message": "Task created and starting execution",
+        "status": "queued",
+        "queue_position": task_scheduler.queue_position(task_id),
+        "message": "Task created and queued for execution",
     }
 
+async def get_task_info(task_id: str) -> Dict[str, Any]:
+    """Get a task's public state from this worker or, if another worker runs it, from the state backend."""
+    task_info = await active_tasks.aget(task_id)
+    if task_info is not None:
+        return public_task(task_id, task_info)
+    task = await state_backend.load_task(task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail=f"Task {task_id} not found")
+    return task
+
 @app.get("/computer-use/tasks/{task_id}")
-async def get_task_status(task_id: str):
-    if task_id not in active_tasks:
+async def get_task_status(task_id: str, request: Request):
+    task = await get_task_info(task_id)
+    return cached_json_response(request, ("task",) + task_version(task), lambda: task)
+
+@app.get("/computer-use/tasks/{task_id}/status")
+async def get_task_status_only(task_id: str, request: Request):
+    # Same as get_task_status without the history; use /history to page through it
+    task = await get_task_info(task_id)
+    return cached_json_response(
+        request,
+        ("status",) + task_version(task),
+        lambda: {k: v for k, v in task.items() if k != "history"},
+    )
+
+@app.get("/computer-use/tasks/{task_id}/history")
+async def get_task_history(
+    task_id: str,
+    request: Request,
+    since: int = Query(0, ge=0),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+):
+    # Steps after the cursor "since"; pass the returned "next" to get only new steps
+    task = await get_task_info(task_id)
+    return cached_json_response(
+        request,
+        ("history", since, limit) + task_version(task),
+        lambda: {"task_id": task_id, **history_page(task.get("history"), since, limit)},
+    )
+
+@app.get("/computer-use/tasks/{task_id}/timings")
+async def get_task_timings(task_id: str):
+    # Spans per step (LLM, actions, page state) with histograms over the task's steps;
+    # only the worker that ran a task has its timings
+    task_info = await active_tasks.aget(task_id)
+    if task_info is None:
         raise HTTPException(status_code=404, detail=f"Task {task_id} not found")
-    
-    task_info = active_tasks[task_id]
-    
-    # Exclude agent from response
-    response = {k: v for k, v in task_info.items() if k != "agent"}
-    
-    return response
+    agent = task_info.get("agent")
+    timings = agent.timings.to_dict() if agent is not None else task_info.get("timings") or StepTimings().to_dict()
+    scheduling = task_scheduler.info(task_id) or task_info.get("scheduling") or {}
+    return {
+        "task_id": task_id,
+        "status": task_info.get("status"),
+        "queue_wait_seconds": scheduling.get("queue_wait_seconds"),
+        **timings,
+    }
 
 @app.post("/computer-use/tasks/{task_id}/message")
 async def send_message_to_task(task_id: str, request: MessageRequest):
-    if task_id not in active_tasks:
+    task_info = await active_tasks.aget(task_id)
+    if task_info is None:
+        if await forward_control(task_id, "message", message=request.message):
+            return {"status": "success", "message": "Message received by agent"}
         raise HTTPException(status_code=404, detail=f"Task {task_id} not found")
     
-    task_info = active_tasks[task_id]
     agent = task_info.get("agent")
     
     if not agent:
@@ -139,15 +341,18 @@ async def send_message_to_task(task_id: str, request: MessageRequest):
     # Add message to agent's history
     if hasattr(agent, "add_user_message") and callable(agent.add_user_message):
         await agent.add_user_message(request.message)
+    await save_task(task_id)
     
     return {"status": "success", "message": "Message received by agent"}
 
 @app.post("/computer-use/tasks/{task_id}/pause")
 async def pause_task(task_id: str):
-    if task_id not in active_tasks:
+    task_info = await active_tasks.aget(task_id)
+    if task_info is None:
+        if await forward_control(task_id, "pause"):
+            return {"status": "success", "message": "Task paused"}
         raise HTTPException(status_code=404, detail=f"Task {task_id} not found")
     
-    task_info = active_tasks[task_id]
     agent = task_info.get("agent")
     
     if not agent:
@@ -157,15 +362,18 @@ async def pause_task(task_id: str):
     if hasattr(agent, "pause") and callable(agent.pause):
         await agent.pause()
         active_tasks[task_id]["status"] = "paused"
+        await save_task(task_id)
     
     return {"status": "success", "message": "Task paused"}
 
 @app.post("/computer-use/tasks/{task_id}/resume")
 async def resume_task(task_id: str):
-    if task_id not in active_tasks:
+    task_info = await active_tasks.aget(task_id)
+    if task_info is None:
+        if await forward_control(task_id, "resume"):
+            return {"status": "success", "message": "Task resumed"}
         raise HTTPException(status_code=404, detail=f"Task {task_id} not found")
     
-    task_info = active_tasks[task_id]
     agent = task_info.get("agent")
     
     if not agent:
@@ -175,66 +383,159 @@ async def resume_task(task_id: str):
     if hasattr(agent, "resume") and callable(agent.resume):
         await agent.resume()
         active_tasks[task_id]["status"] = "running"
+        await save_task(task_id)
     
     return {"status": "success", "message": "Task resumed"}
 
 @app.post("/computer-use/tasks/{task_id}/stop")
 async def stop_task(task_id: str):
-    if task_id not in active_tasks:
+    task_info = await active_tasks.aget(task_id)
+    if task_info is None:
+        if await forward_control(task_id, "stop"):
+            return {"status": "success", "message": "Task stopped"}
         raise HTTPException(status_code=404, detail=f"Task {task_id} not found")
     
-    task_info = active_tasks[task_id]
     agent = task_info.get("agent")
     
     if not agent:
         raise HTTPException(status_code=400, detail="Agent not available")
     
+    # Drop the task from the queue if it has not started yet; a running
+    # task is ended by the agent, and run_task then closes it
+    was_queued = task_scheduler.cancel(task_id, running=False)
+    
     # Stop the agent
     if hasattr(agent, "stop") and callable(agent.stop):
         await agent.stop()
     
-    # Clean up resources
-    if hasattr(agent, "close") and callable(agent.close):
+    # Clean up resources of a task that never ran
+    if was_queued and hasattr(agent, "close") and callable(agent.close):
         await agent.close()
     
-    active_tasks[task_id]["status"] = "stopped"
+    update_task(task_id, status="stopped")
+    if was_queued:
+        # A running task is finished by run_task once the agent has stopped
+        await finish_task(task_id)
     
     return {"status": "success", "message": "Task stopped"}
 
+@app.get("/computer-use/browser-pools")
+async def get_browser_pools():
+    return browser_pool_stats()
+
+@app.get("/computer-use/llm-pool")
+async def get_llm_pool_stats():
+    return llm_pool_stats()
+
+@app.get("/computer-use/timings")
+async def get_timings():
+    # Span durations of every task on this worker
+    return {"histograms": timing_histograms()}
+
+@app.get("/computer-use/scheduler")
+async def get_scheduler_stats():
+    return task_scheduler.stats()
+
+@app.get("/computer-use/task-store")
+async def get_task_store_stats():
+    return active_tasks.stats()
+
+async def remote_task_page(matches: Callable[[Dict[str, Any]], bool], count: int, seen: Set[str]) -> List[Dict[str, Any]]:
+    """
+    Read the newest tasks from the state backend, in batches, until enough of them match.
+
+    Args:
+        matches: Filter for the tasks to return.
+        count: Number of tasks to return at most.
+        seen: IDs of tasks that are already listed from this worker.
+
+    Returns:
+        Matching tasks, most recently created first.
+    """
+    tasks: List[Dict[str, Any]] = []
+    offset = 0
+    while len(tasks) < count:
+        batch = await state_backend.list_tasks(offset=offset, limit=count)
+        tasks.extend(task for task in batch if task.get("id") not in seen and matches(task))
+        if len(batch) < count:
+            break
+        offset += count
+    return tasks[:count]
+
 @app.get("/computer-use/tasks")
-async def list_tasks():
-    # Exclude agent from response
-    tasks = []
-    for task_id, task_info in active_tasks.items():
-        tasks.append({k: v for k, v in task_info.items() if k != "agent"})
+async def list_tasks(
+    status: Optional[str] = None,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+):
+    # Newest tasks first, without their history; status takes a comma-separated list
+    statuses = set(status.split(",")) if status else None
+    # Each source is read only as far as the requested page, newest first, and the
+    # sources are merged by creation time so that offsets stay stable between pages
+    count = offset + limit + 1
+    
+    def matches(task: Dict[str, Any]) -> bool:
+        return statuses is None or task.get("status") in statuses
+    
+    local_tasks = [
+        public_task(task_id, task_info)
+        for task_id, task_info in heapq.nlargest(
+            count,
+            ((task_id, task_info) for task_id, task_info in active_tasks.items() if matches(task_info)),
+            key=lambda item: item[1].get("created_at") or "",
+        )
+    ]
+    archived = await active_tasks.archived_page(statuses, limit=count)
+    archived_tasks = [task for _, task in archived]
+    # This worker's tasks are in the backend too; its own copies are newer
+    seen = {task_id for task_id, _ in active_tasks.items()} | {task_id for task_id, _ in archived}
+    remote_tasks = await remote_task_page(matches, count, seen) if state_backend.shared else []
+    
+    merged = heapq.merge(
+        local_tasks, archived_tasks, remote_tasks,
+        key=lambda task: task.get("created_at") or "",
+        reverse=True,
+    )
+    summaries = ({k: v for k, v in task.items() if k != "history"} for task in merged)
+    tasks, next_offset = paginate(summaries, offset, limit)
     
-    return tasks
+    return {"tasks": tasks, "offset": offset, "limit": limit, "next_offset": next_offset}
 
 # Background task function
 async def run_task(task_id: str, task_description: str, agent: ComputerUseAgent):
     try:
         # Update status to running
         active_tasks[task_id]["status"] = "running"
+        await save_task(task_id)
         
         # Create and run the agent
         result = await agent.run(task_description)
         
-        # Update task info with results
-        active_tasks[task_id]["history"] = agent.agent.history if agent.agent else []
-        active_tasks[task_id]["status"] = "completed" if result.get("success", False) else "failed"
+        # Update task info with results; clients may poll before finish_task saves them
+        if result.get("stopped"):
+            # stop_task has already recorded the stop
+            status = "stopped"
+        else:
+            status = "completed" if result.get("success", False) else "failed"
+        update_task(
+            task_id,
+            history=agent.agent.history if agent.agent else [],
+            vision=agent.vision_stats(),
+            context=agent.context_stats(),
+            status=status,
+        )
         
         # Extract current URL and reasoning if available
         if agent.agent:
             if hasattr(agent.agent, "browser") and agent.agent.browser:
                 current_url = await agent.agent.browser.current_url()
-                active_tasks[task_id]["current_url"] = current_url
+                update_task(task_id, current_url=current_url)
             
             if hasattr(agent.agent, "reasoning") and agent.agent.reasoning:
-                active_tasks[task_id]["reasoning"] = agent.agent.reasoning
+                update_task(task_id, reasoning=agent.agent.reasoning)
     except Exception as e:
         logger.error(f"Error running task {task_id}: {e}", exc_info=True)
-        active_tasks[task_id]["status"] = "failed"
-        active_tasks[task_id]["error"] = str(e)
+        update_task(task_id, status="failed", error=str(e))
     finally:
         # Always close the agent when done
         if agent:
@@ -242,6 +543,8 @@ async def run_task(task_id: str, task_description: str, agent: ComputerUseAgent)
                 await agent.close()
             except Exception as e:
                 logger.error(f"Error closing agent for task {task_id}: {e}", exc_info=True)
+            update_task(task_id, timings=agent.timings.to_dict())
+        await finish_task(task_id)
 
 # Main entry point for running the server directly
 if __name__ == "__main__":
@@ -0,0 +1,404 @@
+"""
+Prometheus Metrics
+
+Counters, gauges and histograms for main.py, api.py and server.py, served
+at /metrics in the Prometheus text exposition format.
+
+Updating a metric never takes a lock: every thread writes to its own cells,
+which are only summed when the metrics are scraped. A lock is only taken
+the first time a thread or a new label set uses a metric. Values that are
+already kept elsewhere, such as queue depths or pool sizes, are read by
+collectors at scrape time instead of being updated on the hot path.
+"""
+
+import bisect
+import math
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from fastapi import Request
+from fastapi.responses import Response
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class MetricFamily(NamedTuple):
+    """
+    A metric as it is rendered. Collectors return these, or plain tuples
+    of the same shape.
+
+    Attributes:
+        name: The metric name.
+        type: "counter", "gauge" or "histogram".
+        documentation: The help text.
+        samples: (name suffix, labels, value) for every sample, e.g.
+            ("_bucket", {"le": "0.5"}, 3) for a histogram bucket.
+    """
+
+    name: str
+    type: str
+    documentation: str
+    samples: List[Tuple[str, Dict[str, str], float]]
+
+
+class _Cells:
+    """Values of one metric child, with a separate list of cells for each thread."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._local = threading.local()
+        self._all: List[List[float]] = []
+        self._lock = threading.Lock()
+
+    def mine(self) -> List[float]:
+        cells = getattr(self._local, "cells", None)
+        if cells is None:
+            cells = [0.0] * self.size
+            with self._lock:
+                self._all.append(cells)
+            self._local.cells = cells
+        return cells
+
+    def totals(self) -> List[float]:
+        with self._lock:
+            everyone = list(self._all)
+        return [sum(cells[i] for cells in everyone) for i in range(self.size)]
+
+
+class _CounterChild:
+    def __init__(self):
+        self._cells = _Cells(1)
+
+    def inc(self, amount: float = 1.0):
+        self._cells.mine()[0] += amount
+
+    def value(self) -> float:
+        return self._cells.totals()[0]
+
+
+class _GaugeChild:
+    # Gauges are set from one place (usually the event loop), so a plain value is enough
+    def __init__(self):
+        self._value = 0.0
+
+    def set(self, value: float):
+        self._value = value
+
+    def inc(self, amount: float = 1.0):
+        self._value += amount
+
+    def dec(self, amount: float = 1.0):
+        self._value -= amount
+
+    def value(self) -> float:
+        return self._value
+
+
+class _HistogramChild:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # One cell per bucket and one for +Inf, then the sum and the count
+        self._cells = _Cells(len(buckets) + 3)
+
+    def observe(self, value: float):
+        cells = self._cells.mine()
+        cells[bisect.bisect_left(self.buckets, value)] += 1
+        cells[-2] += value
+        cells[-1] += 1
+
+    def time(self) -> "_Timer":
+        """Observe the duration of a with block."""
+        return _Timer(self)
+
+    def totals(self) -> Tuple[List[float], float, float]:
+        totals = self._cells.totals()
+        return totals[:-2], totals[-2], totals[-1]
+
+
+class _Timer:
+    def __init__(self, histogram: _HistogramChild):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._started)
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry: Optional["Registry"] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        (registry or REGISTRY).register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: Any, **labels: Any):
+        """Get the child for a set of label values."""
+        key = tuple(str(labels[name]) for name in self.labelnames) if labels else tuple(str(value) for value in values)
+        if len(key) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {self.labelnames}")
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _items(self) -> List[Tuple[Dict[str, str], Any]]:
+        return [(dict(zip(self.labelnames, key)), child) for key, child in list(self._children.items())]
+
+    def collect(self) -> MetricFamily:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """A value that only goes up, such as the number of requests."""
+
+    type = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self._children[()].inc(amount)
+
+    def collect(self) -> MetricFamily:
+        return MetricFamily(self.name, self.type, self.documentation, [("", labels, child.value()) for labels, child in self._items()])
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, such as requests in progress."""
+
+    type = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self._children[()].set(value)
+
+    def inc(self, amount: float = 1.0):
+        self._children[()].inc(amount)
+
+    def dec(self, amount: float = 1.0):
+        self._children[()].dec(amount)
+
+    def collect(self) -> MetricFamily:
+        return MetricFamily(self.name, self.type, self.documentation, [("", labels, child.value()) for labels, child in self._items()])
+
+
+class Histogram(_Metric):
+    """Observations, such as latencies, counted in buckets."""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        registry: Optional["Registry"] = None,
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._children[()].observe(value)
+
+    def time(self) -> _Timer:
+        return self._children[()].time()
+
+    def collect(self) -> MetricFamily:
+        samples = []
+        for labels, child in self._items():
+            counts, total, count = child.totals()
+            samples.extend(histogram_samples(self.buckets, counts, total, count, labels))
+        return MetricFamily(self.name, self.type, self.documentation, samples)
+
+
+def histogram_samples(
+    buckets: Sequence[float], counts: Sequence[float], total: float, count: float, labels: Optional[Dict[str, str]] = None
+) -> List[Tuple[str, Dict[str, str], float]]:
+    """
+    Samples of a histogram from per-bucket counts.
+
+    Args:
+        buckets: Upper bounds of the buckets.
+        counts: Observations in each bucket (not cumulative), with +Inf last.
+        total: Sum of the observations.
+        count: Number of observations.
+        labels: Labels of the histogram.
+    """
+    labels = labels or {}
+    samples, cumulative = [], 0.0
+    for bound, bucket_count in zip(tuple(buckets) + (math.inf,), counts):
+        cumulative += bucket_count
+        samples.append(("_bucket", {**labels, "le": format_value(bound)}, cumulative))
+    samples.append(("_sum", labels, total))
+    samples.append(("_count", labels, count))
+    return samples
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if value != value:
+        return "NaN"
+    if float(value).is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Registry:
+    """The metrics and collectors that make up a /metrics response."""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], Iterable[MetricFamily]]] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+
+    def register_collector(self, collector: Callable[[], Iterable[MetricFamily]]):
+        """
+        Add a function that is called at every scrape and returns metric
+        families, e.g. gauges read from a scheduler's counters.
+        """
+        with self._lock:
+            if collector not in self._collectors:
+                self._collectors.append(collector)
+
+    def collect(self) -> List[MetricFamily]:
+        with self._lock:
+            metrics, collectors = list(self._metrics.values()), list(self._collectors)
+        families = [metric.collect() for metric in metrics]
+        for collector in collectors:
+            families.extend(MetricFamily(*family) for family in collector())
+        return families
+
+    def render(self) -> str:
+        """All metrics in the text exposition format."""
+        lines = []
+        for family in self.collect():
+            lines.append(f"# HELP {family.name} {_escape(family.documentation)}")
+            lines.append(f"# TYPE {family.name} {family.type}")
+            for suffix, labels, value in family.samples:
+                if labels:
+                    rendered = ",".join(f'{name}="{_escape(str(label))}"' for name, label in labels.items())
+                    lines.append(f"{family.name}{suffix}{{{rendered}}} {format_value(value)}")
+                else:
+                    lines.append(f"{family.name}{suffix} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# The registry of this process
+REGISTRY = Registry()
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Time to serve an HTTP request, by route template", ["method", "route"]
+)
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests served, by route template and status", ["method", "route", "status"])
+HTTP_REQUESTS_IN_PROGRESS = Gauge("http_requests_in_progress", "HTTP requests being served")
+
+_START_TIME = time.time()
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that times every HTTP request.
+
+    Requests are labelled with their route template (e.g.
+    /computer-use/tasks/{task_id}), so task IDs do not create new series;
+    requests that match no route are labelled "unmatched". For streaming
+    responses the duration covers the whole stream.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_REQUESTS_IN_PROGRESS.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_REQUESTS_IN_PROGRESS.dec()
+            # The router puts the matched route in the scope
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            HTTP_REQUEST_DURATION.labels(scope["method"], route).observe(time.perf_counter() - started)
+            HTTP_REQUESTS.labels(scope["method"], route, status).inc()
+
+
+def process_metrics() -> List[MetricFamily]:
+    """Memory, CPU time and open files of this process."""
+    times = os.times()
+    families = [
+        MetricFamily("process_cpu_seconds_total", "counter", "CPU time used by the process", [("", {}, times.user + times.system)]),
+        MetricFamily("process_start_time_seconds", "gauge", "When the process started, in Unix time", [("", {}, _START_TIME)]),
+    ]
+    rss = resident_memory_bytes(os.getpid())
+    if rss is not None:
+        families.append(MetricFamily("process_resident_memory_bytes", "gauge", "Resident memory of the process", [("", {}, rss)]))
+    try:
+        families.append(MetricFamily("process_open_fds", "gauge", "Open file descriptors", [("", {}, len(os.listdir("/proc/self/fd")))]))
+    except OSError:
+        pass
+    return families
+
+
+def resident_memory_bytes(pid: int) -> Optional[int]:
+    """Resident memory of a process, read from /proc (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+REGISTRY.register_collector(process_metrics)
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    """Serve the metrics of this process; add with app.add_route("/metrics", metrics_endpoint)."""
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
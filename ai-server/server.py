@@ -1,12 +1,36 @@
 import os
+import json
+import asyncio
+import threading
 import torch
+from contextlib import contextmanager
 from fastapi import FastAPI, Request, HTTPException, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field, ValidationInfo, field_validator
 from typing import Optional, Dict, Any, List
 from peft import PeftModel, PeftConfig
 from transformers import AutoModelForCausalLM, AutoTokenizer, TextGenerationPipeline
 
+from metrics import REGISTRY, MetricFamily, MetricsMiddleware, histogram_samples, metrics_endpoint
+from inference.cpu import CPU_DTYPES, compile_model, configure_threads, quantize_int8, resolve_device
+from inference import (
+    AdapterInUseError,
+    AdapterRegistry,
+    BatchScheduler,
+    EmptyPromptError,
+    GenerationJob,
+    MemoryResponseCache,
+    PrefixCache,
+    QueueFullError,
+    SchedulerStoppedError,
+    SQLiteResponseCache,
+    adapter_identity,
+    is_deterministic,
+    make_cache_key,
+    stream_job,
+)
+
 # Konfigurera FastAPI-app
 app = FastAPI(title="DeepSeek LoRA API", description="API för att använda DeepSeek-modell med LoRA-adapters")
 
@@ -19,21 +43,56 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Latens per route och Prometheus-mätvärden på /metrics
+app.add_middleware(MetricsMiddleware)
+app.add_route("/metrics", metrics_endpoint, include_in_schema=False)
+
 # Konfigurationsvariabler
 BASE_MODEL_PATH = os.environ.get("BASE_MODEL_PATH", "deepseek-ai/deepseek-coder-6.7b-base")
 LORA_PATH = os.environ.get("LORA_PATH", "./output/final_model")
+DEFAULT_ADAPTER = os.environ.get("DEFAULT_ADAPTER", "default")  # Namn på adaptern från LORA_PATH
+LORA_ADAPTERS = os.environ.get("LORA_ADAPTERS", "")  # Fler adapters att registrera, t.ex. "sql=./output/sql,docs=./output/docs"
+MAX_RESIDENT_ADAPTERS = int(os.environ.get("MAX_RESIDENT_ADAPTERS", "4"))  # Max antal laddade adapters samtidigt
+MERGED_MODEL_PATH = os.environ.get("MERGED_MODEL_PATH", "")  # Sammanslagen modell från merge_lora.py, laddas utan PEFT
+INFERENCE_DEVICE = os.environ.get("INFERENCE_DEVICE", "auto")  # "auto", "cuda", "mps" eller "cpu"
+CPU_DTYPE = os.environ.get("CPU_DTYPE", "bfloat16")  # "bfloat16", "float32" eller "int8" (dynamisk kvantisering)
+CPU_THREADS = int(os.environ.get("CPU_THREADS", "0"))  # Intra-op-trådar på CPU, 0 = alla kärnor
+CPU_INTEROP_THREADS = int(os.environ.get("CPU_INTEROP_THREADS", "0"))  # Inter-op-trådar på CPU, 0 = PyTorchs standard
+TORCH_COMPILE = os.environ.get("TORCH_COMPILE", "0") == "1"  # Kompilera modellen med torch.compile och värm upp den
 API_KEY = os.environ.get("API_KEY", "din-api-nyckel-här")  # Ersätt med din egen API-nyckel
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "8"))  # Max antal sekvenser som avkodas samtidigt
+MAX_QUEUE_SIZE = int(os.environ.get("MAX_QUEUE_SIZE", "64"))  # Max antal väntande förfrågningar, 0 = obegränsat
+RETRY_AFTER_SECONDS = os.environ.get("RETRY_AFTER_SECONDS", "1")  # Retry-After-header när kön är full
+PREFIX_CACHE_MB = int(os.environ.get("PREFIX_CACHE_MB", "512"))  # Minnesbudget för prefix-cachen, 0 = avstängd
+PREFIX_CACHE_BLOCK_SIZE = int(os.environ.get("PREFIX_CACHE_BLOCK_SIZE", "16"))  # Antal tokens per cachat block
+RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "")  # "memory" eller "sqlite" för att cacha deterministiska svar
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", "./cache/responses.sqlite3")
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "3600"))  # Sekunder
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
 
 # Pydantic-modeller för API-requests och responses
 class GenerateRequest(BaseModel):
     prompt: str
-    max_tokens: Optional[int] = 150
-    temperature: Optional[float] = 0.7
-    top_p: Optional[float] = 0.95
+    max_tokens: Optional[int] = Field(150, ge=1)
+    temperature: Optional[float] = Field(0.7, ge=0)  # 0 ger girig avkodning
+    top_p: Optional[float] = Field(0.95, gt=0, le=1)
+    seed: Optional[int] = None
+    adapter: Optional[str] = None  # Namn på LoRA-adapter, "base" för basmodellen utan adapter
+
+    @field_validator("max_tokens", "temperature", "top_p")
+    @classmethod
+    def null_means_default(cls, value, info: ValidationInfo):
+        """null betyder standardvärdet, så att svaret och cachenyckeln blir desamma som utan fältet."""
+        return cls.model_fields[info.field_name].default if value is None else value
 
 class GenerateResponse(BaseModel):
     response: str
 
+class AdapterRequest(BaseModel):
+    name: str
+    path: str
+    load: bool = True
+
 # Funktion för API-nyckelautentisering
 def verify_api_key(authorization: Optional[str] = Header(None)):
     if not authorization:
@@ -48,77 +107,212 @@ def verify_api_key(authorization: Optional[str] = Header(None)):
     
     return token
 
-# Ladda modell och tokenizer
-print(f"Laddar basmodell: {BASE_MODEL_PATH}")
+# Svarscache för deterministiska förfrågningar (opt-in)
+response_cache = None
+if RESPONSE_CACHE == "memory":
+    response_cache = MemoryResponseCache(max_entries=RESPONSE_CACHE_MAX_ENTRIES, ttl=RESPONSE_CACHE_TTL)
+elif RESPONSE_CACHE == "sqlite":
+    response_cache = SQLiteResponseCache(RESPONSE_CACHE_PATH, max_entries=RESPONSE_CACHE_MAX_ENTRIES, ttl=RESPONSE_CACHE_TTL)
+
+# Modellen laddas i bakgrunden så att servern kan svara på /health direkt
 tokenizer = None
 model = None
 pipeline = None
+scheduler = None
+adapters = None
+model_state = "loading"  # "loading", "ready" eller "failed"
+model_error = None
+runtime_config = {}
+model_identity = None  # Modellens del av cachenycklarna, sätts när modellen laddas
 
-try:
-    # Försök ladda modellen
-    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL_PATH)
+def load_model():
+    """Ladda modell och tokenizer och starta schemaläggaren."""
+    global tokenizer, model, pipeline, scheduler, adapters, model_state, model_error, runtime_config, model_identity
     
-    # Konfigurera för 4-bit kvantisering för minnesbesparing
-    if torch.cuda.is_available():
-        from transformers import BitsAndBytesConfig
+    # En sammanslagen modell har LoRA-vikterna inbakade och laddas direkt
+    model_path = MERGED_MODEL_PATH or BASE_MODEL_PATH
+    model_identity = None
+    print(f"Laddar {'sammanslagen modell' if MERGED_MODEL_PATH else 'basmodell'}: {model_path}")
+    try:
+        # Försök ladda modellen
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
         
-        bnb_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.float16
-        )
+        device = resolve_device(INFERENCE_DEVICE)
+        runtime_config = {"device": device}
         
-        model = AutoModelForCausalLM.from_pretrained(
-            BASE_MODEL_PATH,
-            quantization_config=bnb_config,
-            device_map="auto"
-        )
-    else:
-        model = AutoModelForCausalLM.from_pretrained(
-            BASE_MODEL_PATH, 
-            device_map="auto",
-            torch_dtype=torch.float16
+        # Konfigurera för 4-bit kvantisering för minnesbesparing
+        if device == "cuda":
+            from transformers import BitsAndBytesConfig
+            
+            bnb_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_use_double_quant=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.float16
+            )
+            
+            loaded_model = AutoModelForCausalLM.from_pretrained(
+                model_path,
+                quantization_config=bnb_config,
+                device_map="auto"
+            )
+            runtime_config["dtype"] = "nf4"
+        elif device == "cpu":
+            # float16 är långsamt eller saknas på CPU, så bfloat16 eller float32 används i stället
+            if CPU_DTYPE not in CPU_DTYPES:
+                raise ValueError(f"Ogiltig CPU_DTYPE: {CPU_DTYPE}")
+            runtime_config.update(dtype=CPU_DTYPE, threads=configure_threads(CPU_THREADS, CPU_INTEROP_THREADS))
+            loaded_model = AutoModelForCausalLM.from_pretrained(
+                model_path,
+                torch_dtype=CPU_DTYPES[CPU_DTYPE],
+                low_cpu_mem_usage=True
+            )
+        else:
+            # safetensors-filerna minnesmappas i stället för att läsas in i sin helhet
+            loaded_model = AutoModelForCausalLM.from_pretrained(
+                model_path, 
+                device_map="auto",
+                torch_dtype=torch.float16,
+                low_cpu_mem_usage=True
+            )
+            runtime_config["dtype"] = "float16"
+        
+        if MERGED_MODEL_PATH:
+            # Ingen PEFT-wrapper, så inga extra LoRA-matmuls per token
+            print("Använder sammanslagen modell. LoRA-adapters är avstängda.")
+            model = loaded_model
+        else:
+            # Ladda LoRA-adapter om specificerad
+            adapters = AdapterRegistry(loaded_model, max_resident=MAX_RESIDENT_ADAPTERS)
+            if os.path.exists(LORA_PATH):
+                print(f"Laddar LoRA-adapter från: {LORA_PATH}")
+                adapters.register(DEFAULT_ADAPTER, LORA_PATH)
+                adapters.load(DEFAULT_ADAPTER)
+            else:
+                print(f"VARNING: LoRA-adapter hittades inte på {LORA_PATH}. Använder endast basmodellen.")
+            
+            # Övriga adapters laddas först när en förfrågan behöver dem
+            for entry in filter(None, LORA_ADAPTERS.split(",")):
+                name, _, path = entry.partition("=")
+                adapters.register(name.strip(), path.strip())
+            model = adapters.model
+        
+        merged_adapter = None
+        if device == "cpu" and CPU_DTYPE == "int8":
+            # Dynamisk kvantisering fungerar inte med PEFT-wrappern, så adaptern slås ihop först
+            if adapters and adapters.list():
+                print("VARNING: CPU_DTYPE=int8 slår ihop standardadaptern med basmodellen. Byte av adapter är avstängt.")
+            if isinstance(model, PeftModel):
+                merged_adapter = adapters.identity(DEFAULT_ADAPTER)
+            model = quantize_int8(model.merge_and_unload() if isinstance(model, PeftModel) else model)
+            adapters = None
+        
+        runtime_config["compiled"] = TORCH_COMPILE
+        if TORCH_COMPILE:
+            model = compile_model(model)
+        
+        # Skapa pipeline för textgenerering
+        pipeline = TextGenerationPipeline(model=model, tokenizer=tokenizer)
+        print("Modell och tokenizer har laddats framgångsrikt!")
+        
+        # Starta schemaläggaren som batchar samtidiga förfrågningar
+        prefix_cache = None
+        if PREFIX_CACHE_MB > 0:
+            prefix_cache = PrefixCache(max_bytes=PREFIX_CACHE_MB * 1024 * 1024, block_size=PREFIX_CACHE_BLOCK_SIZE)
+        scheduler = BatchScheduler(
+            model,
+            tokenizer,
+            max_batch_size=MAX_BATCH_SIZE,
+            max_queue_size=MAX_QUEUE_SIZE,
+            prefix_cache=prefix_cache,
+            adapters=adapters
         )
+        scheduler.start()
+        
+        if TORCH_COMPILE:
+            # Första anropen kompilerar modellen; gör det innan servern tar emot förfrågningar
+            print("Värmer upp kompilerad modell...")
+            scheduler.submit("def hello_world():", max_tokens=4, temperature=0).result()
+        
+        # Allt utom den valda adaptern som avgör svaren: vikterna (en ny sammanslagning
+        # på samma sökväg ger en ny identitet), datatypen och en inbakad standardadapter
+        model_identity = {
+            "weights": adapter_identity(MERGED_MODEL_PATH) if MERGED_MODEL_PATH else BASE_MODEL_PATH,
+            "dtype": runtime_config.get("dtype"),
+            "merged_adapter": merged_adapter,
+        }
+        print(f"Inferenskonfiguration: {runtime_config}")
+        model_state = "ready"
     
-    # Ladda LoRA-adapter om specificerad
-    if os.path.exists(LORA_PATH):
-        print(f"Laddar LoRA-adapter från: {LORA_PATH}")
-        model = PeftModel.from_pretrained(model, LORA_PATH)
-    else:
-        print(f"VARNING: LoRA-adapter hittades inte på {LORA_PATH}. Använder endast basmodellen.")
+    except Exception as e:
+        print(f"Fel vid laddning av modell: {str(e)}")
+        model_error = str(e)
+        model_state = "failed"
+
+@app.on_event("startup")
+async def start_model_loading():
+    """Starta laddningen av modellen i en bakgrundstråd."""
+    threading.Thread(target=load_model, name="model-loader", daemon=True).start()
+
+# Köhantering för schemaläggaren
+@contextmanager
+def scheduler_admission():
+    """Översätt en full eller stoppad kö till 429 respektive 503."""
+    if model_state == "loading":
+        raise HTTPException(status_code=503, detail="Modellen laddas fortfarande", headers={"Retry-After": RETRY_AFTER_SECONDS})
+    if model_state == "failed" or not scheduler:
+        raise HTTPException(status_code=503, detail=f"Modellen kunde inte laddas: {model_error}")
+    
+    try:
+        yield
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": RETRY_AFTER_SECONDS})
+    except SchedulerStoppedError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": RETRY_AFTER_SECONDS})
+    except EmptyPromptError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Välj adapter för en förfrågan (None betyder basmodellen)
+def resolve_adapter(request: GenerateRequest) -> Optional[str]:
+    if request.adapter == "base":
+        return None
     
-    # Skapa pipeline för textgenerering
-    pipeline = TextGenerationPipeline(model=model, tokenizer=tokenizer)
-    print("Modell och tokenizer har laddats framgångsrikt!")
+    name = request.adapter or DEFAULT_ADAPTER
+    if adapters and adapters.is_registered(name):
+        return name
+    if request.adapter:
+        raise HTTPException(status_code=404, detail=f"LoRA-adapter {request.adapter} hittades inte")
+    return None
 
-except Exception as e:
-    print(f"Fel vid laddning av modell: {str(e)}")
-    raise e
+# Nyckel i svarscachen, eller None om förfrågan inte ska cachas
+def response_cache_key(request: GenerateRequest) -> Optional[str]:
+    if not response_cache or not is_deterministic(request.temperature, request.seed):
+        return None
+    
+    return make_cache_key(
+        prompt=request.prompt,
+        max_tokens=request.max_tokens,
+        # Temperatur och top_p påverkar inte giriga svar utan seed
+        temperature=request.temperature if request.seed is not None else 0,
+        top_p=request.top_p if request.seed is not None else None,
+        seed=request.seed,
+        adapter=adapters.identity(resolve_adapter(request)) if adapters else None,
+        model=model_identity,
+    )
 
 # Inferens-funktion
-def run_inference(prompt: str, max_tokens: int = 150, temperature: float = 0.7, top_p: float = 0.95) -> str:
+def submit_inference(prompt: str, max_tokens: int = 150, temperature: float = 0.7, top_p: float = 0.95, seed: Optional[int] = None, adapter: Optional[str] = None):
+    """Lägg en prompt i schemaläggarens kö och returnera en Future med svaret."""
+    with scheduler_admission():
+        return scheduler.submit(prompt, max_tokens=max_tokens, temperature=temperature, top_p=top_p, seed=seed, adapter=adapter)
+
+def run_inference(prompt: str, max_tokens: int = 150, temperature: float = 0.7, top_p: float = 0.95, seed: Optional[int] = None, adapter: Optional[str] = None) -> str:
     """Generera text baserat på en prompt."""
-    if not model or not tokenizer or not pipeline:
-        raise HTTPException(status_code=500, detail="Modellen har inte laddats korrekt")
+    future = submit_inference(prompt, max_tokens=max_tokens, temperature=temperature, top_p=top_p, seed=seed, adapter=adapter)
     
     try:
-        # Generera svar
-        input_ids = tokenizer.encode(prompt, return_tensors="pt").to(model.device)
-        gen_tokens = model.generate(
-            input_ids,
-            max_new_tokens=max_tokens,
-            do_sample=True,
-            temperature=temperature,
-            top_p=top_p,
-            pad_token_id=tokenizer.eos_token_id
-        )
-        
-        # Dekodera och returnera svaret (utan prompten)
-        prompt_length = input_ids.shape[1]
-        generated_text = tokenizer.decode(gen_tokens[0][prompt_length:], skip_special_tokens=True)
-        
-        return generated_text
+        # Svaret returneras utan prompten
+        return future.result()
     
     except Exception as e:
         print(f"Fel vid inferens: {str(e)}")
@@ -128,20 +322,218 @@ def run_inference(prompt: str, max_tokens: int = 150, temperature: float = 0.7,
 @app.post("/api/generate", response_model=GenerateResponse)
 async def generate_text(request: GenerateRequest, api_key: str = Depends(verify_api_key)):
     """Generera text baserat på en prompt."""
-    response_text = run_inference(
+    cache_key = response_cache_key(request)
+    if cache_key:
+        cached = await response_cache.aget(cache_key)
+        if cached is not None:
+            return GenerateResponse(response=cached)
+    
+    future = submit_inference(
         request.prompt, 
         max_tokens=request.max_tokens,
         temperature=request.temperature,
-        top_p=request.top_p
+        top_p=request.top_p,
+        seed=request.seed,
+        adapter=resolve_adapter(request)
     )
     
+    try:
+        # Vänta utan att blockera event-loopen medan batchen avkodas
+        response_text = await asyncio.wrap_future(future)
+    except EmptyPromptError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(f"Fel vid inferens: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Inferensfel: {str(e)}")
+    
+    if cache_key:
+        await response_cache.aset(cache_key, response_text)
+    
     return GenerateResponse(response=response_text)
 
-# Enkel hälsokontroll
+# Strömmande variant av textgenerering (Server-Sent Events)
+@app.post("/api/generate/stream")
+async def generate_text_stream(request: GenerateRequest, api_key: str = Depends(verify_api_key)):
+    """Generera text och skicka den till klienten token för token."""
+    cache_key = response_cache_key(request)
+    cached = await response_cache.aget(cache_key) if cache_key else None
+    
+    if cached is None:
+        job = GenerationJob(
+            prompt=request.prompt,
+            max_tokens=request.max_tokens,
+            temperature=request.temperature,
+            top_p=request.top_p,
+            seed=request.seed,
+            adapter=resolve_adapter(request)
+        )
+        
+        with scheduler_admission():
+            chunks = stream_job(scheduler, job)
+    
+    async def event_stream():
+        if cached is not None:
+            yield f"data: {json.dumps({'text': cached}, ensure_ascii=False)}\n\n"
+            yield "data: [DONE]\n\n"
+            return
+        
+        # Om klienten kopplar ner avbryts generatorn och jobbet tas bort ur batchen
+        parts = []
+        try:
+            async for chunk in chunks:
+                parts.append(chunk)
+                yield f"data: {json.dumps({'text': chunk}, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            print(f"Fel vid inferens: {str(e)}")
+            error = json.dumps({"detail": f"Inferensfel: {str(e)}"}, ensure_ascii=False)
+            yield f"event: error\ndata: {error}\n\n"
+            return
+        
+        if cache_key:
+            await response_cache.aset(cache_key, "".join(parts))
+        yield "data: [DONE]\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Administration av LoRA-adapters
+async def run_adapter_operation(fn):
+    """Kör en ändring av adapter-registret i schemaläggarens tråd."""
+    if model_state == "ready" and adapters is None:
+        raise HTTPException(status_code=409, detail="LoRA-adapters är avstängda (sammanslagen modell eller CPU_DTYPE=int8)")
+    
+    with scheduler_admission():
+        future = scheduler.run_in_worker(fn)
+    
+    try:
+        return await asyncio.wrap_future(future)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=f"LoRA-adapter hittades inte: {e}")
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except AdapterInUseError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.get("/admin/adapters")
+async def list_adapters(api_key: str = Depends(verify_api_key)):
+    """Lista registrerade LoRA-adapters."""
+    return {"default": DEFAULT_ADAPTER, "adapters": adapters.list() if adapters else []}
+
+@app.post("/admin/adapters")
+async def register_adapter(request: AdapterRequest, api_key: str = Depends(verify_api_key)):
+    """Registrera en LoRA-adapter och ladda den direkt om load är satt."""
+    def register():
+        adapters.register(request.name, request.path, pinned=scheduler.active_adapters)
+        if request.load:
+            adapters.load(request.name, pinned=scheduler.active_adapters)
+    
+    await run_adapter_operation(register)
+    return {"status": "success", "adapters": adapters.list()}
+
+@app.delete("/admin/adapters/{name}")
+async def unregister_adapter(name: str, api_key: str = Depends(verify_api_key)):
+    """Ladda ur och avregistrera en LoRA-adapter."""
+    await run_adapter_operation(lambda: adapters.unregister(name, pinned=scheduler.active_adapters))
+    return {"status": "success", "adapters": adapters.list()}
+
+# Storleken på modellens parametrar och buffertar ändras inte, så den räknas en gång per modell
+_model_bytes: Dict[int, int] = {}
+
+def model_memory_bytes() -> Dict[str, int]:
+    """Minne som modellen använder: GPU-minne via CUDA, annars storleken på vikterna."""
+    if torch.cuda.is_available() and runtime_config.get("device", "").startswith("cuda"):
+        return {"allocated": torch.cuda.memory_allocated(), "reserved": torch.cuda.memory_reserved()}
+    current = scheduler.model if scheduler else model
+    if current is None:
+        return {}
+    if id(current) not in _model_bytes:
+        tensors = list(current.parameters()) + list(current.buffers())
+        _model_bytes[id(current)] = sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+    return {"weights": _model_bytes[id(current)]}
+
+def inference_metrics() -> List[MetricFamily]:
+    """Mätvärden för schemaläggaren, modellen och cacharna. Läses vid varje skrapning."""
+    families = [
+        MetricFamily("inference_model_ready", "gauge", "1 when the model is loaded", [("", {}, 1 if model_state == "ready" else 0)]),
+        MetricFamily("inference_model_memory_bytes", "gauge", "Memory used by the model, by kind", [
+            ("", {"kind": kind}, value) for kind, value in model_memory_bytes().items()
+        ]),
+    ]
+    if scheduler:
+        stats = scheduler.stats()
+        sizes = stats["decode_batch_sizes"]
+        families += [
+            MetricFamily("inference_batch_size", "gauge", "Sequences being decoded", [("", {}, stats["batch_size"])]),
+            MetricFamily("inference_max_batch_size", "gauge", "Sequences that may be decoded at once", [("", {}, stats["max_batch_size"])]),
+            MetricFamily("inference_queue_depth", "gauge", "Requests waiting for a batch slot", [("", {}, stats["queue_depth"])]),
+            MetricFamily("inference_tokens_per_second", "gauge", "Tokens decoded per second, over the last 10 seconds", [
+                ("", {}, stats["tokens_per_second"])
+            ]),
+            MetricFamily("inference_tokens_total", "counter", "Tokens processed, by kind", [
+                ("", {"kind": "prompt"}, stats["prompt_tokens"]),
+                ("", {"kind": "prompt_cached"}, stats["cached_prompt_tokens"]),
+                ("", {"kind": "generated"}, stats["generated_tokens"]),
+            ]),
+            MetricFamily("inference_requests_total", "counter", "Generation requests finished, by result", [
+                ("", {"result": "completed"}, stats["completed_requests"]),
+                ("", {"result": "failed"}, stats["failed_requests"]),
+            ]),
+            # Ett steg med n sekvenser hamnar i hinken n, så histogrammet visar hur full batchen är
+            MetricFamily("inference_decode_batch_size", "histogram", "Sequences in each decode step", histogram_samples(
+                range(1, len(sizes)), sizes[1:] + [0], sum(size * count for size, count in enumerate(sizes)), stats["decode_steps"]
+            )),
+        ]
+        if scheduler.prefix_cache:
+            prefix = scheduler.prefix_cache.stats()
+            families += [
+                MetricFamily("inference_prefix_cache_lookups_total", "counter", "Prefix cache lookups, by result", [
+                    ("", {"result": "hit"}, prefix["hits"]),
+                    ("", {"result": "miss"}, prefix["misses"]),
+                ]),
+                MetricFamily("inference_prefix_cache_bytes", "gauge", "Memory used by the prefix cache", [("", {}, prefix["bytes"])]),
+            ]
+    if response_cache:
+        cache = response_cache.stats()
+        families.append(MetricFamily("inference_response_cache_lookups_total", "counter", "Response cache lookups, by result", [
+            ("", {"result": "hit"}, cache["hits"]),
+            ("", {"result": "miss"}, cache["misses"]),
+        ]))
+    return families
+
+REGISTRY.register_collector(inference_metrics)
+
+# Hälsokontroll (readiness): 200 först när modellen är laddad
 @app.get("/health")
 async def health_check():
-    """Kontrollera om API:et är igång och fungerande."""
-    return {"status": "healthy", "model_loaded": model is not None and tokenizer is not None}
+    """Kontrollera om API:et är igång och redo att generera text."""
+    # Läser bara räknare från schemaläggaren, så svaret blockeras aldrig av inferens
+    content = {
+        "status": model_state,
+        "model_loaded": model_state == "ready",
+        "error": model_error,
+        "scheduler_running": scheduler.is_running if scheduler else False,
+        "batch_size": scheduler.batch_size if scheduler else 0,
+        "max_batch_size": MAX_BATCH_SIZE,
+        "queue_depth": scheduler.queue_depth if scheduler else 0,
+        "max_queue_size": MAX_QUEUE_SIZE,
+        "prefix_cache": scheduler.prefix_cache.stats() if scheduler and scheduler.prefix_cache else None,
+        "response_cache": response_cache.stats() if response_cache else None,
+        "adapters": adapters.list() if adapters else [],
+        "merged_model": MERGED_MODEL_PATH or None,
+        "runtime": runtime_config,
+    }
+    return JSONResponse(content=content, status_code=200 if model_state == "ready" else 503)
+
+# Liveness: processen svarar, även medan modellen laddas
+@app.get("/health/live")
+async def liveness_check():
+    """Kontrollera att processen lever. Misslyckad modelladdning ger 503 så att den startas om."""
+    if model_state == "failed":
+        return JSONResponse(content={"status": "failed", "error": model_error}, status_code=503)
+    return {"status": "alive"}
 
 # Om du kör denna fil direkt
 if __name__ == "__main__":
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The tests import the server modules the way main.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("ANONYMIZED_TELEMETRY", "false")
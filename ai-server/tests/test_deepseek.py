@@ -0,0 +1,122 @@
+"""
+Tests for the DeepSeek provider against a stubbed inference server that
+speaks the /api/generate/stream Server-Sent Events protocol of server.py.
+"""
+
+import asyncio
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("browser_use")
+uvicorn = pytest.importorskip("uvicorn")
+
+from browser_use import Agent
+from browser_use.browser.views import BrowserState, TabInfo
+from browser_use.dom.views import DOMElementNode
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+from computer_use.deepseek import DeepSeekChatModel
+
+# What the stubbed model answers: the agent's next action, as browser-use's system prompt asks for
+DONE_RESPONSE = json.dumps({
+    "current_state": {"evaluation_previous_goal": "Unknown", "memory": "Nothing done yet", "next_goal": "Finish"},
+    "action": [{"done": {"text": "finished", "success": True}}],
+})
+
+
+def create_stub_app(prompts):
+    app = FastAPI()
+
+    @app.post("/api/generate/stream")
+    async def generate_stream(request: Request):
+        body = await request.json()
+        prompts.append(body["prompt"])
+
+        async def events():
+            # Wrapped in a code block and split mid-token, as a real model would send it
+            text = f"```json\n{DONE_RESPONSE}\n```"
+            for start in range(0, len(text), 7):
+                yield f"data: {json.dumps({'text': text[start:start + 7]})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/api/generate/slow")
+    async def generate_slow():
+        async def events():
+            # Each chunk arrives well within httpx's read timeout, but the call never ends
+            for _ in range(100):
+                yield f"data: {json.dumps({'text': '.'})}\n\n"
+                await asyncio.sleep(0.05)
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+@pytest.fixture(scope="module")
+def stub_server():
+    prompts = []
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(create_stub_app(prompts), host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    yield f"http://127.0.0.1:{port}", prompts
+    server.should_exit = True
+    thread.join()
+
+
+class StubBrowserContext:
+    """A browser context with an empty page, so a step needs no real browser."""
+
+    async def get_state(self, *args, **kwargs):
+        root = DOMElementNode(tag_name="body", xpath="/body", attributes={}, children=[], is_visible=True, parent=None)
+        return BrowserState(
+            element_tree=root,
+            selector_map={},
+            url="about:blank",
+            title="",
+            tabs=[TabInfo(page_id=0, url="about:blank", title="")],
+        )
+
+    async def get_selector_map(self):
+        return {}
+
+    async def remove_highlights(self):
+        pass
+
+
+def test_agent_step_with_streamed_json_actions(stub_server):
+    url, prompts = stub_server
+    llm = DeepSeekChatModel(api_key="test", endpoint=url, streaming=True, timeout=10)
+    agent = Agent(task="Say that you are finished", llm=llm, browser_context=StubBrowserContext(), max_actions_per_step=1)
+
+    asyncio.run(agent.step())
+
+    assert agent.state.consecutive_failures == 0
+    result = agent.state.last_result[-1]
+    assert result.is_done and result.extracted_content == "finished"
+    assert "Say that you are finished" in prompts[-1]
+    # browser-use's example action (a tool call) is rendered as JSON in the prompt
+    assert '"action"' in prompts[-1]
+
+
+def test_streaming_timeout_covers_the_whole_call(stub_server):
+    url, _ = stub_server
+    llm = DeepSeekChatModel(api_key="test", endpoint=url, streaming=True, timeout=0.5)
+    # The stub's slow endpoint stands in for the stream endpoint
+    llm._url = lambda path: url + "/api/generate/slow"
+
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        asyncio.run(llm.ainvoke("hello"))
+    assert time.monotonic() - started < 3
@@ -0,0 +1,64 @@
+"""
+Tests for the order in which the task scheduler starts queued tasks.
+"""
+
+import asyncio
+
+import pytest
+
+# The computer_use package imports browser-use
+pytest.importorskip("browser_use")
+
+from computer_use.task_scheduler import TaskScheduler
+
+
+async def idle():
+    await asyncio.sleep(0)
+
+
+def queue_order(scheduler, task_ids):
+    return sorted(task_ids, key=scheduler.queue_position)
+
+
+def test_priority_applies_within_an_owners_queue():
+    async def run():
+        scheduler = TaskScheduler(max_concurrent=1)
+        started = []
+
+        def task(task_id):
+            async def run_task():
+                started.append(task_id)
+            return run_task
+
+        blocker = asyncio.Event()
+        scheduler.submit("running", blocker.wait, owner="a")
+        scheduler.submit("low", task("low"), owner="a")
+        scheduler.submit("high", task("high"), owner="a", priority=5)
+        scheduler.submit("other", task("other"), owner="b", priority=1)
+
+        # a's high priority task does not wait behind its earlier low priority one
+        assert queue_order(scheduler, ["low", "high", "other"]) == ["high", "other", "low"]
+
+        blocker.set()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        assert started == ["high", "other", "low"]
+
+    asyncio.run(run())
+
+
+def test_equal_priorities_are_served_round_robin_and_in_order():
+    async def run():
+        scheduler = TaskScheduler(max_concurrent=1)
+        scheduler.submit("running", asyncio.Event().wait, owner="a")
+        for task_id, owner in [("a1", "a"), ("a2", "a"), ("b1", "b"), ("a3", "a")]:
+            scheduler.submit(task_id, idle, owner=owner)
+
+        assert queue_order(scheduler, ["a1", "a2", "b1", "a3"]) == ["a1", "b1", "a2", "a3"]
+
+        # Cancelling keeps the rest of the owner's queue in order
+        assert scheduler.cancel("a2")
+        assert queue_order(scheduler, ["a1", "b1", "a3"]) == ["a1", "b1", "a3"]
+        assert scheduler.stats()["queued"] == 3
+
+    asyncio.run(run())
@@ -0,0 +1,59 @@
+import os
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from peft import PeftModel
+from dotenv import load_dotenv
+
+# Ladda miljövariabler från .env
+load_dotenv()
+
+# Hämta konfiguration från miljövariabler (samma som train_lora.py)
+MODEL_NAME = os.getenv("LORA_MODEL_PATH", "deepseek-ai/deepseek-coder-6.7b-base")
+OUTPUT_DIR = os.getenv("LORA_OUTPUT_DIR", "./output")
+ADAPTER_DIR = os.getenv("LORA_ADAPTER_DIR", f"{OUTPUT_DIR}/final_model")
+MERGED_DIR = os.getenv("LORA_MERGED_DIR", f"{OUTPUT_DIR}/merged_model")
+MAX_SHARD_SIZE = os.getenv("LORA_MAX_SHARD_SIZE", "2GB")
+
+# Ladda basmodellen i fp16; en 4-bit-kvantiserad modell kan inte slås ihop med adaptern
+def load_base_model():
+    tokenizer = AutoTokenizer.from_pretrained(ADAPTER_DIR if os.path.exists(f"{ADAPTER_DIR}/tokenizer_config.json") else MODEL_NAME)
+    model = AutoModelForCausalLM.from_pretrained(
+        MODEL_NAME,
+        torch_dtype=torch.float16,
+        low_cpu_mem_usage=True,
+    )
+
+    return model, tokenizer
+
+# Slå ihop LoRA-vikterna med basmodellens vikter
+def merge_adapter(model):
+    model = PeftModel.from_pretrained(model, ADAPTER_DIR)
+    model = model.merge_and_unload()
+
+    return model
+
+# Spara den sammanslagna modellen som safetensors
+def save_merged_model(model, tokenizer):
+    os.makedirs(MERGED_DIR, exist_ok=True)
+    model.save_pretrained(MERGED_DIR, safe_serialization=True, max_shard_size=MAX_SHARD_SIZE)
+    tokenizer.save_pretrained(MERGED_DIR)
+
+# Huvudfunktion
+def main():
+    if not os.path.exists(ADAPTER_DIR):
+        raise FileNotFoundError(f"LoRA-adapter hittades inte på {ADAPTER_DIR}. Kör train_lora.py först.")
+
+    print("Laddar basmodell och tokenizer...")
+    model, tokenizer = load_base_model()
+
+    print(f"Slår ihop LoRA-adapter från: {ADAPTER_DIR}")
+    model = merge_adapter(model)
+
+    print("Sparar sammanslagen modell...")
+    save_merged_model(model, tokenizer)
+
+    print("Klart! Den sammanslagna modellen har sparats i:", MERGED_DIR)
+    print(f"Starta servern med MERGED_MODEL_PATH={MERGED_DIR} för att använda den.")
+
+if __name__ == "__main__":
+    main()